@@ -2,8 +2,28 @@ import boto3
 import hashlib
 import json
 import sys, traceback, os
+import gzip
+import base64
 import urllib.request, mimetypes
 import math
+import re
+import time
+import itertools
+import collections
+from array import array
+from datetime import datetime, timedelta, timezone
+
+# NumPy is not part of the lambda runtime. Lambdas which need the fast geo math
+# include it as a layer, the others fall back to the scalar math.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# Likewise for Brotli. Without it, replies are only compressed with gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ################################################################################
 # All AWS resource names
@@ -25,9 +45,26 @@ class CibicResources():
         RideFlowWaypoints = 'cibic21_ride_flow_waypoints'
         WaypointsSnapped = 'cibic21_waypoints_snapped'
         UserEnrollments = 'cibic21_user_enrollments'
+        # One row per ride with the main zone ride line at each of RideLineLevels,
+        # the flow line, the point count and the bounding box (see insertRideGeometry).
+        RideGeometry = 'cibic21_ride_geometry'
+        # The number of rides with a flow per UTC day, user, role, flow, region and
+        # organization, and the latest ride flow per user (see addRideToRollup).
+        RideDailyRollup = 'cibic21_ride_daily_rollup'
+        UserLastFlow = 'cibic21_user_last_flow'
+        # The Accuweather location key per cell and the conditions per location
+        # and period (see fetchWeatherJson).
+        WeatherLocations = 'cibic21_weather_locations'
+        WeatherConditions = 'cibic21_weather_conditions'
+        # The Roads API snapped points per run of geohash cells (see wp-snap).
+        SnappedSegments = 'cibic21_snapped_segments'
 
     class S3Bucket():
         JournalingImages = 'cibic21-s3-journaling-images'
+        # Ride waypoints which are too big for an async lambda payload.
+        RideWaypoints = 'cibic21-s3-ride-waypoints'
+        # The /ride/get GeoJSON of each ride (see renderRideGeoJson).
+        RideGeoJson = 'cibic21-s3-ride-geojson'
 
     Organization = 'CiBiC'
     LosAngelesRegion = 'Los Angeles'
@@ -55,60 +92,951 @@ def guessMimeTypeFromFile(fileName):
     type = res.split(':')[-1].strip()
     return type
 
+def nanToNone(value):
+    """
+    Return None if value is a float NaN (used for a missing value), otherwise value.
+    """
+    return None if value != value else value
+
+class LruCache():
+    """
+    Least recently used cache in the lambda container, which lasts across warm
+    invocations. The total size of the values (the len of each value, such as
+    the characters of a str) is at most maxSize, and an entry expires ttl
+    seconds after it was put (never if ttl is None). hits, misses and evictions
+    count since the container started.
+    """
+    def __init__(self, name, maxSize, ttl=None):
+        self.name = name
+        self.maxSize = maxSize
+        self.ttl = ttl
+        # key -> (value, size, expiry time or None), least recently used first.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the value for key, or None if there is none or it expired.
+        """
+        entry = self.entries.get(key)
+        if entry != None and (entry[2] == None or entry[2] > time.monotonic()):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry != None:
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Put the value for key, evicting the least recently used entries to stay
+        within maxSize. A value bigger than maxSize is not cached.
+        """
+        self.pop(key)
+        size = len(value)
+        if size > self.maxSize:
+            return
+        self.entries[key] = (value, size, time.monotonic() + self.ttl if self.ttl != None else None)
+        self.size += size
+        while self.size > self.maxSize:
+            key, (value, size, expiry) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def pop(self, key):
+        """
+        Remove the entry for key, if any. Return True if there was one.
+        """
+        entry = self.entries.pop(key, None)
+        if entry == None:
+            return False
+        self.size -= entry[1]
+        return True
+
+    def evict(self, predicate):
+        """
+        Remove the entries whose key matches predicate(key). Return the number of
+        removed entries.
+        """
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
+
+    def getStats(self):
+        """
+        Return the counters as a string for the log.
+        """
+        return '{} cache: {} hits, {} misses, {} evictions, {} entries, size {}'.format(
+                 self.name, self.hits, self.misses, self.evictions, len(self.entries), self.size)
+
 def unmarshallAwsDataItem(awsDict):
     boto3.resource('dynamodb')
     deserializer = boto3.dynamodb.types.TypeDeserializer()
     pyDict = {k: deserializer.deserialize(v) for k,v in awsDict.items()}
     return pyDict
 
+# Accuweather location keys are cached by cells of this many degrees of latitude
+# and longitude, and the conditions by periods of weatherPeriodSeconds.
+weatherCellDegrees = float(os.environ['ENV_VAR_WEATHER_CELL_DEGREES']) if 'ENV_VAR_WEATHER_CELL_DEGREES' in os.environ else 0.01
+weatherPeriodSeconds = 15 * 60
+# The caches in the container, in front of the WeatherLocations and
+# WeatherConditions tables.
+weatherLocationCache = LruCache('weather location', 64 * 1024)
+weatherConditionsCache = LruCache('weather conditions', 1024 * 1024)
+
 def fetchWeatherJson(lat, lon, accuweatherLocationUrl, accuweatherConditionsUrl,
-      accuweatherApiKey, requests):
+      accuweatherApiKey, requests, cur=None):
     """
     Use the lat, lon to fetch the Accuweather location key, and use that to
     fetch the weather conditions. Return a JSON string of the entire response.
     You must pass in requests because this requires the Lambda to include the
     layer for it. If there is an error, print the error and return None.
+    The location key of the lat, lon cell (see weatherCellDegrees) and the
+    conditions of the current period (see weatherPeriodSeconds) are cached in
+    the container and, if cur is given, in the WeatherLocations and
+    WeatherConditions tables.
     """
-    # Fetch the location key.
-    response = requests.get(
-        '{}?apikey={}&q={}%2C{}'.format(accuweatherLocationUrl, accuweatherApiKey, lat, lon))
-    if response.status_code/100 == 2:
-        locationKey = response.json()['Key']
-    else:
-        err = 'Accuweather location API request failed with code {}'.format(response.status_code)
-        print(err)
+    cell = '{}:{},{}'.format(weatherCellDegrees, round(lat / weatherCellDegrees), round(lon / weatherCellDegrees))
+    period = datetime.fromtimestamp(time.time() // weatherPeriodSeconds * weatherPeriodSeconds, timezone.utc)
+    locationKey = getWeatherLocationKey(cell, accuweatherLocationUrl, accuweatherApiKey,
+                                        lat, lon, requests, cur)
+    if locationKey == None:
         return None
 
-    # Fetch the weather conditions.
-    response = requests.get(
-        '{}/{}?apikey={}&language=en-us'.format(accuweatherConditionsUrl, locationKey, accuweatherApiKey))
-    if response.status_code/100 == 2:
-        if len(response.json()) == 1:
-            return json.dumps(response.json()[0])
+    conditionsJson = weatherConditionsCache.get((locationKey, period))
+    if conditionsJson == None and cur != None:
+        row = executeCacheSql(cur, """
+              SELECT "conditionsJson" FROM {} WHERE "locationKey" = %s AND period = %s
+              """.format(CibicResources.Postgres.WeatherConditions), (locationKey, period))
+        if row != None:
+            conditionsJson = row[0]
+    if conditionsJson == None:
+        # Fetch the weather conditions.
+        response = requests.get(
+            '{}/{}?apikey={}&language=en-us'.format(accuweatherConditionsUrl, locationKey, accuweatherApiKey))
+        if response.status_code/100 == 2:
+            if len(response.json()) == 1:
+                conditionsJson = json.dumps(response.json()[0])
+            else:
+                err = 'Expected 1 Accuweather result. Got {}: {}'.format(len(response.json()), response.json())
+                print(err)
+                return None
         else:
-            err = 'Expected 1 Accuweather result. Got {}: {}'.format(len(response.json()), response.json())
+            err = 'Accuweather conditions API request failed with code {}'.format(response.status_code)
             print(err)
             return None
-    else:
-        err = 'Accuweather conditions API request failed with code {}'.format(response.status_code)
-        print(err)
+        if cur != None:
+            executeCacheSql(cur, """
+              INSERT INTO {} ("locationKey", period, "conditionsJson") VALUES (%s, %s, %s)
+              ON CONFLICT DO NOTHING
+              """.format(CibicResources.Postgres.WeatherConditions), (locationKey, period, conditionsJson))
+            # The older conditions of the location are not used again.
+            executeCacheSql(cur, """
+              DELETE FROM {} WHERE "locationKey" = %s AND period < %s
+              """.format(CibicResources.Postgres.WeatherConditions), (locationKey, period - timedelta(days=1)))
+    weatherConditionsCache.put((locationKey, period), conditionsJson)
+    print(weatherLocationCache.getStats())
+    print(weatherConditionsCache.getStats())
+    return conditionsJson
+
+def getWeatherLocationKey(cell, accuweatherLocationUrl, accuweatherApiKey, lat, lon, requests, cur):
+    """
+    Return the Accuweather location key for the cell from the caches (see
+    fetchWeatherJson) or else fetch it for lat, lon. If there is an error, print
+    the error and return None.
+    """
+    locationKey = weatherLocationCache.get(cell)
+    if locationKey == None and cur != None:
+        row = executeCacheSql(cur, """
+              SELECT "locationKey" FROM {} WHERE cell = %s
+              """.format(CibicResources.Postgres.WeatherLocations), (cell,))
+        if row != None:
+            locationKey = row[0]
+    if locationKey == None:
+        # Fetch the location key.
+        response = requests.get(
+            '{}?apikey={}&q={}%2C{}'.format(accuweatherLocationUrl, accuweatherApiKey, lat, lon))
+        if response.status_code/100 == 2:
+            locationKey = response.json()['Key']
+        else:
+            err = 'Accuweather location API request failed with code {}'.format(response.status_code)
+            print(err)
+            return None
+        if cur != None:
+            executeCacheSql(cur, """
+              INSERT INTO {} (cell, "locationKey") VALUES (%s, %s) ON CONFLICT DO NOTHING
+              """.format(CibicResources.Postgres.WeatherLocations), (cell, locationKey))
+    weatherLocationCache.put(cell, locationKey)
+    return locationKey
+
+def executeCacheSql(cur, sql, parameters, fetchAll=False):
+    """
+    Execute the sql for a cache table (such as WeatherConditions) in a
+    savepoint, so that an error (such as a missing table) does not abort the
+    transaction of the caller. Return the first row, or None if there is none
+    or an error. If fetchAll, return the list of all the rows instead ([] if
+    there is an error).
+    """
+    cur.execute('SAVEPOINT cache_table')
+    try:
+        cur.execute(sql, parameters)
+        if fetchAll:
+            result = cur.fetchall() if cur.description != None else []
+        else:
+            result = cur.fetchone() if cur.description != None else None
+        cur.execute('RELEASE SAVEPOINT cache_table')
+        return result
+    except Exception:
+        reportError()
+        cur.execute('ROLLBACK TO SAVEPOINT cache_table')
+        return [] if fetchAll else None
+
+################################################################################
+# OBJECT STORE HELPERS
+################################################################################
+class S3ObjectStore():
+    """
+    Put and get objects by key in an S3 bucket.
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3')
+
+    def put(self, key, data, contentType='binary/octet-stream', metadata=None):
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=contentType,
+                           Metadata=metadata or {})
+
+    def open(self, key):
+        """
+        Return a readable binary stream of the object. The caller must close it.
+        """
+        return self.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def get(self, key):
+        stream = self.open(key)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def getWithMetadata(self, key):
+        """
+        Return (data, metadata dict) of the object, or None if there is none.
+        """
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        try:
+            return (response['Body'].read(), response['Metadata'])
+        finally:
+            response['Body'].close()
+
+    def delete(self, key):
+        """
+        Delete the object, if there is one.
+        """
+        self.s3.delete_object(Bucket=self.bucket, Key=key)
+
+class LocalObjectStore():
+    """
+    Put and get objects by key as files in a local folder. This stands in for
+    S3ObjectStore when running lambdas locally.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, key):
+        return os.path.join(self.folder, *key.split('/'))
+
+    def put(self, key, data, contentType='binary/octet-stream', metadata=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        # The metadata is in a file next to the object.
+        with open(path + '.metadata', 'w') as f:
+            json.dump(metadata or {}, f)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def get(self, key):
+        with self.open(key) as stream:
+            return stream.read()
+
+    def getWithMetadata(self, key):
+        try:
+            data = self.get(key)
+        except FileNotFoundError:
+            return None
+        metadata = {}
+        if os.path.exists(self.path(key) + '.metadata'):
+            with open(self.path(key) + '.metadata') as f:
+                metadata = json.load(f)
+        return (data, metadata)
+
+    def delete(self, key):
+        for path in (self.path(key), self.path(key) + '.metadata'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def makeObjectStore(bucket):
+    """
+    Return an S3ObjectStore for the bucket. If the environment variable
+    ENV_VAR_LOCAL_OBJECT_STORE_DIR is set (for running locally), return a
+    LocalObjectStore for the bucket's folder under it.
+    """
+    localDir = os.environ.get('ENV_VAR_LOCAL_OBJECT_STORE_DIR')
+    if localDir:
+        return LocalObjectStore(os.path.join(localDir, bucket))
+    return S3ObjectStore(bucket)
+
+################################################################################
+# POSTGRES HELPERS
+################################################################################
+# The Postgres connection of this lambda container, kept across warm invocations.
+_postgresConnection = None
+
+def getPostgresConnection(host, database, user, password):
+    """
+    Return the Postgres connection of this lambda container, connecting if there
+    is none yet or it is no longer usable. Because the connection is reused by
+    warm invocations, roll back any transaction which a previous invocation left
+    open and reset session settings (such as SET TIME ZONE). The reset is also
+    the liveness check, so it costs one round trip.
+    """
+    global _postgresConnection
+    # Only the lambdas which use Postgres have psycopg2.
+    import psycopg2
+
+    conn = _postgresConnection
+    if conn != None and conn.closed == 0:
+        try:
+            conn.rollback()
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute('RESET ALL')
+            cur.close()
+            conn.autocommit = False
+            return conn
+        except psycopg2.Error as err:
+            print('reconnecting to postgres after error: {}'.format(err))
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    _postgresConnection = psycopg2.connect(host=host, database=database,
+                                           user=user, password=password)
+    return _postgresConnection
+
+# Characters per read of CopyRowStream, which bounds the memory for the rows.
+copyBufferSize = 64 * 1024
+
+def formatCopyValue(value):
+    """
+    Return the value in the COPY text format: \\N for None, t or f for a bool
+    and str() otherwise, escaping backslash, tab, newline and carriage return.
+    """
+    if value == None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    text = str(value)
+    if '\\' in text or '\t' in text or '\n' in text or '\r' in text:
+        text = (text.replace('\\', '\\\\').replace('\t', '\\t')
+                    .replace('\n', '\\n').replace('\r', '\\r'))
+    return text
+
+class CopyRowStream:
+    """
+    File-like object for cursor.copy_expert which formats the rows of an
+    iterable (such as a generator) in the COPY text format only as psycopg2
+    reads them, so that the rows are never all in memory. count is the number
+    of rows read so far.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.rest = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        chunks = [self.rest]
+        length = len(self.rest)
+        for row in self.rows:
+            line = '\t'.join(formatCopyValue(value) for value in row) + '\n'
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+            if size >= 0 and length >= size:
+                break
+        data = ''.join(chunks)
+        if size >= 0 and len(data) > size:
+            self.rest = data[size:]
+            data = data[:size]
+        else:
+            self.rest = ''
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+def copyRows(cur, table, columns, rows):
+    """
+    Insert the rows (an iterable of tuples, for example from a generator) into
+    the Postgres table with COPY FROM STDIN. columns is the list of column names
+    in the order of the tuple values, or None for all the columns of the table.
+    Values are as for formatCopyValue, so a point column takes the same
+    'lon, lat' text as makeSqlPoint. Return the number of rows.
+    """
+    sql = 'COPY {} '.format(table)
+    if columns != None:
+        sql += '({}) '.format(', '.join('"{}"'.format(column) for column in columns))
+    sql += 'FROM STDIN'
+    stream = CopyRowStream(rows)
+    cur.copy_expert(sql, stream, size=copyBufferSize)
+    return stream.count
+
+# Statements declared with declarePreparedStatement: name -> (sql, parameterTypes, preamble).
+_preparedStatements = {}
+# The connection whose session has prepared the names in _preparedNames. If
+# _preparedNames is None, it is unknown which names are prepared.
+_preparedConnection = None
+_preparedNames = set()
+# Timing counters: name -> {'calls', 'prepares', 'seconds', 'maxSeconds'}.
+_preparedStatementStats = {}
+
+def declarePreparedStatement(name, sql, parameterTypes, preamble=''):
+    """
+    Declare the statement for executePreparedStatement. sql uses $1, $2, ... for
+    the parameters, whose Postgres types are in the list parameterTypes. The
+    optional preamble (such as "SET TIME ZONE ...;") is sent before each
+    execution in the same round trip, since PREPARE only takes a single query.
+    name must be a lowercase SQL identifier.
+    """
+    _preparedStatements[name] = (sql.strip().rstrip(';'), parameterTypes, preamble)
+    _preparedStatementStats[name] = {'calls': 0, 'prepares': 0, 'seconds': 0.0, 'maxSeconds': 0.0}
+
+def getDeclaredStatement(name):
+    """
+    Return (sql, parameterTypes, preamble) of the statement declared with
+    declarePreparedStatement, for example to EXPLAIN it.
+    """
+    return _preparedStatements[name]
+
+def executePreparedStatement(cur, name, parameters):
+    """
+    Execute the declared statement on cur with the list of parameters. The first
+    execution on a connection sends PREPARE (in the same round trip) so that
+    Postgres parses and plans the statement once per connection. Later
+    executions only send EXECUTE. Fetch the results from cur as usual.
+    If cur is a named (server-side) cursor, send the statement itself with the
+    parameters instead, since DECLARE CURSOR cannot use a prepared statement.
+    """
+    global _preparedConnection, _preparedNames
+    sql, parameterTypes, preamble = _preparedStatements[name]
+    if cur.name != None:
+        executeStatementOnNamedCursor(cur, name, parameters)
+        return
+    if cur.connection is not _preparedConnection:
+        _preparedConnection = cur.connection
+        _preparedNames = set()
+    if _preparedNames == None:
+        # A previous execution failed, maybe after its PREPARE succeeded.
+        cur.execute('SELECT name FROM pg_prepared_statements;')
+        _preparedNames = set(row[0] for row in cur.fetchall())
+
+    prepare = name not in _preparedNames
+    command = preamble
+    if prepare:
+        # Escape % for the psycopg2 parameter formatting of the whole command.
+        command += 'PREPARE {} ({}) AS {};'.format(name, ', '.join(parameterTypes),
+                                                   sql.replace('%', '%%'))
+    command += 'EXECUTE {}'.format(name)
+    if len(parameters) > 0:
+        command += ' ({})'.format(', '.join(['%s'] * len(parameters)))
+    command += ';'
+
+    start = time.perf_counter()
+    try:
+        cur.execute(command, parameters)
+    except:
+        # Check pg_prepared_statements next time, since PREPARE is not undone by
+        # the rollback of a failed transaction.
+        _preparedNames = None
+        raise
+    seconds = time.perf_counter() - start
+    if prepare:
+        _preparedNames.add(name)
+
+    addPreparedStatementTime(name, prepare, seconds)
+    print('executed {}{} in {:.1f} ms'.format(name, ' (prepared)' if prepare else '', seconds * 1000))
+
+def executeStatementOnNamedCursor(cur, name, parameters):
+    """
+    Declare the named cursor cur for the declared statement with the list of
+    parameters, which psycopg2 binds into the SQL. The preamble is sent first on
+    another cursor of the connection. Fetch the results from cur as usual.
+    """
+    sql, parameterTypes, preamble = _preparedStatements[name]
+    start = time.perf_counter()
+    if preamble != '':
+        preambleCur = cur.connection.cursor()
+        preambleCur.execute(preamble)
+        preambleCur.close()
+    cur.execute(*bindStatementParameters(sql, parameterTypes, parameters))
+    seconds = time.perf_counter() - start
+    addPreparedStatementTime(name, False, seconds)
+    print('executed {} on cursor {} in {:.1f} ms'.format(name, cur.name, seconds * 1000))
+
+def bindStatementParameters(sql, parameterTypes, parameters):
+    """
+    Return (sql, parameters) for cur.execute of the statement sql with $1, $2, ...
+    replaced by named psycopg2 parameters with the declared parameterTypes, so
+    that psycopg2 binds the list of parameters into the SQL.
+    """
+    return (re.sub(r'\$(\d+)', lambda match: '%(p{0})s::{1}'.format(
+                     match.group(1), parameterTypes[int(match.group(1)) - 1]),
+                   sql.replace('%', '%%')),
+            {'p{}'.format(i + 1): value for i, value in enumerate(parameters)})
+
+def addPreparedStatementTime(name, prepare, seconds):
+    """
+    Add an execution of the declared statement to its timing counters.
+    """
+    stats = _preparedStatementStats[name]
+    stats['calls'] += 1
+    stats['prepares'] += 1 if prepare else 0
+    stats['seconds'] += seconds
+    stats['maxSeconds'] = max(stats['maxSeconds'], seconds)
+
+def getPreparedStatementStats():
+    """
+    Return the timing counters of the declared statements with at least one
+    execution in this lambda container: name -> {'calls', 'prepares', 'seconds',
+    'maxSeconds'}, where seconds is the total time of cur.execute.
+    """
+    return {name: dict(stats) for name, stats in _preparedStatementStats.items()
+            if stats['calls'] > 0}
+
+def printPreparedStatementStats():
+    """
+    Print the timing counters of getPreparedStatementStats, one line per
+    statement. Call at the end of each invocation so that the log shows the
+    totals of the container so far.
+    """
+    for name, stats in sorted(getPreparedStatementStats().items()):
+        print('statement {}: {} calls, {} prepares, {:.1f} ms total, {:.1f} ms max'.format(
+            name, stats['calls'], stats['prepares'], stats['seconds'] * 1000,
+            stats['maxSeconds'] * 1000))
+
+# The simplifyLine tolerance in meters (0 for the full line) of each column in
+# the RideGeometry table. The ride line in each column is the JSON array of the
+# WaypointsRaw "pointJson" of the kept main zone waypoints, ordered by idx.
+RideLineLevels = ((0, 'rideLineJson'), (5, 'rideLine5mJson'),
+                  (20, 'rideLine20mJson'), (100, 'rideLine100mJson'))
+
+def getRideLineColumn(tolerance):
+    """
+    Return the RideGeometry column for the coarsest of RideLineLevels with a
+    tolerance not greater than tolerance (meters). If tolerance is None, return
+    the column of the full line.
+    """
+    result = RideLineLevels[0][1]
+    if tolerance != None:
+        for level, column in RideLineLevels:
+            if level <= tolerance:
+                result = column
+    return result
+
+def makeLineWkt(latitudes, longitudes):
+    """
+    Return the WKT LINESTRING for the points, or None if there are fewer than
+    two points (a LineString needs at least two).
+    """
+    if len(latitudes) < 2:
         return None
+    return 'LINESTRING({})'.format(', '.join(
+      '{!r} {!r}'.format(float(longitudes[i]), float(latitudes[i])) for i in range(len(latitudes))))
+
+def insertRideGeometry(cur, rideId, latitudes, longitudes, pointJsons,
+                       flowLatitudes=(), flowLongitudes=()):
+    """
+    Insert (or replace) the RideGeometry row for the ride, simplifying the main
+    zone ride line to each of RideLineLevels. latitudes, longitudes and
+    pointJsons (the JSON strings as in WaypointsRaw "pointJson") are for the
+    main zone waypoints ordered by idx. flowLatitudes and flowLongitudes are
+    for the flow waypoints (as in RideFlowWaypoints) ordered by idx, if any.
+    "rideLine" is the full line as a PostGIS geometry for spatial queries such
+    as the vector tiles, "flowLine" is the flow line, "pointCount" is the
+    number of main zone waypoints and "bbox" is the bounding box of the main
+    zone waypoints. The table is:
+    "rideId" text PRIMARY KEY, "rideLineJson" json, "rideLine5mJson" json,
+    "rideLine20mJson" json, "rideLine100mJson" json,
+    "rideLine" geometry(LineString, 4326), "flowLine" geometry(LineString, 4326)
+    (both with a GIST index), "pointCount" integer, "bbox" geometry(Polygon, 4326)
+    """
+    lines = []
+    counts = []
+    for level, column in RideLineLevels:
+        if len(pointJsons) == 0:
+            # Match array_agg of no waypoints.
+            lines.append(None)
+            counts.append(0)
+        else:
+            keep = simplifyLine(latitudes, longitudes, level)
+            lines.append('[' + ', '.join(pointJsons[i] for i in keep) + ']')
+            counts.append(len(keep))
+    bbox = [None] * 4
+    if len(latitudes) > 0:
+        bbox = [float(min(longitudes)), float(min(latitudes)), float(max(longitudes)), float(max(latitudes))]
+
+    sql = """
+          INSERT INTO {0} ("rideId", {1}, "rideLine", "flowLine", "pointCount", "bbox")
+          VALUES (%s, {2}, ST_GeomFromText(%s, 4326), ST_GeomFromText(%s, 4326), %s,
+                  ST_MakeEnvelope(%s, %s, %s, %s, 4326))
+          ON CONFLICT ("rideId") DO UPDATE SET {3}, "rideLine" = EXCLUDED."rideLine",
+            "flowLine" = EXCLUDED."flowLine", "pointCount" = EXCLUDED."pointCount", "bbox" = EXCLUDED."bbox"
+          """.format(CibicResources.Postgres.RideGeometry,
+                     ', '.join('"{}"'.format(column) for level, column in RideLineLevels),
+                     ', '.join(['%s'] * len(RideLineLevels)),
+                     ', '.join('"{0}" = EXCLUDED."{0}"'.format(column) for level, column in RideLineLevels))
+    cur.execute(sql, [rideId] + lines + [makeLineWkt(latitudes, longitudes),
+                                         makeLineWkt(flowLatitudes, flowLongitudes),
+                                         len(latitudes)] + bbox)
+    print('inserted ride geometry for ride {} with line points {} and {} flow points'.format(
+          rideId, counts, len(flowLatitudes)))
+
+def addRideToRollup(cur, rideId):
+    """
+    Count the ride (just inserted into Rides in the same transaction) in
+    RideDailyRollup and update the user's UserLastFlow if it is the latest ride.
+    Rides without a flow, start time or user are not counted. NULL role, region
+    and organization are counted as ''. The tables are:
+    RideDailyRollup: day date (UTC), "userId" text, role text, flow text,
+    region text, organization text (all NOT NULL and the PRIMARY KEY),
+    rides integer NOT NULL
+    UserLastFlow: "userId" text PRIMARY KEY, "startTime" timestamptz NOT NULL,
+    flow text NOT NULL, "flowName" text
+    """
+    sql = """
+          INSERT INTO {0} (day, "userId", role, flow, region, organization, rides)
+          SELECT ("startTime" AT TIME ZONE 'UTC')::date, "userId", COALESCE(role, ''), flow,
+                 COALESCE(region, ''), COALESCE(organization, ''), 1
+            FROM {1}
+            WHERE "rideId" = %s AND flow IS NOT NULL AND "startTime" IS NOT NULL AND "userId" IS NOT NULL
+          ON CONFLICT (day, "userId", role, flow, region, organization) DO UPDATE SET rides = {0}.rides + 1
+          """.format(CibicResources.Postgres.RideDailyRollup, CibicResources.Postgres.Rides)
+    cur.execute(sql, (rideId,))
+    sql = """
+          INSERT INTO {0} ("userId", "startTime", flow, "flowName")
+          SELECT "userId", "startTime", flow, "flowName"
+            FROM {1}
+            WHERE "rideId" = %s AND flow IS NOT NULL AND "startTime" IS NOT NULL AND "userId" IS NOT NULL
+          ON CONFLICT ("userId") DO UPDATE
+            SET "startTime" = EXCLUDED."startTime", flow = EXCLUDED.flow, "flowName" = EXCLUDED."flowName"
+            WHERE {0}."startTime" <= EXCLUDED."startTime"
+          """.format(CibicResources.Postgres.UserLastFlow, CibicResources.Postgres.Rides)
+    cur.execute(sql, (rideId,))
+
+# Sent before the ride GeoJSON queries so that the timestamps are in local time.
+timeZonePreamble = "SET TIME ZONE 'America/Los_Angeles';"
+
+# The /ride/get GeoJSON of ride $1, with the ride line from the RideGeometry
+# column {2} (see getRideLineColumn).
+fetchRideSql = """
+            SELECT json_build_object(
+                     'type', 'FeatureCollection',
+                     'features', array_to_json(feature_list),
+                     'properties', json_build_object(
+                                     'rideId', rid,
+                                     'startTime', start_time,
+                                     'endTime', end_time,
+                                     'userId', user_id,
+                                     'role', role,
+                                     'flow', flow,
+                                     'flowName', flow_name,
+                                     'flowIsToWork', flow_is_to_work,
+                                     'commute', commute,
+                                     'flowJoinPoints', flow_join_points_json,
+                                     'flowLeavePoints', flow_leave_points_json,
+                                     'pod', pod,
+                                     'podName', pod_name,
+                                     'podMember', pod_member_json,
+                                     'inferredPod', inferred_pod,
+                                     'inferredPodName', inferred_pod_name,
+                                     'weather', weather_json,
+                                     'region', region,
+                                     'organization', organization,
+                                     'flowPath', flow_path
+                                   )
+                   )::text
+            FROM (SELECT array[json_build_object(
+                                'type', 'Feature',
+                                'geometry', ST_AsGeoJSON(start_zone)::json
+                               ),
+                               json_build_object(
+                                'type', 'Feature',
+                                'geometry', ST_AsGeoJSON(end_zone)::json
+                               ),
+                               json_build_object(
+                                'type', 'Feature',
+                                'geometry', json_build_object(
+                                              'type', 'LineString',
+                                              'coordinates', ride_line
+                                            ))
+                               ] AS feature_list,
+                               json_build_object(
+                                'type', 'Feature',
+                                'geometry', ST_AsGeoJSON(flow_line)::json) AS flow_path,
+                               rid, start_time, end_time, user_id, role, flow, flow_name, flow_is_to_work, commute,
+                               flow_join_points_json, flow_leave_points_json, pod, pod_name, pod_member_json,
+                               inferred_pod, inferred_pod_name, weather_json, region, organization
+                  FROM (SELECT ride."startZone" AS start_zone,
+                               ride."endZone" AS end_zone,
+                               geometry."{2}" AS ride_line,
+                               geometry."flowLine" AS flow_line,
+                               ride."rideId" AS rid,
+                               ride."startTime" AS start_time,
+                               ride."endTime" AS end_time,
+                               ride."userId" AS user_id,
+                               ride."role" AS role,
+                               ride."flow" AS flow,
+                               ride."flowName" AS flow_name,
+                               ride."flowIsToWork" AS flow_is_to_work,
+                               ride."commute" AS commute,
+                               ride."flowJoinPointsJson" AS flow_join_points_json,
+                               ride."flowLeavePointsJson" AS flow_leave_points_json,
+                               ride."pod" AS pod,
+                               ride."podName" AS pod_name,
+                               ride."podMemberJson" AS pod_member_json,
+                               ride."inferredPod" AS inferred_pod,
+                               ride."inferredPodName" AS inferred_pod_name,
+                               ride."weatherJson" AS weather_json,
+                               ride."region" AS region,
+                               ride."organization" AS organization
+                         FROM {0} AS ride
+                         LEFT JOIN {1} AS geometry
+                         ON ride."rideId" = geometry."rideId"
+                         WHERE ride."rideId" = $1
+                       ) AS geo
+                 ) AS feature_collection;
+          """
+for level, column in RideLineLevels:
+    declarePreparedStatement('fetch_ride_' + column.lower(),
+                             fetchRideSql.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry,
+                                                 column),
+                             ['text'], timeZonePreamble)
+
+fetchRideVersionSql = """
+            SELECT ride."updatedTime", ride."inferredPod", geometry."updatedTime"
+            FROM {0} AS ride
+            LEFT JOIN {1} AS geometry
+            ON ride."rideId" = geometry."rideId"
+            WHERE ride."rideId" = $1;
+          """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry)
+declarePreparedStatement('fetch_ride_version', fetchRideVersionSql, ['text'])
+
+def selectRideVersion(cur, rideId):
+    """
+    Return the version of the ride: ("updatedTime" of the ride, "inferredPod",
+    "updatedTime" of its RideGeometry), or None if there is no such ride. Any
+    change of the ride GeoJSON changes the version. Once inferredPod is set,
+    the ride no longer changes.
+    """
+    executePreparedStatement(cur, 'fetch_ride_version', [rideId])
+    version = cur.fetchone()
+    return tuple(version) if version != None else None
+
+def selectRideJson(cur, rideId, rideLineColumn):
+    """
+    Return the GeoJSON for the ride as JSON text, or None if not found.
+    rideLineColumn is the RideGeometry column for the ride line (see
+    getRideLineColumn). Postgres builds the JSON, so pass the text through
+    without decoding it.
+    """
+    executePreparedStatement(cur, 'fetch_ride_' + rideLineColumn.lower(), [rideId])
+    row = cur.fetchone()
+    return row[0] if row != None else None
+
+def makeRideVersionTag(version):
+    """
+    Return a short string for the version from selectRideVersion.
+    """
+    return hashlib.sha1(json.dumps(version, default=str).encode('utf-8')).hexdigest()
+
+def getRideGeoJsonKey(rideId, rideLineColumn):
+    """
+    Return the RideGeoJson object store key of the ride GeoJSON.
+    """
+    return 'rides/{}/{}.json'.format(rideId, rideLineColumn)
+
+def renderRideGeoJson(cur, store, rideId):
+    """
+    Put the GeoJSON of the ride at each of RideLineLevels into the RideGeoJson
+    object store, with the metadata 'ride-version' (see makeRideVersionTag).
+    Return False if there is no such ride. The version is selected before the
+    GeoJSON so that a concurrent update makes the tag older, never newer, than
+    the GeoJSON.
+    """
+    version = selectRideVersion(cur, rideId)
+    if version == None:
+        return False
+    for level, column in RideLineLevels:
+        rideJson = selectRideJson(cur, rideId, column)
+        if rideJson == None:
+            return False
+        store.put(getRideGeoJsonKey(rideId, column), rideJson.encode('utf-8'), 'application/json',
+                  {'ride-version': makeRideVersionTag(version)})
+    print('rendered ride GeoJSON for ride {}'.format(rideId))
+    return True
+
+def readRideGeoJson(store, rideId, rideLineColumn, version):
+    """
+    Return the rendered GeoJSON of the ride (see renderRideGeoJson) as text if
+    it is for the version from selectRideVersion, otherwise None.
+    """
+    obj = store.getWithMetadata(getRideGeoJsonKey(rideId, rideLineColumn))
+    if obj == None:
+        return None
+    data, metadata = obj
+    if metadata.get('ride-version') != makeRideVersionTag(version):
+        print('rendered GeoJSON of ride {} is not for the current version'.format(rideId))
+        return None
+    return data.decode('utf-8')
 
 ################################################################################
 # LAMBDA HELPERS
 ################################################################################
-def lambdaReply(code, message):
-    messageJson = json.dumps(message)
+# Replies with a smaller body are not compressed.
+compressReplyMinBytes = int(os.environ['ENV_VAR_COMPRESS_MIN_BYTES']) if 'ENV_VAR_COMPRESS_MIN_BYTES' in os.environ else 1024
+
+def lambdaReply(code, message, event=None, headers=None):
+    return lambdaReplyJson(code, json.dumps(message), event, headers)
+
+def lambdaReplyJson(code, messageJson, event=None, headers=None):
+    """
+    Like lambdaReply for the message which is already JSON text. If event (the
+    API Gateway request) is given and its Accept-Encoding allows, compress a
+    body of at least compressReplyMinBytes with Brotli (if available) or gzip.
+    Since the body then depends on Accept-Encoding, the reply has Vary:
+    Accept-Encoding for shared caches (even if this body is not compressed).
+    headers (such as ETag) are added to the reply.
+    """
     maxPrintLen = 200
     if len(messageJson) <= maxPrintLen:
         print('lambda reply {} {}'.format(code, messageJson))
     else:
         print('lambda reply {} {} ...'.format(code, messageJson[0:maxPrintLen]))
 
-    return {
+    reply = {
         'statusCode': code,
         'body': messageJson
     }
+    if event != None:
+        reply['headers'] = {'Vary': 'Accept-Encoding'}
+    if event != None and len(messageJson) >= compressReplyMinBytes:
+        encoding = getReplyEncoding(event)
+        if encoding != None:
+            start = time.perf_counter()
+            data = messageJson.encode('utf-8')
+            if encoding == 'br':
+                compressed = brotli.compress(data, quality=5)
+            else:
+                compressed = gzip.compress(data, compresslevel=6)
+            reply = {
+                'statusCode': code,
+                'headers': {'Content-Type': 'application/json', 'Content-Encoding': encoding,
+                            'Vary': 'Accept-Encoding'},
+                'body': base64.b64encode(compressed).decode('ascii'),
+                'isBase64Encoded': True
+            }
+            print('compressed reply with {} from {} to {} bytes (ratio {:.1f}) in {:.1f} ms'.format(
+                  encoding, len(data), len(compressed), len(data) / len(compressed),
+                  (time.perf_counter() - start) * 1000))
+    if headers != None:
+        reply['headers'] = dict(reply.get('headers', {}), **headers)
+    return reply
+
+def getRequestHeader(event, name):
+    """
+    Return the value of the header (case-insensitive name) of the API Gateway
+    event, or None.
+    """
+    for headerName, value in (event.get('headers') or {}).items():
+        if headerName.lower() == name.lower():
+            return value
+    return None
+
+def makeETag(event, *parts):
+    """
+    Return a strong ETag (quoted) for the reply of lambdaReplyJson to the API
+    Gateway event. The parts are JSON serializable or converted with str (such
+    as datetimes) and must identify the reply body. The ETag also depends on
+    the encoding from getReplyEncoding, so that each Content-Encoding of the
+    body has its own ETag.
+    """
+    parts = (getReplyEncoding(event),) + parts
+    return '"{}"'.format(hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest())
+
+def isNotModified(event, etag):
+    """
+    Return True if the If-None-Match header of the API Gateway event matches
+    etag, in which case reply with notModifiedReply.
+    """
+    ifNoneMatch = getRequestHeader(event, 'If-None-Match')
+    if ifNoneMatch == None:
+        return False
+    for tag in ifNoneMatch.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison.
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+def notModifiedReply(etag, headers=None):
+    print('lambda reply 304 {}'.format(etag))
+    return {
+        'statusCode': 304,
+        'headers': dict({'ETag': etag, 'Vary': 'Accept-Encoding'}, **(headers or {})),
+        'body': ''
+    }
+
+def getReplyEncoding(event):
+    """
+    Return 'br' or 'gzip' for the reply as allowed by the Accept-Encoding
+    header of the API Gateway event, or None to not compress.
+    """
+    acceptEncoding = getRequestHeader(event, 'Accept-Encoding') or ''
+    accepted = set()
+    for item in acceptEncoding.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for part in parts[1:]:
+            if part.startswith('q='):
+                try:
+                    quality = float(part[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(parts[0].lower())
+    if brotli != None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
 
 def malformedMessageReply():
     return lambdaReply(420, 'Malformed message received')
@@ -116,72 +1044,511 @@ def malformedMessageReply():
 def processedReply():
     return lambdaReply(200, 'Message processed')
 
+################################################################################
+# WAYPOINT HELPERS
+################################################################################
+epochUtc = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parseIsoTimestamp(timestamp):
+    """
+    Parse the ISO 8601 timestamp string (which may end in 'Z') and return
+    (epochMs, utcOffsetMinutes) where epochMs is the int milliseconds since the
+    epoch. If the timestamp has no UTC offset, it is UTC.
+    """
+    epochMs, micros, utcOffsetMinutes = parseIsoTimestampMicros(timestamp)
+    return (epochMs, utcOffsetMinutes)
+
+def parseIsoTimestampMicros(timestamp):
+    """
+    Like parseIsoTimestamp, but return (epochMs, micros, utcOffsetMinutes) where
+    micros is the int microseconds after the millisecond (0 to 999).
+    """
+    if timestamp.endswith('Z'):
+        # Change ISO time Z to make Python happy.
+        timestamp = timestamp[:-1] + '+00:00'
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo == None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    epochMs, micros = divmod((dt - epochUtc) // timedelta(microseconds=1), 1000)
+    return (epochMs, micros, dt.utcoffset() // timedelta(minutes=1))
+
+def getIsoTimestampFormat(timestamp):
+    """
+    Return (decimals, zuluUtc) of the ISO 8601 timestamp string for
+    makeIsoTimestamp: the number of digits of the fraction of the seconds, and
+    whether it ends in 'Z'.
+    """
+    match = re.search(r'T\d\d:\d\d:\d\d(?:[.,](\d+))?', timestamp)
+    decimals = len(match.group(1)) if match != None and match.group(1) != None else 0
+    return (min(decimals, 6), timestamp.endswith('Z'))
+
+def makeIsoTimestamp(epochMs, utcOffsetMinutes=0, decimals=3, zuluUtc=False, micros=0):
+    """
+    Return the ISO 8601 timestamp string for epochMs (plus micros microseconds),
+    using the UTC offset, like '2021-11-18T07:10:41.411+01:00' . decimals is the
+    number of digits of the fraction of the seconds (0 for none). If zuluUtc,
+    write the UTC offset 0 as 'Z', like '2021-11-18T06:10:41.411Z' .
+    """
+    tz = timezone(timedelta(minutes=utcOffsetMinutes))
+    dt = (epochUtc + timedelta(milliseconds=epochMs, microseconds=micros)).astimezone(tz)
+    text = dt.isoformat(timespec='seconds')
+    if decimals > 0:
+        text = text[:19] + '.' + '{:06d}'.format(dt.microsecond)[:decimals] + text[19:]
+    if zuluUtc and utcOffsetMinutes == 0:
+        text = text[:-6] + 'Z'
+    return text
+
+class WaypointArray():
+    """
+    The waypoints of a ride, stored by column. Each column is an array with one
+    value per waypoint:
+    latitude, longitude: float degrees
+    timestamp: int milliseconds since the epoch
+    timestampMicros: int microseconds after the millisecond of timestamp
+    speed, distance, speedLimit: float, NaN if not given
+    roadType: int index in roadTypeNames, -1 if not given
+    zone: int index in WaypointArray.ZoneNames, set by splitWaypoints
+    idx: int index of the waypoint in the ride, set by splitWaypoints
+    utcOffsetMinutes is the UTC offset of the first decoded timestamp, and
+    timestampDecimals and zuluUtc the format of the timestamps, used to make ISO
+    timestamp strings in the format sent by the app (see makeIsoTimestamp).
+    """
+    __slots__ = ('latitude', 'longitude', 'timestamp', 'timestampMicros', 'speed', 'distance',
+                 'speedLimit', 'roadType', 'zone', 'idx', 'roadTypeNames', 'roadTypeCodes',
+                 'utcOffsetMinutes', 'timestampDecimals', 'zuluUtc')
+    ZoneNames = ('main', 'start', 'end')
+    MainZone = 0
+    StartZone = 1
+    EndZone = 2
+
+    def __init__(self, roadTypeNames=None, utcOffsetMinutes=0, timestampDecimals=3, zuluUtc=False):
+        self.latitude = array('d')
+        self.longitude = array('d')
+        self.timestamp = array('q')
+        self.timestampMicros = array('h')
+        self.speed = array('d')
+        self.distance = array('d')
+        self.speedLimit = array('d')
+        self.roadType = array('h')
+        self.zone = array('b')
+        self.idx = array('q')
+        self.roadTypeNames = [] if roadTypeNames == None else roadTypeNames
+        self.roadTypeCodes = {name: code for code, name in enumerate(self.roadTypeNames)}
+        self.utcOffsetMinutes = utcOffsetMinutes
+        self.timestampDecimals = timestampDecimals
+        self.zuluUtc = zuluUtc
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def append(self, latitude, longitude, timestamp, speed=None, distance=None,
+               speedLimit=None, roadType=None, timestampMicros=0):
+        """
+        Append a waypoint where timestamp is int milliseconds since the epoch
+        and roadType is a str. The other optional values may be None.
+        """
+        self.latitude.append(latitude)
+        self.longitude.append(longitude)
+        self.timestamp.append(timestamp)
+        self.timestampMicros.append(timestampMicros)
+        self.speed.append(math.nan if speed == None else speed)
+        self.distance.append(math.nan if distance == None else distance)
+        self.speedLimit.append(math.nan if speedLimit == None else speedLimit)
+        if roadType == None:
+            self.roadType.append(-1)
+        else:
+            code = self.roadTypeCodes.get(roadType)
+            if code == None:
+                code = len(self.roadTypeNames)
+                self.roadTypeNames.append(roadType)
+                self.roadTypeCodes[roadType] = code
+            self.roadType.append(code)
+        self.zone.append(WaypointArray.MainZone)
+        self.idx.append(len(self.idx))
+
+    @classmethod
+    def fromDicts(cls, waypoints):
+        """
+        Make a WaypointArray from the list of waypoint dicts sent by the app,
+        each with 'latitude', 'longitude', 'timestamp' (ISO string), 'speed',
+        'distance', 'speed_limit' and 'road_type'. The timestamp format is that
+        of the first waypoint, with the most decimals of any waypoint.
+        """
+        result = cls()
+        for wp in waypoints:
+            epochMs, micros, utcOffsetMinutes = parseIsoTimestampMicros(wp['timestamp'])
+            decimals, zuluUtc = getIsoTimestampFormat(wp['timestamp'])
+            if len(result) == 0:
+                result.utcOffsetMinutes = utcOffsetMinutes
+                result.timestampDecimals = decimals
+                result.zuluUtc = zuluUtc
+            else:
+                result.timestampDecimals = max(result.timestampDecimals, decimals)
+            result.append(wp['latitude'], wp['longitude'], epochMs, wp.get('speed'),
+                          wp.get('distance'), wp.get('speed_limit'), wp.get('road_type'), micros)
+        return result
+
+    @classmethod
+    def fromPolyline(cls, encoded, timestampDeltas, speedDeltas=None, utcOffsetMinutes=0):
+        """
+        Make a WaypointArray from the compact trajectory sent by the app:
+        encoded is the Google encoded polyline of the waypoints.
+        timestampDeltas is the int list of the first timestamp in milliseconds
+        since the epoch followed by the difference from the previous timestamp.
+        speedDeltas (optional) is the int list of the first speed in tenths
+        followed by the difference from the previous speed in tenths.
+        utcOffsetMinutes is the UTC offset for making ISO timestamp strings.
+        Raise ValueError if the column lengths don't match.
+        """
+        latitudes, longitudes = decodePolyline(encoded)
+        if len(timestampDeltas) != len(latitudes):
+            raise ValueError('Got {} timestamps for {} polyline points'.format(
+              len(timestampDeltas), len(latitudes)))
+        if speedDeltas != None and len(speedDeltas) != len(latitudes):
+            raise ValueError('Got {} speeds for {} polyline points'.format(
+              len(speedDeltas), len(latitudes)))
+
+        result = cls(utcOffsetMinutes=utcOffsetMinutes)
+        result.latitude = latitudes
+        result.longitude = longitudes
+        result.timestamp = array('q', itertools.accumulate(timestampDeltas))
+        result.timestampMicros = array('h', itertools.repeat(0, len(latitudes)))
+        if speedDeltas != None:
+            result.speed = array('d', (speed / 10.0 for speed in itertools.accumulate(speedDeltas)))
+        else:
+            result.speed = array('d', itertools.repeat(math.nan, len(latitudes)))
+        result.distance = array('d', itertools.repeat(math.nan, len(latitudes)))
+        result.speedLimit = array('d', itertools.repeat(math.nan, len(latitudes)))
+        result.roadType = array('h', itertools.repeat(-1, len(latitudes)))
+        result.zone = array('b', itertools.repeat(WaypointArray.MainZone, len(latitudes)))
+        result.idx = array('q', range(len(latitudes)))
+        return result
+
+    def take(self, indexes):
+        """
+        Return a new WaypointArray with the waypoints at the given indexes (in
+        the given order), including their zone and idx.
+        """
+        result = WaypointArray(list(self.roadTypeNames), self.utcOffsetMinutes,
+                               self.timestampDecimals, self.zuluUtc)
+        for name in ('latitude', 'longitude', 'timestamp', 'timestampMicros', 'speed', 'distance',
+                     'speedLimit', 'roadType', 'zone', 'idx'):
+            column = getattr(self, name)
+            setattr(result, name, array(column.typecode, (column[i] for i in indexes)))
+        return result
+
+    def isoTimestamp(self, i):
+        return makeIsoTimestamp(self.timestamp[i], self.utcOffsetMinutes, self.timestampDecimals,
+                                self.zuluUtc, self.timestampMicros[i])
+
+    def pointJson(self, i, timestamp=None):
+        """
+        Return the JSON string of the GeoJSON position with the timestamp, like
+        '[-118.4, 34.1, 0, "2021-11-18T07:10:41.411-08:00"]', which is cached
+        in the WaypointsRaw "pointJson". If timestamp is None, use isoTimestamp(i).
+        """
+        if timestamp == None:
+            timestamp = self.isoTimestamp(i)
+        return '[' + str(self.longitude[i]) + ', ' + str(self.latitude[i]) + ', 0, "' + timestamp + '"]'
+
+    def roadTypeName(self, i):
+        code = self.roadType[i]
+        return None if code < 0 else self.roadTypeNames[code]
+
+    def zoneName(self, i):
+        return WaypointArray.ZoneNames[self.zone[i]]
+
+def encodePolyline(latitudes, longitudes, precision=5):
+    """
+    Encode the sequences of float degrees latitudes, longitudes as a Google
+    encoded polyline string, see
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    The app uses the default precision of 5 decimal places.
+    """
+    factor = 10 ** precision
+    chunks = []
+    previousLat = 0
+    previousLon = 0
+    for latitude, longitude in zip(latitudes, longitudes):
+        lat = round(latitude * factor)
+        lon = round(longitude * factor)
+        for delta in (lat - previousLat, lon - previousLon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previousLat = lat
+        previousLon = lon
+    return ''.join(chunks)
+
+def decodePolyline(encoded, precision=5):
+    """
+    Decode the Google encoded polyline string and return (latitudes, longitudes)
+    where each is an array of float degrees. Raise ValueError if the string is
+    malformed.
+    """
+    factor = 10 ** precision
+    latitudes = array('d')
+    longitudes = array('d')
+    lat = 0
+    lon = 0
+    value = 0
+    shift = 0
+    isLat = True
+    for c in encoded.encode('ascii'):
+        chunk = c - 63
+        if chunk < 0 or chunk > 0x3f:
+            raise ValueError('Malformed encoded polyline: bad character {}'.format(chr(c)))
+        value |= (chunk & 0x1f) << shift
+        if chunk & 0x20:
+            shift += 5
+            continue
+
+        delta = ~(value >> 1) if value & 1 else value >> 1
+        value = 0
+        shift = 0
+        if isLat:
+            lat += delta
+            latitudes.append(lat / factor)
+        else:
+            lon += delta
+            longitudes.append(lon / factor)
+        isLat = not isLat
+
+    if shift != 0 or not isLat:
+        raise ValueError('Malformed encoded polyline: truncated')
+    return (latitudes, longitudes)
+
+# Packed binary format of a WaypointArray, see packWaypoints.
+WaypointsPackMagic = b'CBW'
+WaypointsPackVersion = 3
+# The decimal places kept of the latitude and longitude degrees (about 0.1 m),
+# and of the speed, distance and speedLimit. Version 1 had no decimals in the
+# header and kept 6 and 2.
+WaypointsPackCoordinateDecimals = 6
+WaypointsPackMeasureDecimals = 6
+
+def packWaypoints(waypoints):
+    """
+    Pack the WaypointArray into bytes which unpackWaypoints can read. This is
+    much smaller than the JSON of the waypoints. Version 3 of the format is:
+    - WaypointsPackMagic and the WaypointsPackVersion byte
+    - the decimal places of the coordinates and of the measures (see
+      WaypointsPackCoordinateDecimals and WaypointsPackMeasureDecimals)
+    - the number of waypoints and the UTC offset in minutes
+    - the timestampDecimals and 1 if zuluUtc, otherwise 0
+    - the road type names: the count, then the length and UTF-8 of each name
+    - latitude and longitude columns: deltas of the degrees scaled by 10 to the
+      coordinate decimals
+    - timestamp column: deltas of the milliseconds since the epoch
+    - timestampMicros column, only if timestampDecimals is more than 3
+    - speed, distance and speedLimit columns: deltas of the values scaled by
+      10 to the measure decimals, plus 1 so that 0 is a missing (NaN) value
+    - roadType column: the code plus 1 so that 0 is no road type
+    Each number is a (zigzag for signed) varint. The zone and idx are not
+    packed since splitWaypoints sets them.
+    """
+    out = bytearray(WaypointsPackMagic)
+    out.append(WaypointsPackVersion)
+    writeVarint(out, WaypointsPackCoordinateDecimals)
+    writeVarint(out, WaypointsPackMeasureDecimals)
+    writeVarint(out, len(waypoints))
+    writeVarint(out, zigzag(waypoints.utcOffsetMinutes))
+    writeVarint(out, waypoints.timestampDecimals)
+    writeVarint(out, 1 if waypoints.zuluUtc else 0)
+    writeVarint(out, len(waypoints.roadTypeNames))
+    for name in waypoints.roadTypeNames:
+        nameBytes = name.encode('utf-8')
+        writeVarint(out, len(nameBytes))
+        out += nameBytes
+
+    coordinateScale = 10 ** WaypointsPackCoordinateDecimals
+    measureScale = 10 ** WaypointsPackMeasureDecimals
+    for column, scale in ((waypoints.latitude, coordinateScale), (waypoints.longitude, coordinateScale),
+                          (waypoints.timestamp, 1)):
+        previous = 0
+        for value in column:
+            value = round(value * scale)
+            writeVarint(out, zigzag(value - previous))
+            previous = value
+    if waypoints.timestampDecimals > 3:
+        for micros in waypoints.timestampMicros:
+            writeVarint(out, micros)
+    for column in (waypoints.speed, waypoints.distance, waypoints.speedLimit):
+        previous = 0
+        for value in column:
+            if value != value:
+                writeVarint(out, 0)
+            else:
+                value = round(value * measureScale)
+                writeVarint(out, zigzag(value - previous) + 1)
+                previous = value
+    for code in waypoints.roadType:
+        writeVarint(out, code + 1)
+    return bytes(out)
+
+def unpackWaypoints(data):
+    """
+    Return the WaypointArray from the bytes made by packWaypoints (version 1,
+    2 or 3). Raise ValueError if the bytes are not a supported version of the
+    format.
+    """
+    if data[:len(WaypointsPackMagic)] != WaypointsPackMagic:
+        raise ValueError('Packed waypoints have a bad header')
+    pos = len(WaypointsPackMagic)
+    version = data[pos]
+    pos += 1
+    if version == 1:
+        coordinateDecimals = 6
+        measureDecimals = 2
+    elif version in [2, 3]:
+        coordinateDecimals, pos = readVarint(data, pos)
+        measureDecimals, pos = readVarint(data, pos)
+    else:
+        raise ValueError('Unsupported packed waypoints version {}'.format(version))
+    coordinateScale = 10 ** coordinateDecimals
+    measureScale = 10 ** measureDecimals
+
+    count, pos = readVarint(data, pos)
+    utcOffsetMinutes, pos = readVarint(data, pos)
+    # Versions 1 and 2 had the timestamps in milliseconds with 'Z' never used.
+    timestampDecimals = 3
+    zuluUtc = 0
+    if version == 3:
+        timestampDecimals, pos = readVarint(data, pos)
+        zuluUtc, pos = readVarint(data, pos)
+    nNames, pos = readVarint(data, pos)
+    roadTypeNames = []
+    for i in range(nNames):
+        length, pos = readVarint(data, pos)
+        roadTypeNames.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+
+    result = WaypointArray(roadTypeNames, unzigzag(utcOffsetMinutes), timestampDecimals, zuluUtc == 1)
+    for name, scale in (('latitude', coordinateScale), ('longitude', coordinateScale), ('timestamp', 1)):
+        column = getattr(result, name)
+        value = 0
+        for i in range(count):
+            delta, pos = readVarint(data, pos)
+            value += unzigzag(delta)
+            column.append(value / scale if scale != 1 else value)
+    if timestampDecimals > 3:
+        for i in range(count):
+            micros, pos = readVarint(data, pos)
+            result.timestampMicros.append(micros)
+    else:
+        result.timestampMicros = array('h', itertools.repeat(0, count))
+    for column in (result.speed, result.distance, result.speedLimit):
+        value = 0
+        for i in range(count):
+            delta, pos = readVarint(data, pos)
+            if delta == 0:
+                column.append(math.nan)
+            else:
+                value += unzigzag(delta - 1)
+                column.append(value / measureScale)
+    for i in range(count):
+        code, pos = readVarint(data, pos)
+        result.roadType.append(code - 1)
+    if pos != len(data):
+        raise ValueError('Packed waypoints have {} extra bytes'.format(len(data) - pos))
+
+    result.zone = array('b', itertools.repeat(WaypointArray.MainZone, count))
+    result.idx = array('q', range(count))
+    return result
+
+def zigzag(value):
+    """
+    Map a signed int to an unsigned int so that small magnitudes stay small:
+    0, -1, 1, -2, ... map to 0, 1, 2, 3, ...
+    """
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+def writeVarint(out, value):
+    """
+    Append the unsigned int value to the bytearray out, 7 bits per byte with
+    the high bit set on all but the last byte.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def readVarint(data, pos):
+    """
+    Read the unsigned varint in data starting at pos. Return (value, newPos).
+    """
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (value, pos)
+        shift += 7
+
 ################################################################################
 # GEO MATH HELPERS
 ################################################################################
 
 def splitWaypoints(radius, waypoints):
     """
-    Split waypoints into three groups:
+    Split the WaypointArray waypoints into three groups:
     1) 'start' zone: waypoints that fall within given radius of the first waypoint
     2) 'end' zone:  waypoints that fall within given radius of the last waypoint
     3) 'main' zone: all other waypoints.
-    Each waypoint has float 'latitude' and 'longitude'. This adds 'originalIdx'
-    and 'zone'. Return return (startZone, endZone, mainZone) .
+    This sets the 'idx' and 'zone' columns of waypoints. Return
+    (startZone, endZone, mainZone) where each is a WaypointArray.
     """
     if len(waypoints):
-        startWp = waypoints[0]
-        endWp = waypoints[-1]
-        startZone = [startWp]
-        endZone = []
-        mainZone = []
-        wpIdx = 0
-        for wp in waypoints:
-            wp['originalIdx'] = wpIdx
-            dStart = getGreatCircleDistance(startWp['latitude'], startWp['longitude'],
-                        wp['latitude'], wp['longitude'])
-            dEnd = getGreatCircleDistance(endWp['latitude'], endWp['longitude'],
-                        wp['latitude'], wp['longitude'])
-            if dStart <= radius or dEnd <= radius:
-                if dStart <= radius:
-                    wp['zone'] = 'start'
-                    startZone.append(wp)
-                if dEnd <= radius:
-                    wp['zone'] = 'end'
-                    endZone.append(wp)
+        startIdx = [0]
+        endIdx = []
+        mainIdx = []
+        inStarts = getWithinRadius(waypoints.latitude[0], waypoints.longitude[0], radius,
+                                   waypoints.latitude, waypoints.longitude)
+        inEnds = getWithinRadius(waypoints.latitude[-1], waypoints.longitude[-1], radius,
+                                 waypoints.latitude, waypoints.longitude)
+        waypoints.idx = array('q', range(len(waypoints)))
+        for wpIdx in range(len(waypoints)):
+            inStart = inStarts[wpIdx]
+            inEnd = inEnds[wpIdx]
+            if inStart or inEnd:
+                if inStart:
+                    waypoints.zone[wpIdx] = WaypointArray.StartZone
+                    startIdx.append(wpIdx)
+                if inEnd:
+                    waypoints.zone[wpIdx] = WaypointArray.EndZone
+                    endIdx.append(wpIdx)
             else:
-                wp['zone'] = 'main'
-                mainZone.append(wp)
-            wpIdx += 1
-        endZone.append(endWp)
+                waypoints.zone[wpIdx] = WaypointArray.MainZone
+                mainIdx.append(wpIdx)
+        endIdx.append(len(waypoints) - 1)
         print('split waypoints: start {}, end {}, main {}'
-                .format(len(startZone), len(endZone), len(mainZone)))
-        return (startZone, endZone, mainZone)
-    return ([],[],[])
+                .format(len(startIdx), len(endIdx), len(mainIdx)))
+        return (waypoints.take(startIdx), waypoints.take(endIdx), waypoints.take(mainIdx))
+    return (WaypointArray(), WaypointArray(), WaypointArray())
 
 def obfuscateWaypoints(waypoints, id, obfuscateSalt):
     """
-    Each waypoint has float 'latitude' and 'longitude'.
+    waypoints is a WaypointArray.
     Use strings id and obfuscateSalt to derive an offset for the center which is
     always the same for the id (and obfuscateSalt).
     Return (centerLat, centerLon, minRadius) .
     """
-    centerLat = 0
-    centerLon = 0
     # find "center of mass" of all waypoints
     # TODO: what if center is too close to the waypoint we want to obfuscate
     # (i.e. len(waypoints) == 1)
-    for wp in waypoints:
-        centerLat += wp['latitude']
-        centerLon += wp['longitude']
-    centerLat /= float(len(waypoints))
-    centerLon /= float(len(waypoints))
+    centerLat = sum(waypoints.latitude, 0) / float(len(waypoints))
+    centerLon = sum(waypoints.longitude, 0) / float(len(waypoints))
     # find min radius to cover all waypoints
-    minRadius = 0
-    for wp in waypoints:
-        d = getGreatCircleDistance(wp['latitude'], wp['longitude'], centerLat, centerLon)
-        if minRadius < d:
-            minRadius = d
+    minRadius = max(getGreatCircleDistances(centerLat, centerLon,
+                                            waypoints.latitude, waypoints.longitude),
+                    default=0)
 
     # Compute an offset for center lat and lon in the range -50 to 50 (meters).
     sha256 = hashlib.sha256()
@@ -198,6 +1565,37 @@ def obfuscateWaypoints(waypoints, id, obfuscateSalt):
 
     return (centerLat + offsetLat, centerLon + offsetLon, minRadius)
 
+# https://en.wikipedia.org/wiki/Geohash
+GeohashBase32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def encodeGeohash(lat, lon, precision):
+    """
+    Return the geohash of lat, lon with precision characters. The cell of 7
+    characters is about 150 by 150 meters.
+    """
+    latRange = [-90.0, 90.0]
+    lonRange = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bitCount = 0
+    isLon = True
+    while len(geohash) < precision:
+        (value, valueRange) = (lon, lonRange) if isLon else (lat, latRange)
+        mid = (valueRange[0] + valueRange[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            valueRange[0] = mid
+        else:
+            bits = bits * 2
+            valueRange[1] = mid
+        isLon = not isLon
+        bitCount += 1
+        if bitCount == 5:
+            geohash.append(GeohashBase32[bits])
+            bits = 0
+            bitCount = 0
+    return ''.join(geohash)
+
 # https://en.wikipedia.org/wiki/Haversine_formula
 def getGreatCircleDistance(lat1, lon1, lat2, lon2):
     if lat1 == lat2 and lon1 == lon2:
@@ -212,3 +1610,210 @@ def getGreatCircleDistance(lat1, lon1, lat2, lon2):
     # dA = math.acos(math.sin(lat1)*math.sin(lat2) + math.cos(lat1)*math.cos(lat2)*math.cos(dLon))
     dA = math.acos(max(-1.0,min(1.0,math.sin(lat1)*math.sin(lat2) + math.cos(lat1)*math.cos(lat2)*math.cos(dLon))))
     return dA * R * 1000 # convert to meters
+
+
+def getGreatCircleDistances(lat, lon, lats, lons):
+    """
+    Return a list of the great circle distances in meters from lat, lon to each
+    point of the sequences lats, lons. Each distance is the same as from
+    getGreatCircleDistance (within floating point rounding if NumPy is used).
+    """
+    if numpy is None:
+        return [getGreatCircleDistance(lat, lon, lat2, lon2) for lat2, lon2 in zip(lats, lons)]
+    return _greatCircleDistanceArrays(lat, lon, numpy.asarray(lats, dtype=float),
+                                      numpy.asarray(lons, dtype=float)).tolist()
+
+def getConsecutiveDistances(lats, lons):
+    """
+    Return a list of the great circle distances in meters between each pair of
+    consecutive points of the sequences lats, lons. If there are N points, the
+    list has N - 1 distances.
+    """
+    if numpy is None:
+        return [getGreatCircleDistance(lats[i - 1], lons[i - 1], lats[i], lons[i])
+                for i in range(1, len(lats))]
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    return _greatCircleDistanceArrays(lats[:-1], lons[:-1], lats[1:], lons[1:]).tolist()
+
+def getCumulativeDistances(lats, lons):
+    """
+    Return a list of the distance in meters travelled along the points of the
+    sequences lats, lons up to each point. The first value is 0.0 and the last
+    value is the total distance. If there are no points, return [].
+    """
+    if len(lats) == 0:
+        return []
+    if numpy is None:
+        return list(itertools.accumulate(getConsecutiveDistances(lats, lons), initial=0.0))
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    distances = _greatCircleDistanceArrays(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    return numpy.concatenate(([0.0], numpy.cumsum(distances))).tolist()
+
+def getWithinRadius(lat, lon, radius, lats, lons):
+    """
+    Return a list of booleans, one for each point of the sequences lats, lons,
+    which is True if getGreatCircleDistance from lat, lon to the point is <= radius
+    (meters). To avoid the acos for most points, this uses a cascade:
+    1) Points outside a latitude/longitude bounding box of the radius are out.
+    2) Points where the equirectangular approximation is far enough from the
+       radius (see below) are decided by the approximation.
+    3) The remaining points near the radius use getGreatCircleDistance.
+    For angles a (latitude difference) and b (longitude difference) in radians,
+    the squared angular distance t2 on the sphere and the approximation
+    a^2 + cos(lat)^2 b^2 differ by at most (a^2 + b^2)^2 / 3 + b^2 |a| / 2 . (This
+    follows from x^2 - x^4 / 12 <= 4 hav(x) <= x^2 applied to the haversine
+    formula, and the change of cos^2 between lat and the mid latitude.)
+    """
+    R = 6378.137 * 1000.0 # earth radius in meters
+    maxA2 = (radius / R) ** 2
+    # A wide bound on the floating point error of the squared angle computed by
+    # the acos in getGreatCircleDistance.
+    tolerance = 4e-14
+    latLimit = math.sqrt(maxA2 + tolerance)
+    cosLat = math.cos(math.radians(lat))
+    cos2Lat = cosLat * cosLat
+    if math.sin(latLimit) < cosLat:
+        # The widest longitude difference of the circle, plus slack for rounding.
+        lonLimit = math.asin(math.sin(latLimit) / cosLat) * (1.0 + 1e-9)
+    else:
+        # The circle includes a pole.
+        lonLimit = math.pi
+
+    if numpy is not None:
+        lats = numpy.asarray(lats, dtype=float)
+        lons = numpy.asarray(lons, dtype=float)
+        a = numpy.radians(lats - lat)
+        b = numpy.abs(lons - lon) % 360.0
+        b = numpy.radians(numpy.minimum(b, 360.0 - b))
+        a2 = a * a
+        b2 = b * b
+        approxA2 = a2 + cos2Lat * b2
+        errorBound = (a2 + b2) ** 2 / 3.0 + b2 * numpy.abs(a) / 2.0 + tolerance
+        inBox = (numpy.abs(a) <= latLimit) & (b <= lonLimit)
+        isWithin = inBox & (approxA2 + errorBound < maxA2)
+        isNearRadius = inBox & ~isWithin & (approxA2 - errorBound <= maxA2)
+        within = isWithin.tolist()
+        for i in numpy.flatnonzero(isNearRadius):
+            within[i] = getGreatCircleDistance(lat, lon, float(lats[i]), float(lons[i])) <= radius
+        return within
+
+    within = []
+    for lat2, lon2 in zip(lats, lons):
+        a = math.radians(lat2 - lat)
+        b = abs(lon2 - lon) % 360.0
+        b = math.radians(min(b, 360.0 - b))
+        if abs(a) > latLimit or b > lonLimit:
+            within.append(False)
+            continue
+
+        a2 = a * a
+        b2 = b * b
+        approxA2 = a2 + cos2Lat * b2
+        errorBound = (a2 + b2) ** 2 / 3.0 + b2 * abs(a) / 2.0 + tolerance
+        if approxA2 + errorBound < maxA2:
+            within.append(True)
+        elif approxA2 - errorBound > maxA2:
+            within.append(False)
+        else:
+            within.append(getGreatCircleDistance(lat, lon, lat2, lon2) <= radius)
+    return within
+
+def simplifyLine(latitudes, longitudes, tolerance):
+    """
+    Simplify the line of the sequences latitudes, longitudes with the
+    Douglas-Peucker algorithm. Return the sorted list of the indexes of the
+    points to keep, so that no removed point is more than tolerance meters from
+    the simplified line. The first and last points are always kept.
+    """
+    n = len(latitudes)
+    if n <= 2 or tolerance <= 0:
+        return list(range(n))
+
+    # Project to meters on a plane, which is accurate enough at the scale of a ride.
+    R = 6378.137 * 1000.0 # earth radius in meters
+    lat0 = latitudes[0]
+    lon0 = longitudes[0]
+    xScale = math.radians(1.0) * R * math.cos(math.radians(lat0))
+    yScale = math.radians(1.0) * R
+    if numpy is not None:
+        xs = (numpy.asarray(longitudes, dtype=float) - lon0) * xScale
+        ys = (numpy.asarray(latitudes, dtype=float) - lat0) * yScale
+    else:
+        xs = [(lon - lon0) * xScale for lon in longitudes]
+        ys = [(lat - lat0) * yScale for lat in latitudes]
+
+    tolerance2 = tolerance * tolerance
+    keep = [False] * n
+    keep[0] = True
+    keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        maxIdx, maxD2 = getFarthestFromSegment(xs, ys, first, last)
+        if maxD2 > tolerance2:
+            keep[maxIdx] = True
+            stack.append((first, maxIdx))
+            stack.append((maxIdx, last))
+
+    return [i for i in range(n) if keep[i]]
+
+def getFarthestFromSegment(xs, ys, first, last):
+    """
+    Find the point strictly between first and last which is farthest from the
+    segment from point first to point last. Return (index, squaredDistance).
+    """
+    x1 = xs[first]
+    y1 = ys[first]
+    dx = xs[last] - x1
+    dy = ys[last] - y1
+    length2 = dx * dx + dy * dy
+    if numpy is not None and not isinstance(xs, list):
+        px = xs[first + 1:last] - x1
+        py = ys[first + 1:last] - y1
+        if length2 > 0:
+            t = numpy.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+            px = px - t * dx
+            py = py - t * dy
+        d2 = px * px + py * py
+        i = int(numpy.argmax(d2))
+        return (first + 1 + i, float(d2[i]))
+
+    maxIdx = first + 1
+    maxD2 = -1.0
+    for i in range(first + 1, last):
+        px = xs[i] - x1
+        py = ys[i] - y1
+        if length2 > 0:
+            t = min(1.0, max(0.0, (px * dx + py * dy) / length2))
+            px -= t * dx
+            py -= t * dy
+        d2 = px * px + py * py
+        if d2 > maxD2:
+            maxIdx = i
+            maxD2 = d2
+    return (maxIdx, maxD2)
+
+def getZoomTolerance(zoom, latitude):
+    """
+    Return the size in meters of a pixel of a 256-pixel web map tile at the zoom
+    level and latitude, to use as a simplifyLine tolerance.
+    """
+    return 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+def _greatCircleDistanceArrays(lat1, lon1, lat2, lon2):
+    """
+    NumPy version of getGreatCircleDistance where the arguments are arrays (or
+    scalars) which broadcast together. Return an array of distances in meters.
+    """
+    R = 6378.137 # earth radius in km
+    rLat1 = numpy.radians(lat1)
+    rLat2 = numpy.radians(lat2)
+    dLon = numpy.abs(numpy.radians(lon1) - numpy.radians(lon2))
+    dA = numpy.arccos(numpy.clip(numpy.sin(rLat1)*numpy.sin(rLat2) +
+                                 numpy.cos(rLat1)*numpy.cos(rLat2)*numpy.cos(dLon), -1.0, 1.0))
+    return numpy.where((lat1 == lat2) & (lon1 == lon2), 0.0, dA * R * 1000) # convert to meters
@@ -0,0 +1,425 @@
+# This lambda applies the versioned Postgres schema migrations and checks that
+# the hot queries can use the indexes. The event is
+# { "action": "migrate" | "check" | "plan-time" | "rebuild-rollup",
+#   "stage": "prod" | "dev" }
+# where "stage" is optional (default "prod"). For the dev stage, the table names
+# have the suffix "_dev" (see CibicResources.Postgres).
+# "migrate" applies the migrations which are not in the SchemaMigrations table
+# yet, each in one transaction. "check" runs EXPLAIN EXECUTE for each of
+# HotStatements and EXPLAIN for each of HotQueries with sequential scans
+# disabled, and reports whether the plan uses the expected indexes.
+# "plan-time" compares the planning and execution times of PlanTimeStatements
+# sent as plain queries (as before they were prepared) and with EXECUTE of the
+# prepared statement, using EXPLAIN (ANALYZE, SUMMARY).
+# "rebuild-rollup" recomputes RideDailyRollup and UserLastFlow from Rides (see
+# addRideToRollup), for example for rides inserted before the ingest lambdas
+# which update them were deployed.
+# To run locally against a PostGIS database (with the ENV_VAR_POSTGRES_*
+# environment variables), use: python lambda_function.py migrate|check|plan-time|rebuild-rollup [dev]
+
+from common.cibic_common import *
+import os
+import importlib.util
+from datetime import datetime, timezone
+
+pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
+pgUsername = os.environ['ENV_VAR_POSTGRES_USER']
+pgPassword = os.environ['ENV_VAR_POSTGRES_PASSWORD']
+pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
+
+# The table of applied migrations, with the stage suffix like the other tables.
+SchemaMigrations = 'cibic21_schema_migrations'
+
+# The statements which recompute RideDailyRollup and UserLastFlow from Rides, as
+# addRideToRollup would for each ride. The SHARE lock holds off ride inserts.
+RollupRebuild = [
+    'LOCK TABLE {Rides} IN SHARE MODE',
+    'DELETE FROM {RideDailyRollup}',
+    """INSERT INTO {RideDailyRollup} (day, "userId", role, flow, region, organization, rides)
+       SELECT ("startTime" AT TIME ZONE 'UTC')::date, "userId", COALESCE(role, ''), flow,
+              COALESCE(region, ''), COALESCE(organization, ''), COUNT(*)
+         FROM {Rides}
+         WHERE flow IS NOT NULL AND "startTime" IS NOT NULL AND "userId" IS NOT NULL
+         GROUP BY 1, 2, 3, 4, 5, 6""",
+    'DELETE FROM {UserLastFlow}',
+    """INSERT INTO {UserLastFlow} ("userId", "startTime", flow, "flowName")
+       SELECT DISTINCT ON ("userId") "userId", "startTime", flow, "flowName"
+         FROM {Rides}
+         WHERE flow IS NOT NULL AND "startTime" IS NOT NULL AND "userId" IS NOT NULL
+         ORDER BY "userId", "startTime" DESC""",
+]
+
+# (version, description, statements). Never change an applied migration, add a
+# new one. In the statements, {Rides} etc. are the CibicResources.Postgres table
+# names with the stage suffix and {suffix} is the suffix, for index names.
+Migrations = [
+    (1, 'Indexes for the hot queries', [
+        # Ride paging and time ranges (/ride/query, /ride/tiles). Also serves "startTime" alone.
+        'CREATE INDEX IF NOT EXISTS cibic21_rides_start_time_ride_id{suffix} ON {Rides} ("startTime", "rideId")',
+        'CREATE INDEX IF NOT EXISTS cibic21_rides_region_organization_start_time{suffix} ON {Rides} (region, organization, "startTime")',
+        # Per-user rides (user-ride-statistics-api, infer-pod).
+        'CREATE INDEX IF NOT EXISTS cibic21_rides_user_id_role_start_time{suffix} ON {Rides} ("userId", role, "startTime")',
+        # The rides still to infer the pod of (infer-pod).
+        'CREATE INDEX IF NOT EXISTS cibic21_rides_inferred_pod_null{suffix} ON {Rides} ("rideId") WHERE "inferredPod" IS NULL',
+        # The waypoints of a ride by zone in order (ride lines, ride-geometry-backfill).
+        'CREATE INDEX IF NOT EXISTS cibic21_waypoints_raw_ride_id_zone_idx{suffix} ON {WaypointsRaw} ("rideId", zone, idx)',
+        'CREATE INDEX IF NOT EXISTS cibic21_waypoints_raw_coordinate{suffix} ON {WaypointsRaw} USING GIST (coordinate)',
+        # The flow waypoints of a ride in order (ride-geometry-backfill).
+        'CREATE INDEX IF NOT EXISTS cibic21_ride_flow_waypoints_ride_id_idx{suffix} ON {RideFlowWaypoints} ("rideId", idx)',
+        'CREATE INDEX IF NOT EXISTS cibic21_waypoints_snapped_ride_id{suffix} ON {WaypointsSnapped} ("rideId")',
+    ]),
+    (2, 'RideGeometry table (see insertRideGeometry)', [
+        """CREATE TABLE IF NOT EXISTS {RideGeometry} (
+             "rideId" text PRIMARY KEY,
+             "rideLineJson" json,
+             "rideLine5mJson" json,
+             "rideLine20mJson" json,
+             "rideLine100mJson" json,
+             "rideLine" geometry(LineString, 4326))""",
+        'CREATE INDEX IF NOT EXISTS cibic21_ride_geometry_ride_line{suffix} ON {RideGeometry} USING GIST ("rideLine")',
+    ]),
+    (3, 'RideGeometry flow line, point count and bounding box (run ride-geometry-backfill after)', [
+        """ALTER TABLE {RideGeometry}
+             ADD COLUMN IF NOT EXISTS "flowLine" geometry(LineString, 4326),
+             ADD COLUMN IF NOT EXISTS "pointCount" integer,
+             ADD COLUMN IF NOT EXISTS "bbox" geometry(Polygon, 4326)""",
+        'CREATE INDEX IF NOT EXISTS cibic21_ride_geometry_flow_line{suffix} ON {RideGeometry} USING GIST ("flowLine")',
+    ]),
+    (4, 'RideDailyRollup and UserLastFlow tables (see addRideToRollup)', [
+        """CREATE TABLE IF NOT EXISTS {RideDailyRollup} (
+             day date NOT NULL,
+             "userId" text NOT NULL,
+             role text NOT NULL,
+             flow text NOT NULL,
+             region text NOT NULL,
+             organization text NOT NULL,
+             rides integer NOT NULL,
+             PRIMARY KEY (day, "userId", role, flow, region, organization))""",
+        """CREATE TABLE IF NOT EXISTS {UserLastFlow} (
+             "userId" text PRIMARY KEY,
+             "startTime" timestamptz NOT NULL,
+             flow text NOT NULL,
+             "flowName" text)""",
+    ] + RollupRebuild),
+    (5, '"updatedTime" of Rides, RideGeometry and UserEnrollments for the ETags', [
+        """CREATE OR REPLACE FUNCTION cibic21_set_updated_time{suffix}() RETURNS trigger
+           LANGUAGE plpgsql AS $$
+           BEGIN
+             NEW."updatedTime" = clock_timestamp();
+             RETURN NEW;
+           END $$""",
+    ] + [statement.replace('{table}', '{' + table + '}').replace('{name}', name)
+         for table, name in [('Rides', 'rides'), ('RideGeometry', 'ride_geometry'),
+                             ('UserEnrollments', 'user_enrollments')]
+         for statement in [
+             # The now() default is stored once for the existing rows without
+             # rewriting the table. New rows get the time of the insert.
+             'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "updatedTime" timestamptz NOT NULL DEFAULT now()',
+             'ALTER TABLE {table} ALTER COLUMN "updatedTime" SET DEFAULT clock_timestamp()',
+             'DROP TRIGGER IF EXISTS cibic21_{name}_updated_time{suffix} ON {table}',
+             """CREATE TRIGGER cibic21_{name}_updated_time{suffix} BEFORE UPDATE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE cibic21_set_updated_time{suffix}()""",
+         ]]),
+    (6, 'WeatherLocations and WeatherConditions tables (see fetchWeatherJson)', [
+        """CREATE TABLE IF NOT EXISTS {WeatherLocations} (
+             cell text PRIMARY KEY,
+             "locationKey" text NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS {WeatherConditions} (
+             "locationKey" text NOT NULL,
+             period timestamptz NOT NULL,
+             "conditionsJson" text NOT NULL,
+             PRIMARY KEY ("locationKey", period))""",
+    ]),
+    (7, 'SnappedSegments table (see wp-snap)', [
+        """CREATE TABLE IF NOT EXISTS {SnappedSegments} (
+             "segmentKey" text PRIMARY KEY,
+             "snappedJson" text NOT NULL,
+             "createdTime" timestamptz NOT NULL DEFAULT now())""",
+    ]),
+    (8, 'SnappedSegments index for deleting the expired rows (see wp-snap)', [
+        'CREATE INDEX IF NOT EXISTS cibic21_snapped_segments_created_time{suffix} ON {SnappedSegments} ("createdTime")',
+    ]),
+    (9, 'UserEnrollments index for the latest "updatedTime" (/ride/query ETag)', [
+        'CREATE INDEX IF NOT EXISTS cibic21_user_enrollments_updated_time{suffix} ON {UserEnrollments} ("updatedTime")',
+    ]),
+]
+
+# The lambdas which declare hot prepared statements with declarePreparedStatement.
+# They are symlinked into this folder (like common) so that the check explains
+# the statements exactly as the APIs execute them.
+HotStatementLambdas = ['ride-geo-data-api-access', 'user-ride-statistics-api']
+
+# Representative parameters of the hot statements: a month of rides, its full
+# UTC days and a page cursor.
+CheckStartTime = datetime(2021, 11, 1, 7, tzinfo=timezone.utc)
+CheckEndTime = datetime(2021, 12, 1, 8, tzinfo=timezone.utc)
+CheckRideFilter = [CheckStartTime, CheckEndTime, None, None, False, None, None, 51]
+CheckRideFilterPage = [CheckStartTime, CheckEndTime, 'Los Angeles', 'CiBiC', True,
+                       datetime(2021, 11, 15, tzinfo=timezone.utc), 'ride', 51]
+CheckUserStatistics = [None, None, CheckStartTime, CheckEndTime,
+                       datetime(2021, 11, 2, tzinfo=timezone.utc), datetime(2021, 12, 1, tzinfo=timezone.utc)]
+
+# (statement name, parameters, expected indexes) for the index check. Each
+# statement is declared in common or one of HotStatementLambdas. The indexes
+# use the same table names as Migrations.
+HotStatements = [
+    ('query_rides_simple', CheckRideFilter, ['cibic21_rides_start_time_ride_id{suffix}']),
+    ('query_rides_simple', CheckRideFilterPage, ['cibic21_rides_start_time_ride_id{suffix}']),
+    ('query_rides_version', CheckRideFilter[:-1] + [None],
+     ['cibic21_rides_start_time_ride_id{suffix}', 'cibic21_user_enrollments_updated_time{suffix}']),
+    ('query_rides_version', CheckRideFilterPage,
+     ['cibic21_rides_start_time_ride_id{suffix}', 'cibic21_user_enrollments_updated_time{suffix}']),
+] + [
+    ('query_rides_rich_' + column.lower(), CheckRideFilterPage,
+     ['cibic21_rides_start_time_ride_id{suffix}', '{RideGeometry}_pkey'])
+    for level, column in RideLineLevels
+] + [
+    ('query_ride_tile', CheckRideFilter + [12, 701, 1635], ['cibic21_rides_start_time_ride_id{suffix}']),
+] + [
+    ('fetch_ride_' + column.lower(), ['ride'], ['{RideGeometry}_pkey'])
+    for level, column in RideLineLevels
+] + [
+    ('fetch_ride_version', ['ride'], ['{RideGeometry}_pkey']),
+    ('fetch_user_ride_statistics', CheckUserStatistics,
+     ['cibic21_rides_start_time_ride_id{suffix}', '{RideDailyRollup}_pkey']),
+]
+
+# (statement name, parameters) of the hot statements whose planning time the
+# "plan-time" action measures.
+PlanTimeStatements = [
+    ('fetch_ride_ridelinejson', ['ride']),
+    ('query_rides_simple', CheckRideFilterPage),
+    ('query_rides_rich_ridelinejson', CheckRideFilterPage),
+    ('fetch_user_ride_statistics', CheckUserStatistics),
+]
+
+# The number of EXECUTEs of each prepared statement for "plan-time". Postgres
+# plans the first five executions with the parameters (custom plans) before it
+# considers the generic plan, which is then planned only once.
+PlanTimeExecutions = 8
+
+# (name, sql, expected index) for the index check of the queries which are not
+# prepared statements. The sql uses the same table names as Migrations.
+HotQueries = [
+    ('main zone waypoints', """
+       SELECT "pointJson" FROM {WaypointsRaw}
+       WHERE "rideId" = 'ride' AND zone = 'main' ORDER BY idx""",
+     'cibic21_waypoints_raw_ride_id_zone_idx{suffix}'),
+    ('flow waypoints', """
+       SELECT coordinate FROM {RideFlowWaypoints}
+       WHERE "rideId" = 'ride' ORDER BY idx""",
+     'cibic21_ride_flow_waypoints_ride_id_idx{suffix}'),
+    ('tile ride lines', """
+       SELECT "rideId" FROM {RideGeometry}
+       WHERE "rideLine" && ST_Transform(ST_TileEnvelope(12, 701, 1635), 4326)""",
+     'cibic21_ride_geometry_ride_line{suffix}'),
+    ('tile flow lines', """
+       SELECT "rideId" FROM {RideGeometry}
+       WHERE "flowLine" && ST_Transform(ST_TileEnvelope(12, 701, 1635), 4326)""",
+     'cibic21_ride_geometry_flow_line{suffix}'),
+]
+
+def lambda_handler(event, context):
+    try:
+        stage = event.get('stage', 'prod')
+        if stage not in ['prod', 'dev']:
+            return lambdaReply(420, 'bad stage ' + str(stage))
+        suffix = '_dev' if stage == 'dev' else ''
+
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+        if event.get('action') == 'migrate':
+            applied = applyMigrations(conn, suffix)
+            return lambdaReply(200, {'applied': applied})
+        elif event.get('action') == 'rebuild-rollup':
+            rebuildRollup(conn, suffix)
+            return processedReply()
+        elif event.get('action') == 'check':
+            results = checkIndexUsage(conn, suffix)
+            return lambdaReply(200 if all(result['usesIndex'] for result in results) else 420, results)
+        elif event.get('action') == 'plan-time':
+            return lambdaReply(200, measurePlanningTime(conn, suffix))
+        else:
+            return malformedMessageReply()
+    except:
+        err = reportError()
+        print('caught exception:', sys.exc_info()[0])
+        return lambdaReply(420, str(err))
+
+def getTableNames(suffix):
+    """
+    Return the dict of the CibicResources.Postgres table names (plus
+    SchemaMigrations) with the suffix, and 'suffix', for formatting Migrations
+    and HotQueries.
+    """
+    names = {name: value + suffix for name, value in vars(CibicResources.Postgres).items()
+             if not name.startswith('_')}
+    names['SchemaMigrations'] = SchemaMigrations + suffix
+    names['suffix'] = suffix
+    return names
+
+def applyMigrations(conn, suffix):
+    """
+    Apply the Migrations which are not in the SchemaMigrations table, in order of
+    version. Each migration and its SchemaMigrations row are one transaction
+    which holds an advisory lock, so concurrent runs apply each only once.
+    Return the list of applied versions.
+    """
+    names = getTableNames(suffix)
+    cur = conn.cursor()
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS {SchemaMigrations} (
+        version integer PRIMARY KEY,
+        description text NOT NULL,
+        "appliedTime" timestamptz NOT NULL DEFAULT now())
+      """.format(**names))
+    conn.commit()
+
+    applied = []
+    for version, description, statements in sorted(Migrations):
+        cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (names['SchemaMigrations'],))
+        cur.execute('SELECT 1 FROM {SchemaMigrations} WHERE version = %s'.format(**names), (version,))
+        if cur.fetchone() != None:
+            conn.commit()
+            continue
+
+        print('applying migration {}: {}'.format(version, description))
+        for statement in statements:
+            cur.execute(statement.format(**names))
+        cur.execute('INSERT INTO {SchemaMigrations} (version, description) VALUES (%s, %s)'.format(**names),
+                    (version, description))
+        conn.commit()
+        applied.append(version)
+
+    cur.close()
+    print('applied migrations {}'.format(applied))
+    return applied
+
+def rebuildRollup(conn, suffix):
+    """
+    Run RollupRebuild in one transaction.
+    """
+    names = getTableNames(suffix)
+    cur = conn.cursor()
+    for statement in RollupRebuild:
+        cur.execute(statement.format(**names))
+    conn.commit()
+    cur.close()
+    print('rebuilt the ride rollup')
+
+def checkIndexUsage(conn, suffix):
+    """
+    For each of HotStatements, prepare the declared statement (with the table
+    names of the stage) and run EXPLAIN EXECUTE with its parameters and the
+    generic plan, which the APIs get after a few executions. For each of
+    HotQueries, run EXPLAIN. Sequential scans are disabled so that a small
+    local dataset does not hide a missing index. Check whether each plan uses
+    the expected indexes. Return a list of
+    {'query', 'index', 'usesIndex', 'plan'}.
+    """
+    loadHotStatementLambdas()
+    names = getTableNames(suffix)
+    cur = conn.cursor()
+    cur.execute('SET enable_seqscan = off')
+    cur.execute('SET plan_cache_mode = force_generic_plan')
+    results = []
+    for name, parameters, indexes in HotStatements:
+        sql, parameterTypes, preamble = getDeclaredStatement(name)
+        cur.execute(preamble + 'PREPARE cibic21_check ({}) AS {}'.format(
+                      ', '.join(parameterTypes), addTableSuffix(sql, suffix)))
+        cur.execute('EXPLAIN EXECUTE cibic21_check ({})'.format(', '.join(['%s'] * len(parameters))),
+                    parameters)
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        cur.execute('DEALLOCATE cibic21_check')
+        results.append(checkPlan(name, [index.format(**names) for index in indexes], plan))
+    for name, sql, index in HotQueries:
+        cur.execute('EXPLAIN ' + sql.format(**names))
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        results.append(checkPlan(name, [index.format(**names)], plan))
+    conn.rollback()
+    cur.close()
+    return results
+
+def measurePlanningTime(conn, suffix):
+    """
+    For each of PlanTimeStatements, run EXPLAIN (ANALYZE, SUMMARY) of the
+    declared statement (with the table names of the stage) as a plain query with
+    the parameters bound by psycopg2, which is planned on every execution, and
+    of PlanTimeExecutions EXECUTEs of the prepared statement. Return a list of
+    {'query', 'plainMs', 'preparedMs'}, where plainMs is [planning, execution]
+    and preparedMs the list of [planning, execution] of each EXECUTE, in
+    milliseconds.
+    """
+    loadHotStatementLambdas()
+    cur = conn.cursor()
+    results = []
+    for name, parameters in PlanTimeStatements:
+        sql, parameterTypes, preamble = getDeclaredStatement(name)
+        sql = addTableSuffix(sql, suffix)
+        plainSql, plainParameters = bindStatementParameters(sql, parameterTypes, parameters)
+        cur.execute(preamble + 'EXPLAIN (ANALYZE, SUMMARY) ' + plainSql, plainParameters)
+        plainMs = getExplainTimes(cur.fetchall())
+
+        cur.execute(preamble + 'PREPARE cibic21_plan_time ({}) AS {}'.format(
+                      ', '.join(parameterTypes), sql))
+        preparedMs = []
+        for i in range(PlanTimeExecutions):
+            cur.execute('EXPLAIN (ANALYZE, SUMMARY) EXECUTE cibic21_plan_time ({})'.format(
+                          ', '.join(['%s'] * len(parameters))), parameters)
+            preparedMs.append(getExplainTimes(cur.fetchall()))
+        cur.execute('DEALLOCATE cibic21_plan_time')
+
+        print('{}: plain planning {:.3f} ms, execution {:.3f} ms; prepared planning {} ms, execution {} ms'.format(
+                name, plainMs[0], plainMs[1], [ms[0] for ms in preparedMs], [ms[1] for ms in preparedMs]))
+        results.append({'query': name, 'plainMs': plainMs, 'preparedMs': preparedMs})
+    conn.rollback()
+    cur.close()
+    return results
+
+def getExplainTimes(rows):
+    """
+    Return [planning, execution] in milliseconds from the rows of EXPLAIN
+    (ANALYZE, SUMMARY).
+    """
+    times = {}
+    for row in rows:
+        match = re.match(r'\s*(Planning|Execution) Time: ([0-9.]+) ms', row[0])
+        if match:
+            times[match.group(1)] = float(match.group(2))
+    return [times.get('Planning'), times.get('Execution')]
+
+def checkPlan(name, indexes, plan):
+    """
+    Return the index check result of the query name whose EXPLAIN is plan.
+    """
+    words = ' ' + plan.replace('\n', ' ') + ' '
+    usesIndex = all((' ' + index + ' ') in words for index in indexes)
+    print('{}: {} index {}\n{}'.format(name, 'uses' if usesIndex else 'DOES NOT USE',
+                                       ', '.join(indexes), plan))
+    return {'query': name, 'index': ', '.join(indexes), 'usesIndex': usesIndex, 'plan': plan}
+
+def addTableSuffix(sql, suffix):
+    """
+    Return sql (with the CibicResources.Postgres table names) with the table
+    names of the stage suffix.
+    """
+    for name, table in vars(CibicResources.Postgres).items():
+        if not name.startswith('_'):
+            sql = re.sub(r'\b{}\b'.format(table), table + suffix, sql)
+    return sql
+
+def loadHotStatementLambdas():
+    """
+    Import HotStatementLambdas once, so that their statements are declared.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in HotStatementLambdas:
+        moduleName = name.replace('-', '_')
+        if moduleName not in sys.modules:
+            spec = importlib.util.spec_from_file_location(
+                     moduleName, os.path.join(folder, name, 'lambda_function.py'))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[moduleName] = module
+            spec.loader.exec_module(module)
+
+if __name__ == '__main__':
+    print(lambda_handler({'action': sys.argv[1], 'stage': sys.argv[2] if len(sys.argv) > 2 else 'prod'}, None))
@@ -5,10 +5,7 @@
 # add to the tables for rides, ride waypoints and flow waypoints. For each new
 # ride, send an SNS message to buenos-aires-new-ride-ready .
 
-import psycopg2
-from psycopg2 import extras # for fast batch insert, see https://www.psycopg.org/docs/extras.html#fast-exec
 from common.cibic_common import *
-from datetime import datetime
 
 # Python 3.8 lambda environment does not have requests https://stackoverflow.com/questions/58952947/import-requests-on-aws-lambda-for-python-3-8
 # for a fix using Lambda Layers, see https://dev.to/razcodes/how-to-create-a-lambda-layer-in-aws-106m
@@ -40,8 +37,7 @@ def lambda_handler(event, context):
         for id, route in routes.items():
             print("Route " + str(id) + ' "' + str(route.get('name')) + '"')
 
-        conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                user=pgUsername, password=pgPassword)
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
         cur = conn.cursor()
 
         # The users coming from ENV_VAR_RWGPS_CLUB_ID are for Buenos Aires.
@@ -91,18 +87,22 @@ def lambda_handler(event, context):
                       ', ride ' + str(rideId) + ' route ' + flow)
 
                 # Get the waypoints in the form needed by splitWaypoints, etc.
-                waypoints = []
-                previousTimestamp = ""
+                # The timestamps are UTC without a fraction of the seconds,
+                # unless a track point time has one.
+                waypoints = WaypointArray(timestampDecimals=0)
+                previousTimestamp = None
                 for point in trip['trip']['track_points']:
-                    timestamp = datetime.fromtimestamp(point['t']).isoformat() + '+00:00'
-                    if timestamp == previousTimestamp:
+                    # The track point time is in seconds since the epoch.
+                    timestamp, micros = divmod(round(point['t'] * 1000000), 1000)
+                    if (timestamp, micros) == previousTimestamp:
                         # Skip duplicates.
                         continue
                     else:
                         if 'x' in point and 'y' in point:
-                            previousTimestamp = timestamp
-                            waypoints.append({ 'longitude': point['x'], 'latitude': point['y'],
-                              'timestamp': timestamp })
+                            previousTimestamp = (timestamp, micros)
+                            if point['t'] != int(point['t']):
+                                waypoints.timestampDecimals = 6
+                            waypoints.append(point['y'], point['x'], timestamp, timestampMicros=micros)
                         else:
                             print('caught exception: No x or y in point' + str(point))
 
@@ -115,13 +115,18 @@ def lambda_handler(event, context):
                       'unknown', 'unknown', None, region, 'other', None, None)
                     continue
 
-                startZone, endZone, _ = splitWaypoints(obfuscateRadius, waypoints)
+                startZone, endZone, mainZone = splitWaypoints(obfuscateRadius, waypoints)
 
                 # Locally assign the flow waypoint indexes.
                 idx = 0
                 for wp in route['track_points']:
                     wp['idx'] = idx
                     idx += 1
+                # Skip the flow waypoints without coordinates, like the trip waypoints.
+                flowPoints = [wp for wp in route['track_points'] if 'x' in wp and 'y' in wp]
+                if len(flowPoints) < len(route['track_points']):
+                    print('skipped {} route track points without x or y'
+                          .format(len(route['track_points']) - len(flowPoints)))
 
                 pod = None
                 podName = None
@@ -137,23 +142,28 @@ def lambda_handler(event, context):
                 weatherJson = None
                 if role == 'steward':
                     # For a steward include the weather (at the start waypoint).
-                    weatherJson = fetchWeatherJson(startZone[0]['latitude'], startZone[0]['longitude'],
+                    weatherJson = fetchWeatherJson(startZone.latitude[0], startZone.longitude[0],
                       accuweatherLocationUrl, accuweatherConditionsUrl, accuweatherApiKey,
-                      requests)
+                      requests, cur)
 
                 insertRide(cur, str(rideId), str(userId), role, flow, flowName, pod, podName,
                   inferredPod, inferredPodName, weatherJson, region, organization,
                   startZone, endZone)
+                addRideToRollup(cur, str(rideId))
                 insertRawWaypoints(cur, str(rideId), waypoints)
-                insertFlowWaypoints(cur, str(rideId), flow, route['track_points'])
+                # Insert the main zone ride line, also simplified for the map API, and the flow line.
+                insertRideGeometry(cur, str(rideId), mainZone.latitude, mainZone.longitude,
+                                   [mainZone.pointJson(i) for i in range(len(mainZone))],
+                                   [wp['y'] for wp in flowPoints], [wp['x'] for wp in flowPoints])
+                insertFlowWaypoints(cur, str(rideId), flow, flowPoints)
 
                 # Notify ride ready.
                 rideData = {
                     'userId': userId,
                     'role': role,
                     'flow': flow,
-                    'startTime': startZone[0]['timestamp'],
-                    'endTime': endZone[-1]['timestamp']
+                    'startTime': startZone.isoTimestamp(0),
+                    'endTime': endZone.isoTimestamp(-1)
                 }
                 snsClient.publish(TopicArn=rideReadyTopic,
                     Message=json.dumps({'id':rideId, 'rideData': rideData}),
@@ -287,33 +297,29 @@ def insertRide(cur, rideId, userId, role, flow, flowName, pod, podName,
           """.format(CibicResources.Postgres.Rides,
                       wktPoint(cLat1, cLon1), rad1,
                       wktPoint(cLat2, cLon2), rad2)
-    cur.execute(sql, (rideId, startZone[0]['timestamp'], endZone[-1]['timestamp'], userId, role, flow, flowName,
+    cur.execute(sql, (rideId, startZone.isoTimestamp(0), endZone.isoTimestamp(-1), userId, role, flow, flowName,
                       pod, podName, inferredPod, inferredPodName, weatherJson, region, organization))
 
 def wktPoint(lat, lon):
     return 'POINT({} {})'.format(lon, lat)
 
 def insertRawWaypoints(cur, rideId, waypoints):
-    sql = """
-            INSERT INTO {} ("rideId", coordinate, timestamp, idx, zone, "pointJson")
-            VALUES %s
-          """.format(CibicResources.Postgres.WaypointsRaw)
-    values = list((rideId, makeSqlPoint(wp['latitude'], wp['longitude']),
-                    wp['timestamp'], wp['originalIdx'], wp['zone'],
-                    # Cache the JSON of the point with the timestamp.
-                    '[' + str(wp['longitude']) + ', ' + str(wp['latitude']) + ', 0, "' + wp['timestamp'] + '"]')
-                  for wp in waypoints)
-    extras.execute_values(cur, sql, values)
+    def makeRows():
+        for i in range(len(waypoints)):
+            timestamp = waypoints.isoTimestamp(i)
+            yield (rideId, makeSqlPoint(waypoints.latitude[i], waypoints.longitude[i]),
+                   timestamp, waypoints.idx[i], waypoints.zoneName(i),
+                   # Cache the JSON of the point with the timestamp.
+                   waypoints.pointJson(i, timestamp))
+
+    copyRows(cur, CibicResources.Postgres.WaypointsRaw,
+             ['rideId', 'coordinate', 'timestamp', 'idx', 'zone', 'pointJson'], makeRows())
 
 def insertFlowWaypoints(cur, rideId, flow, waypoints):
     try:
-        sql = """
-                INSERT INTO {} ("rideId", flow, coordinate, idx)
-                VALUES %s
-              """.format(CibicResources.Postgres.RideFlowWaypoints)
-        values = list((rideId, flow, makeSqlPoint(wp['y'], wp['x']),
-                       wp['idx']) for wp in waypoints)
-        extras.execute_values(cur, sql, values)
+        copyRows(cur, CibicResources.Postgres.RideFlowWaypoints,
+                 ['rideId', 'flow', 'coordinate', 'idx'],
+                 ((rideId, flow, makeSqlPoint(wp['y'], wp['x']), wp['idx']) for wp in waypoints))
     except:
         print('caught exception in insertFlowWaypoints:', sys.exc_info()[0])
 
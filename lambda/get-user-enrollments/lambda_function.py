@@ -10,7 +10,6 @@
 
 from common.cibic_common import *
 import os
-import psycopg2
 import unidecode
 from psycopg2 import extras # for fast batch insert, see https://www.psycopg.org/docs/extras.html#fast-exec
 from datetime import datetime
@@ -67,8 +66,7 @@ def lambda_handler(event, context):
             enrollments = response.json()
             print('Processing ' + str(len(enrollments)) + ' user enrollments')
 
-            conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                    user=pgUsername, password=pgPassword)
+            conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
             cur = conn.cursor()
 
             # Delete "no-enrollment" users. Then set the remaining users to deleted.
@@ -1,10 +1,12 @@
 # This lambda runs periodically to infer the pod for a ride whose inferredPod is
 # NULL. If the inferred pod cannot be determined, set it to 'unknown' so that we
-# don't try to infer again.
+# don't try to infer again. If ENV_SNS_RIDE_UPDATED is set, publish the updated
+# ride IDs so that caches of the rides can evict them. Then render the GeoJSON
+# of the updated rides again (see ride-render). A ride which fails to render is
+# skipped, and /ride/get queries it from Postgres.
 
 from common.cibic_common import *
 import os
-import psycopg2
 from datetime import datetime, timedelta
 
 pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
@@ -12,14 +14,20 @@ pgUsername = os.environ['ENV_VAR_POSTGRES_USER']
 pgPassword = os.environ['ENV_VAR_POSTGRES_PASSWORD']
 pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
 jointPointRadius = int(os.environ['ENV_VAR_JOIN_POINT_RADIUS'])
+rideUpdatedTopic = os.environ['ENV_SNS_RIDE_UPDATED'] if 'ENV_SNS_RIDE_UPDATED' in os.environ else None
+# Ride IDs per ride updated SNS message, within the 256 KB message limit.
+rideUpdatedBatchSize = 1000
+
+snsClient = boto3.client('sns')
+rideGeoJsonStore = makeObjectStore(CibicResources.S3Bucket.RideGeoJson)
 
 def lambda_handler(event, context):
     now = datetime.now().astimezone()
 
     try:
-        conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                user=pgUsername, password=pgPassword)
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
         cur = conn.cursor()
+        updatedRideIds = []
 
         # Get all rides which don't have an inferred pod yet.
         sql = """
@@ -46,9 +54,9 @@ SELECT "rideId", "startTime", "endTime", flow, role, pod, "podName", region, org
             if role == 'steward':
                 if pod != None:
                     # For the steward, set the inferredPod to the pod.
-                    updateInferredPod(cur, rideId, pod, podName)
+                    updateInferredPod(cur, updatedRideIds, rideId, pod, podName)
                 else:
-                    updateInferredPod(cur, rideId, 'unknown', 'unknown')
+                    updateInferredPod(cur, updatedRideIds, rideId, 'unknown', 'unknown')
                 continue
 
             if (now - endTime) < timedelta(hours=12):
@@ -69,7 +77,7 @@ SELECT "rideId", pod, "podName", "flowJoinPointsJson"
             stewardRides = cur.fetchall()
             if len(stewardRides) == 0:
                 print('There are no matching steward rides for rideId ' + rideId)
-                updateInferredPod(cur, rideId, 'unknown', 'unknown')
+                updateInferredPod(cur, updatedRideIds, rideId, 'unknown', 'unknown')
                 continue
 
             # Check if all steward rides have the same pod.
@@ -85,7 +93,7 @@ SELECT "rideId", pod, "podName", "flowJoinPointsJson"
 
             if inferredPod != None:
                 # There is only one choice, so use it.
-                updateInferredPod(cur, rideId, inferredPod, inferredPodName)
+                updateInferredPod(cur, updatedRideIds, rideId, inferredPod, inferredPodName)
                 continue
 
             # There are steward rides with different pods. Must choose.
@@ -134,22 +142,43 @@ SELECT ST_Distance(ST_SetSRID(coordinate::geometry, 4326)::geography, ST_SetSRID
                     inferredPodName = stewardPodName
 
             if inferredPod != None:
-                updateInferredPod(cur, rideId, inferredPod, inferredPodName)
+                updateInferredPod(cur, updatedRideIds, rideId, inferredPod, inferredPodName)
             else:
-                updateInferredPod(cur, rideId, 'unknown', 'unknown')
+                updateInferredPod(cur, updatedRideIds, rideId, 'unknown', 'unknown')
 
         conn.commit()
+
+        # Publish before rendering, so that a failed render does not hold back
+        # the notification. Until a ride is rendered again, /ride/get sees that
+        # the rendered version is old and queries Postgres.
+        if rideUpdatedTopic != None:
+            for i in range(0, len(updatedRideIds), rideUpdatedBatchSize):
+                snsClient.publish(TopicArn=rideUpdatedTopic,
+                                  Message=json.dumps({'rideIds': updatedRideIds[i:i+rideUpdatedBatchSize]}),
+                                  Subject='ride updated')
+            print('sent ride updated notification for {} rides'.format(len(updatedRideIds)))
+
+        for rideId in updatedRideIds:
+            try:
+                renderRideGeoJson(cur, rideGeoJsonStore, rideId)
+                conn.commit()
+            except:
+                reportError()
+                print('failed to render ride GeoJSON for ride {}'.format(rideId))
+                conn.rollback()
         cur.close()
     except:
         err = reportError()
         print('caught exception:', sys.exc_info()[0])
         return lambdaReply(420, str(err))
+    finally:
+        printPreparedStatementStats()
 
     return processedReply()
 
-def updateInferredPod(cur, rideId, inferredPod, inferredPodName):
+def updateInferredPod(cur, updatedRideIds, rideId, inferredPod, inferredPodName):
     """
-    Update the inferred pod for the rideId.
+    Update the inferred pod for the rideId and append it to updatedRideIds.
     """
     print('inferredPod: ' + inferredPod)
     sql = """
@@ -158,6 +187,7 @@ UPDATE {0} SET "inferredPod" = '{1}', "inferredPodName" = '{2}'
     """.format(CibicResources.Postgres.Rides, inferredPod, inferredPodName,
                rideId)
     cur.execute(sql)
+    updatedRideIds.append(rideId)
 
 def getPointLeaveTime(cur, rideId, lat, lon):
     """
@@ -11,7 +11,6 @@ from boto3.dynamodb.conditions import Key
 import os
 from datetime import datetime, timezone
 from decimal import Decimal
-import psycopg2
 
 dynamoDbResource = boto3.resource('dynamodb')
 pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
@@ -51,8 +50,7 @@ def lambda_handler(event, context):
         now = datetime.now().astimezone(tz=timezone.utc).isoformat()
         response = journalsTable.scan(FilterExpression=Key('timestamp').gt(lastLocationScanTime))
 
-        conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                user=pgUsername, password=pgPassword)
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
         for item in response['Items']:
             if not (item.get('processed') == True and item.get('type') == 'live'):
                 continue
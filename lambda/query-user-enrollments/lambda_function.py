@@ -2,7 +2,6 @@
 
 from common.cibic_common import *
 import os
-import psycopg2
 
 pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
 pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
@@ -16,10 +15,22 @@ def lambda_handler(event, context):
     try:
         print('query-user-enrollments event data: ' + str(event))
 
-        conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                user=pgUsername, password=pgPassword)
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
         cur = conn.cursor()
 
+        # The count and latest "updatedTime" change with any insert, update or
+        # delete, so answer If-None-Match before building the enrollments.
+        sql = """
+          SELECT COUNT(*), MAX("updatedTime") FROM {}
+        """.format(CibicResources.Postgres.UserEnrollments)
+        cur.execute(sql)
+        etag = makeETag(event, 'query-user-enrollments', tuple(cur.fetchone()))
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if isNotModified(event, etag):
+            conn.commit()
+            cur.close()
+            return notModifiedReply(etag, headers)
+
         sql = """
           SELECT "userId", role, active, "displayName", email,
             "consentedName", "consentedEmail", "consentedPhone", to_json("consentedTime"),
@@ -74,7 +85,7 @@ def lambda_handler(event, context):
         cur.close()
 
         print("Returning {} enrollments".format(len(enrollmentsResponse)))
-        requestReply = lambdaReply(200, enrollmentsResponse)
+        requestReply = lambdaReply(200, enrollmentsResponse, event, headers)
     except:
         err = reportError()
         print('caught exception:', sys.exc_info()[0])
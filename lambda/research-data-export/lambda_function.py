@@ -5,7 +5,6 @@ import os
 import io
 import json
 import base64
-import psycopg2
 from datetime import datetime
 import boto3
 from boto3.dynamodb.conditions import Attr
@@ -57,8 +56,7 @@ def lambda_handler(event, context):
         for surveyItem in surveyItems:
             surveyItem['body'] = json.loads(surveyItem.get('body', "{}"))
 
-        conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                user=pgUsername, password=pgPassword)
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
         for journalItem in journalItems:
             try:
                 body = json.loads(journalItem['body'])
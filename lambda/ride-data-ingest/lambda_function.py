@@ -13,6 +13,11 @@ lambdaClient = boto3.client('lambda')
 # see https://docs.aws.amazon.com/lambda/latest/dg/configuration-envvars.html#configuration-envvars-config
 # requestTableArn = os.environ['ENV_DYNAMODB_ENDPOINT_REQUESTS_TABLE_NAME']
 waypointsProcArn = os.environ['ENV_LAMBDA_ARN_WP_PROC']
+# An async lambda payload is limited to 256 KB. Above this size, put the
+# waypoints in the object store and send only the key (a claim check).
+claimCheckBytes = int(os.environ['ENV_VAR_CLAIM_CHECK_BYTES']) if 'ENV_VAR_CLAIM_CHECK_BYTES' in os.environ else 200 * 1024
+
+waypointsStore = makeObjectStore(CibicResources.S3Bucket.RideWaypoints)
 
 def lambda_handler(event, context):
     requestsTable = dynamoDbResource.Table(CibicResources.DynamoDB.EndpointRequests)
@@ -50,24 +55,29 @@ def lambda_handler(event, context):
         if not isRideDataValid(requestBody):
             requestReply = malformedMessageReply();
         else:
-            waypointsData = requestBody['trajectoryData']['waypoints']
+            trajectoryData = requestBody['trajectoryData']
 
             remapRideData = makeRideData(requestBody)
 
-            # To send the waypoints, we gzip and base64.
-            waypoints_gz = gzip.compress(str.encode(json.dumps(waypointsData)))
+            wpProcData = {
+                'rideData' : remapRideData,
+                'flowData' : requestBody.get('flow')
+            }
+            waypointsData = makeWaypointsData(trajectoryData)
+            wpProcData.update(waypointsData)
+            wpProcPayload = json.dumps({ 'rid': requestId, 'data': wpProcData })
+            if len(wpProcPayload) > claimCheckBytes:
+                print('wp-proc payload is {} bytes, putting the waypoints in the object store'
+                      .format(len(wpProcPayload)))
+                for key in waypointsData:
+                    del wpProcData[key]
+                wpProcData['waypoints_s3_key'] = putWaypointsData(requestId, waypointsData)
+                wpProcPayload = json.dumps({ 'rid': requestId, 'data': wpProcData })
+
             # async-invoke waypoints processing lambda
             res = lambdaClient.invoke(FunctionName = waypointsProcArn,
                                 InvocationType = 'Event',
-                                Payload = json.dumps({
-                                                        'rid': requestId,
-                                                        'data':
-                                                        {
-                                                            'rideData' : remapRideData,
-                                                            'flowData' : requestBody.get('flow'),
-                                                            'waypoints_gz_b64' : base64.b64encode(waypoints_gz).decode()
-                                                        }
-                                                    })
+                                Payload = wpProcPayload
                                 )
             print('wp-proc async-invoke reply status code '+str(res['StatusCode']))
 
@@ -93,7 +103,69 @@ def lambda_handler(event, context):
 
 def isRideDataValid(body):
     # TODO: add proper JSON validation by data model
-    return 'id' in body and 'trajectoryData' in body
+    if not ('id' in body and 'trajectoryData' in body):
+        return False
+    trajectoryData = body['trajectoryData']
+    return 'waypoints' in trajectoryData or isCompactTrajectory(trajectoryData)
+
+def isCompactTrajectory(trajectoryData):
+    """
+    Check if trajectoryData has the compact form of the waypoints which the app
+    can send instead of the 'waypoints' array:
+    {
+      'encoded': <Google encoded polyline with one point per waypoint>,
+      'timestampDeltas': [<first epoch ms>, <ms since previous waypoint>, ...],
+      'speedDeltas': [<first speed in tenths>, <difference in tenths>, ...] (optional),
+      'utcOffset': <UTC offset in minutes of the ride timestamps> (optional)
+    }
+    """
+    return 'encoded' in trajectoryData and 'timestampDeltas' in trajectoryData
+
+def makeCompactTrajectory(trajectoryData):
+    # Only pass the columns which wp-process uses.
+    return {
+        'encoded': trajectoryData['encoded'],
+        'timestampDeltas': trajectoryData['timestampDeltas'],
+        'speedDeltas': trajectoryData.get('speedDeltas'),
+        'utcOffset': trajectoryData.get('utcOffset', 0)
+        }
+
+def makeWaypointsData(trajectoryData):
+    """
+    Return the dict of waypoints data for the wp-process payload. Normally this
+    is 'waypoints_bin_b64' with the base64 of packWaypoints. If packing fails,
+    fall back to the gzipped and base64 JSON 'waypoints_gz_b64', or the compact
+    'trajectory'.
+    """
+    try:
+        if 'waypoints' in trajectoryData:
+            waypoints = WaypointArray.fromDicts(trajectoryData['waypoints'])
+        else:
+            waypoints = WaypointArray.fromPolyline(
+              trajectoryData['encoded'], trajectoryData['timestampDeltas'],
+              trajectoryData.get('speedDeltas'), trajectoryData.get('utcOffset', 0))
+        return { 'waypoints_bin_b64': base64.b64encode(packWaypoints(waypoints)).decode() }
+    except:
+        reportError()
+        print('cannot pack the waypoints, sending JSON')
+
+    if 'waypoints' in trajectoryData:
+        # To send the waypoints, we gzip and base64.
+        waypoints_gz = gzip.compress(str.encode(json.dumps(trajectoryData['waypoints'])))
+        return { 'waypoints_gz_b64': base64.b64encode(waypoints_gz).decode() }
+    else:
+        # The compact trajectory is already small, so send it as-is.
+        return { 'trajectory': makeCompactTrajectory(trajectoryData) }
+
+def putWaypointsData(requestId, waypointsData):
+    """
+    Put the gzipped JSON of the waypointsData (from makeWaypointsData) in the
+    object store under the requestId. Return the object key.
+    """
+    key = 'waypoints/{}.json.gz'.format(requestId)
+    waypointsStore.put(key, gzip.compress(str.encode(json.dumps(waypointsData))),
+                       contentType='application/gzip')
+    return key
 
 def makeRideData(body):
     # for example, throw out data that we don't need
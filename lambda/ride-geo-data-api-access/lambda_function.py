@@ -1,12 +1,28 @@
 # This Lambda is for the ride GeoJSON access API. For /ride/get, query parameters
 # is just 'rideId'. For /ride/query, query parameters are 'startTime' and 'endTime'
 # (required) plus 'region', 'organization' and 'requireFlow' (optional).
-# Get the matching rides from the Rides Postgres table and combine with
-# WaypointsRaw and RideFlowWaypoints. Retur the result in GeoJSON.
+# Get the matching rides from the Rides Postgres table and combine with the ride
+# and flow lines in RideGeometry. Retur the result in GeoJSON. For /ride/get,
+# read the GeoJSON rendered by ride-render from the RideGeoJson object store if
+# it is for the current version of the ride.
+# For /ride/query, the optional query parameter 'limit' pages the rides (latest
+# first), and the reply is {"rides": [...], "nextCursor": <cursor or null>}. Pass
+# the 'cursor' query parameter to get the next page.
+# For both, the optional query parameter 'tolerance' (meters) or 'zoom' (web map
+# zoom level) selects a simplified ride line (precomputed in RideGeometry) so
+# that a map downloads fewer points.
+# For /ride/tiles/{z}/{x}/{y}, the path parameters are the web map tile and the
+# query parameters are as for /ride/query. Return a Mapbox Vector Tile with the
+# layers 'rides' (ride lines) and 'flows' (flow lines) clipped to the tile.
+# Subscribed to the ride updated SNS (from infer-pod), evict the rides from the
+# /ride/get cache of this container. SNS invokes only one container, so the
+# other containers keep the rides until they expire or are evicted by size.
+# This is only for memory, since the cache key has the version of the ride.
 
 from common.cibic_common import *
 import os
-import psycopg2
+import base64
+import tempfile
 from datetime import datetime
 import urllib
 
@@ -14,18 +30,85 @@ pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
 pgUsername = os.environ['ENV_VAR_POSTGRES_USER']
 pgPassword = os.environ['ENV_VAR_POSTGRES_PASSWORD']
 pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
+# For the 'zoom' parameter, use the pixel size at this latitude. Both regions are
+# near 34 degrees (north and south).
+zoomLatitude = 34.0
+# Seconds that clients and CDNs may cache a vector tile.
+tileMaxAge = int(os.environ['ENV_VAR_TILE_MAX_AGE']) if 'ENV_VAR_TILE_MAX_AGE' in os.environ else 300
+# Web map zoom levels for which to serve tiles.
+maxTileZoom = 22
+# Maximum bytes of the /ride/query reply. API Gateway and lambda limit the
+# reply to 6 MB. If the rides exceed this, the reply ends with a continuation.
+maxReplyBytes = int(os.environ['ENV_VAR_MAX_REPLY_BYTES']) if 'ENV_VAR_MAX_REPLY_BYTES' in os.environ else 5 * 1024 * 1024
+# Rides per fetch from the server-side cursor of the rich query.
+richQueryFetchSize = int(os.environ['ENV_VAR_RICH_QUERY_FETCH_SIZE']) if 'ENV_VAR_RICH_QUERY_FETCH_SIZE' in os.environ else 50
+# Bytes of the rich query reply to keep in memory before spooling to a file.
+richQuerySpoolBytes = 1024 * 1024
+# Maximum 'limit' of /ride/query.
+maxPageSize = int(os.environ['ENV_VAR_MAX_PAGE_SIZE']) if 'ENV_VAR_MAX_PAGE_SIZE' in os.environ else 1000
+# The /ride/get GeoJSON for (rideId, rideLineColumn, version), kept in the
+# container, where version is from fetchRideVersion so that a ride is not served
+# after it changed. The size is in characters of the JSON text. infer-pod
+# publishes the rides it updates (ENV_SNS_RIDE_UPDATED) and this lambda evicts
+# them when subscribed, which frees the memory of the old versions sooner in the
+# container which gets the message.
+rideCacheMaxBytes = int(os.environ['ENV_VAR_RIDE_CACHE_MAX_BYTES']) if 'ENV_VAR_RIDE_CACHE_MAX_BYTES' in os.environ else 32 * 1024 * 1024
+rideCacheTtl = int(os.environ['ENV_VAR_RIDE_CACHE_TTL']) if 'ENV_VAR_RIDE_CACHE_TTL' in os.environ else 300
+rideCache = LruCache('ride', rideCacheMaxBytes, rideCacheTtl)
+rideGeoJsonStore = makeObjectStore(CibicResources.S3Bucket.RideGeoJson)
 
 def lambda_handler(event, context):
     try:
         print (event)
+        if 'Records' in event:
+            # SNS message from infer-pod: { "rideIds": [<ride-id>, ...] }
+            for rec in event['Records']:
+                evictRides(json.loads(rec['Sns']['Message']).get('rideIds', []))
+            return processedReply()
+
+        if event['requestContext']['resourcePath'] in ['/ride/get', '/ride/query']:
+            try:
+                tolerance, zoom = parseSimplifyParameters(event['queryStringParameters'])
+            except ValueError:
+                return lambdaReply(420, 'bad format for tolerance/zoom parameters')
+            if tolerance == None and zoom != None:
+                tolerance = getZoomTolerance(zoom, zoomLatitude)
+            rideLineColumn = getRideLineColumn(tolerance)
+
         if event['requestContext']['resourcePath'] == '/ride/get':
             if 'rideId' in event['queryStringParameters']:
                 rideId = event['queryStringParameters']['rideId']
+                # Check the version in Postgres (one lookup by rideId) rather
+                # than serve the rendered object by rideId alone. The object can
+                # be older than the ride: ride-geometry-backfill writes
+                # RideGeometry without rendering, infer-pod renders after it
+                # publishes, and a render can fail. The version also answers
+                # If-None-Match and the cache below without reading the object.
+                version = fetchRideVersion(rideId)
+                if version == None:
+                    print('no ride with id {} found'.format(rideId))
+                    return lambdaReply(404, 'not found')
+                etag = makeETag(event, '/ride/get', rideId, rideLineColumn, version)
+                # Clients revalidate every time, since the RideGeometry of a ride
+                # can change even after its inferredPod is set.
+                headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+                if isNotModified(event, etag):
+                    return notModifiedReply(etag, headers)
+
                 # fetch ride from postgres as GeJSON
                 print('fetching ride {}...'.format(rideId))
-                rideData = fetchRide(rideId)
-                if rideData:
-                    return lambdaReply(200, rideData)
+                rideJson = rideCache.get((rideId, rideLineColumn, version))
+                if rideJson == None:
+                    # Read the GeoJSON rendered by ride-render, or build it if it
+                    # is not rendered (yet) for this version.
+                    rideJson = readRideGeoJson(rideGeoJsonStore, rideId, rideLineColumn, version)
+                    if rideJson == None:
+                        rideJson = fetchRide(rideId, rideLineColumn)
+                    if rideJson:
+                        rideCache.put((rideId, rideLineColumn, version), rideJson)
+                print(rideCache.getStats())
+                if rideJson:
+                    return lambdaReplyJson(200, rideJson, event, headers)
                 else:
                     print('no ride with id {} found'.format(rideId))
                     return lambdaReply(404, 'not found')
@@ -41,126 +124,171 @@ def lambda_handler(event, context):
                 region = event['queryStringParameters'].get('region')
                 organization = event['queryStringParameters'].get('organization')
                 requireFlow = ('requireFlow' in event['queryStringParameters'])
+                try:
+                    limit, cursor = parsePageParameters(event['queryStringParameters'])
+                except ValueError:
+                    return lambdaReply(420, 'bad format for limit/cursor parameters')
+                paged = ('limit' in event['queryStringParameters'] or
+                         'cursor' in event['queryStringParameters'])
+
+                version = queryRidesVersion(startTime, endTime, region, organization, requireFlow,
+                                            limit, cursor)
+                etag = makeETag(event, '/ride/query', sorted(event['queryStringParameters'].items()),
+                                version)
+                headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+                if isNotModified(event, etag):
+                    return notModifiedReply(etag, headers)
 
                 if 'idsOnly' in event['queryStringParameters']:
-                    rides = queryRidesSimple(startTime, endTime, region, organization, requireFlow)
+                    rides, nextCursor = queryRidesSimple(startTime, endTime, region, organization, requireFlow,
+                                                         limit, cursor)
+                    print('fetched {} rides'.format(len(rides)))
+                    if paged:
+                        return lambdaReply(200, {'rides': rides, 'nextCursor': nextCursor}, event, headers)
+                    return lambdaReply(200, rides, event, headers)
                 else:
-                    rides = queryRidesRich(startTime, endTime, region, organization, requireFlow)
-                print('fetched {} rides'.format(len(rides)))
-                return lambdaReply(200, rides)
+                    ridesJson, nextCursor = queryRidesRich(startTime, endTime, region, organization, requireFlow,
+                                                           rideLineColumn, limit, cursor, paged)
+                    if paged:
+                        return lambdaReplyJson(200, '{{"rides": {}, "nextCursor": {}}}'.format(
+                                                      ridesJson, json.dumps(nextCursor)), event, headers)
+                    return lambdaReplyJson(200, ridesJson, event, headers)
+            else:
+                return malformedMessageReply()
+
+        if event['requestContext']['resourcePath'] == '/ride/tiles/{z}/{x}/{y}':
+            queryParameters = event.get('queryStringParameters') or {}
+            if 'startTime' in queryParameters and 'endTime' in queryParameters:
+                try:
+                    z, x, y = parseTileParameters(event['pathParameters'])
+                except ValueError:
+                    return lambdaReply(420, 'bad format for z/x/y parameters')
+                startTime = parseDatetime(queryParameters['startTime'])
+                endTime = parseDatetime(queryParameters['endTime'])
+
+                if not startTime or not endTime:
+                    return lambdaReply(420, 'bad format for startTime/endTime parameters')
+
+                region = queryParameters.get('region')
+                organization = queryParameters.get('organization')
+                requireFlow = ('requireFlow' in queryParameters)
+
+                tile = queryRideTile(z, x, y, startTime, endTime, region, organization, requireFlow)
+                print('fetched tile {}/{}/{} with {} bytes'.format(z, x, y, len(tile)))
+                return {
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': 'application/vnd.mapbox-vector-tile',
+                        'Cache-Control': 'public, max-age={}'.format(tileMaxAge)
+                    },
+                    'body': base64.b64encode(tile).decode('ascii'),
+                    'isBase64Encoded': True
+                }
             else:
                 return malformedMessageReply()
     except:
         err = reportError()
         print('caught exception:', sys.exc_info()[0])
         return lambdaReply(420, str(err))
+    finally:
+        printPreparedStatementStats()
 
     return processedReply()
 
-def fetchRide(rideId):
-    sql = """
-            SET TIME ZONE 'America/Los_Angeles';
-            SELECT json_build_object(
-                     'type', 'FeatureCollection',
-                     'features', array_to_json(feature_list),
-                     'properties', json_build_object(
-                                     'rideId', rid,
-                                     'startTime', start_time,
-                                     'endTime', end_time,
-                                     'userId', user_id,
-                                     'role', role,
-                                     'flow', flow,
-                                     'flowName', flow_name,
-                                     'flowIsToWork', flow_is_to_work,
-                                     'commute', commute,
-                                     'flowJoinPoints', flow_join_points_json,
-                                     'flowLeavePoints', flow_leave_points_json,
-                                     'pod', pod,
-                                     'podName', pod_name,
-                                     'podMember', pod_member_json,
-                                     'inferredPod', inferred_pod,
-                                     'inferredPodName', inferred_pod_name,
-                                     'weather', weather_json,
-                                     'region', region,
-                                     'organization', organization,
-                                     'flowPath', flow_path
-                                   )
-                   )
-            FROM (SELECT array[json_build_object(
-                                'type', 'Feature',
-                                'geometry', ST_AsGeoJSON(start_zone)::json
-                               ),
-                               json_build_object(
-                                'type', 'Feature',
-                                'geometry', ST_AsGeoJSON(end_zone)::json
-                               ),
-                               json_build_object(
-                                'type', 'Feature',
-                                'geometry', json_build_object(
-                                              'type', 'LineString',
-                                              'coordinates', array_to_json(ride_line)
-                                            ))
-                               ] AS feature_list,
-                               json_build_object(
-                                'type', 'Feature',
-                                'geometry', ST_AsGeoJSON(flow_line)::json) AS flow_path,
-                               rid, start_time, end_time, user_id, role, flow, flow_name, flow_is_to_work, commute,
-                               flow_join_points_json, flow_leave_points_json, pod, pod_name, pod_member_json,
-                               inferred_pod, inferred_pod_name, weather_json, region, organization
-                  FROM (SELECT ride."startZone" AS start_zone,
-                               ride."endZone" AS end_zone,
-                               wp.ride_line,
-                               flow_wp.flow_line,
-                               ride."rideId" AS rid,
-                               ride."startTime" AS start_time,
-                               ride."endTime" AS end_time,
-                               ride."userId" AS user_id,
-                               ride."role" AS role,
-                               ride."flow" AS flow,
-                               ride."flowName" AS flow_name,
-                               ride."flowIsToWork" AS flow_is_to_work,
-                               ride."commute" AS commute,
-                               ride."flowJoinPointsJson" AS flow_join_points_json,
-                               ride."flowLeavePointsJson" AS flow_leave_points_json,
-                               ride."pod" AS pod,
-                               ride."podName" AS pod_name,
-                               ride."podMemberJson" AS pod_member_json,
-                               ride."inferredPod" AS inferred_pod,
-                               ride."inferredPodName" AS inferred_pod_name,
-                               ride."weatherJson" AS weather_json,
-                               ride."region" AS region,
-                               ride."organization" AS organization
-                         FROM {0} AS ride
-                         LEFT JOIN (SELECT "rideId",
-                                       array_agg("pointJson" ORDER BY "idx") AS ride_line
-                                    FROM {1}
-                                    WHERE zone = 'main'
-                                    GROUP BY "rideId") AS wp
-                         ON ride."rideId" = wp."rideId"
-                         LEFT JOIN (SELECT "rideId", ST_MakeLine(array_agg(coordinate::geometry ORDER BY "idx")) AS flow_line
-                                    FROM {2}
-                                    GROUP BY "rideId") AS flow_wp
-                         ON ride."rideId" = flow_wp."rideId"
-                         WHERE ride."rideId" = '{3}'
-                       ) AS geo
-                 ) AS feature_collection;
-          """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.WaypointsRaw,
-                     CibicResources.Postgres.RideFlowWaypoints, rideId)
-    conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                            user=pgUsername, password=pgPassword)
-    cur = conn.cursor()
-    cur.execute(sql)
+def evictRides(rideIds):
+    """
+    Evict the rides from rideCache (all line levels and versions).
+    """
+    rideIds = set(rideIds)
+    evicted = rideCache.evict(lambda key: key[0] in rideIds)
+    print('evicted {} cached rides for {} ride IDs. {}'.format(evicted, len(rideIds), rideCache.getStats()))
 
-    rideData = None
-    results = cur.fetchall()
-    if len(results):
-        print('ride fetched {}'.format(results[0]))
-        rideData = results[0][0]
+def fetchRideVersion(rideId):
+    """
+    Return the version of the ride for its ETag (see selectRideVersion), or None
+    if there is no such ride.
+    """
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+    cur = conn.cursor()
+    version = selectRideVersion(cur, rideId)
+    conn.commit()
+    cur.close()
+    return version
 
+def fetchRide(rideId, rideLineColumn):
+    """
+    Get the GeoJSON for the ride as JSON text, or None if not found (see
+    selectRideJson).
+    """
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+    cur = conn.cursor()
+    rideJson = selectRideJson(cur, rideId, rideLineColumn)
     conn.commit()
     cur.close()
 
-    return rideData
+    return rideJson
+
+def parseSimplifyParameters(queryParameters):
+    """
+    Return (tolerance, zoom) from the optional query parameters 'tolerance'
+    (float meters) and 'zoom' (int web map zoom level), where each is None if
+    not given. Raise ValueError for a bad format.
+    """
+    tolerance = None
+    zoom = None
+    if 'tolerance' in queryParameters:
+        tolerance = float(queryParameters['tolerance'])
+        if not tolerance >= 0:
+            raise ValueError('Bad tolerance ' + queryParameters['tolerance'])
+    if 'zoom' in queryParameters:
+        zoom = int(queryParameters['zoom'])
+        if zoom < 0 or zoom > 24:
+            raise ValueError('Bad zoom ' + queryParameters['zoom'])
+    return (tolerance, zoom)
+
+def parseTileParameters(pathParameters):
+    """
+    Return (z, x, y) for the tile path parameters. Raise ValueError if they
+    are not integers or the tile does not exist.
+    """
+    z = int(pathParameters['z'])
+    x = int(pathParameters['x'])
+    # Allow a file extension such as '.mvt' or '.pbf'.
+    y = int(pathParameters['y'].split('.')[0])
+    if z < 0 or z > maxTileZoom or x < 0 or x >= 2**z or y < 0 or y >= 2**z:
+        raise ValueError('Bad tile {}/{}/{}'.format(z, x, y))
+    return (z, x, y)
+
+def parsePageParameters(queryParameters):
+    """
+    Return (limit, cursor) from the optional query parameters 'limit' (int from
+    1 to maxPageSize) and 'cursor' (from makePageCursor), where each is None if
+    not given and cursor is decoded to (startTime, rideId). Raise ValueError for
+    a bad format.
+    """
+    limit = None
+    cursor = None
+    if 'limit' in queryParameters:
+        limit = int(queryParameters['limit'])
+        if limit < 1 or limit > maxPageSize:
+            raise ValueError('Bad limit ' + queryParameters['limit'])
+    if 'cursor' in queryParameters:
+        encoded = urllib.parse.unquote(queryParameters['cursor'])
+        try:
+            startTime, rideId = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            cursor = (datetime.fromisoformat(startTime), str(rideId))
+        except Exception:
+            raise ValueError('Bad cursor ' + queryParameters['cursor'])
+        if cursor[0].tzinfo == None:
+            raise ValueError('Bad cursor ' + queryParameters['cursor'])
+    return (limit, cursor)
+
+def makePageCursor(startTime, rideId):
+    """
+    Return the opaque 'cursor' for the page after the ride with startTime (ISO
+    string with the UTC offset) and rideId.
+    """
+    return base64.urlsafe_b64encode(json.dumps([startTime, rideId]).encode()).decode().rstrip('=')
 
 def parseDatetime(ss):
     try:
@@ -168,59 +296,102 @@ def parseDatetime(ss):
     except:
         return None
 
-def queryRidesSimple(startTime, endTime, region, organization, requireFlow):
+# The /ride/query filters as prepared statement parameters: $1 startTime, $2
+# endTime, $3 region (or NULL), $4 organization (or NULL), $5 requireFlow and
+# the page cursor $6 startTime and $7 rideId (or NULL for the first page). The
+# rides are paged in the order of rideOrderSql, and $8 is the LIMIT (NULL for
+# all). Without OR for the cursor, the row comparison is an index condition of
+# the Rides index on ("startTime", "rideId") even in a generic plan, so a page
+# reads about $8 index entries.
+rideFilterSql = """ride."startTime" BETWEEN $1 AND $2 AND ($3::text IS NULL OR ride.region = $3) AND
+                         ($4::text IS NULL OR ride.organization = $4) AND ($5 = False OR ride.flow IS NOT NULL) AND
+                         (ride."startTime", ride."rideId") < (COALESCE($6, 'infinity'), COALESCE($7, ''))"""
+rideOrderSql = 'ride."startTime" DESC, ride."rideId" DESC'
+rideFilterTypes = ['timestamptz', 'timestamptz', 'text', 'text', 'boolean', 'timestamptz', 'text', 'bigint']
+
+def getRideFilterParameters(startTime, endTime, region, organization, requireFlow, limit, cursor):
+    """
+    Return the parameters for rideFilterSql, where limit and cursor are as
+    from parsePageParameters. Fetch one more ride than limit to find out if
+    there is a next page.
+    """
+    cursorStartTime, cursorRideId = cursor if cursor != None else (None, None)
+    return [startTime.astimezone(), endTime.astimezone(), region, organization, requireFlow,
+            cursorStartTime, cursorRideId, limit + 1 if limit != None else None]
+
+declarePreparedStatement('query_rides_simple', """
+            SELECT ride."rideId", ride."startTime"
+            FROM {0} as ride
+            WHERE {1}
+            ORDER BY {2}
+            LIMIT $8
+          """.format(CibicResources.Postgres.Rides, rideFilterSql, rideOrderSql), rideFilterTypes)
+
+# The version reads the "updatedTime" of the rides of the page only (of the
+# whole range without 'limit', which the reply reads anyway). The latest user
+# enrollment is the last entry of its "updatedTime" index (migration 9).
+declarePreparedStatement('query_rides_version', """
+            SELECT COUNT(*), md5(string_agg(ride."rideId", ',' ORDER BY ride."rideId")),
+                   MAX(ride."updatedTime"), MAX(geometry."updatedTime"),
+                   (SELECT MAX("updatedTime") FROM {2})
+            FROM (SELECT ride."rideId", ride."updatedTime"
+                  FROM {0} AS ride
+                  WHERE {3}
+                  ORDER BY {4}
+                  LIMIT $8) AS ride
+            LEFT JOIN {1} AS geometry
+            ON ride."rideId" = geometry."rideId"
+          """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry,
+                     CibicResources.Postgres.UserEnrollments, rideFilterSql, rideOrderSql), rideFilterTypes)
+
+def queryRidesVersion(startTime, endTime, region, organization, requireFlow, limit, cursor):
+    """
+    Return the version of the /ride/query result for its ETag: (count of the
+    rides, digest of their rideIds, latest "updatedTime" of the rides, of their
+    RideGeometry and of the user enrollments for the display names). A changed,
+    added or deleted ride changes the version.
+    """
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+    cur = conn.cursor()
+    executePreparedStatement(cur, 'query_rides_version',
+                             getRideFilterParameters(startTime, endTime, region, organization, requireFlow,
+                                                     limit, cursor))
+    version = tuple(cur.fetchone())
+    conn.commit()
+    cur.close()
+    return version
+
+def queryRidesSimple(startTime, endTime, region, organization, requireFlow, limit, cursor):
     """
     Get only the rideId where startTime is between startTime and endTime.
     If region is not None, restrict to the region.
     If organization is not None, restrict to the organization.
     if requireFlow is True, restrict to rides where the flow is not NULL.
+    limit and cursor are as from parsePageParameters. Return (rides, nextCursor)
+    where nextCursor is None if there are no more rides.
     """
-    extraWhere = ''
-    if region != None:
-        extraWhere += " AND ride.region = '{}'".format(region)
-    if organization != None:
-        extraWhere += " AND ride.organization = '{}'".format(organization)
-    if requireFlow:
-        extraWhere += " AND ride.flow IS NOT NULL"
-
-    sql = """
-            SELECT ride."rideId"
-            FROM {0} as ride
-            WHERE ride."startTime" BETWEEN '{1}' AND '{2}' {3}
-          """.format(CibicResources.Postgres.Rides,
-                     startTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"),
-                     endTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"), extraWhere)
-    conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                        user=pgUsername, password=pgPassword)
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
     cur = conn.cursor()
-    cur.execute(sql)
+    executePreparedStatement(cur, 'query_rides_simple',
+                             getRideFilterParameters(startTime, endTime, region, organization, requireFlow,
+                                                     limit, cursor))
 
     rides = []
     for r in cur.fetchall():
+        if limit != None and len(rides) == limit:
+            break
         rides.append(r[0])
+        # The cursor after this ride, for the next page if there are more rides.
+        nextCursor = makePageCursor(r[1].isoformat(), r[0])
+    else:
+        nextCursor = None
     conn.commit()
     cur.close()
 
-    return rides
+    return (rides, nextCursor)
 
 
-def queryRidesRich(startTime, endTime, region, organization, requireFlow):
-    """
-    Get the full GeoJSON for the rides where startTime is between startTime and endTime.
-    If region is not None, restrict to the region.
-    If organization is not None, restrict to the organization.
-    if requireFlow is True, restrict to rides where the flow is not NULL.
-    """
-    extraWhere = ''
-    if region != None:
-        extraWhere += " AND ride.region = '{}'".format(region)
-    if organization != None:
-        extraWhere += " AND ride.organization = '{}'".format(organization)
-    if requireFlow:
-        extraWhere += " AND ride.flow IS NOT NULL"
-
-    sql = """
-            SET TIME ZONE 'America/Los_Angeles';
+queryRidesRichSql = """
             SELECT json_build_object(
                      'type', 'FeatureCollection',
                      'features', array_to_json(feature_list),
@@ -247,7 +418,7 @@ def queryRidesRich(startTime, endTime, region, organization, requireFlow):
                                      'organization', organization,
                                      'flowPath', flow_path
                                    )
-                   )
+                   )::text, rid, start_time
             FROM (SELECT array[json_build_object(
                                 'type', 'Feature',
                                 'geometry', ST_AsGeoJSON(start_zone)::json
@@ -260,7 +431,7 @@ def queryRidesRich(startTime, endTime, region, organization, requireFlow):
                                 'type', 'Feature',
                                 'geometry', json_build_object(
                                               'type', 'LineString',
-                                              'coordinates', array_to_json(ride_line)
+                                              'coordinates', ride_line
                                             ))
                                ] AS feature_list,
                                json_build_object(
@@ -271,8 +442,8 @@ def queryRidesRich(startTime, endTime, region, organization, requireFlow):
                                inferred_pod, inferred_pod_name, weather_json, region, organization
                   FROM (SELECT ride."startZone" AS start_zone,
                                ride."endZone" AS end_zone,
-                               wp.ride_line,
-                               flow_wp.flow_line,
+                               geometry."{4}" AS ride_line,
+                               geometry."flowLine" AS flow_line,
                                ride."rideId" AS rid,
                                ride."startTime" AS start_time,
                                ride."endTime" AS end_time,
@@ -293,35 +464,147 @@ def queryRidesRich(startTime, endTime, region, organization, requireFlow):
                                ride."weatherJson" AS weather_json,
                                ride."region" AS region,
                                ride."organization" AS organization
-                         FROM {0} AS ride
-                         LEFT JOIN (SELECT "rideId",
-                                       array_agg("pointJson" ORDER BY "idx") AS ride_line
-                                    FROM {1}
-                                    WHERE zone = 'main'
-                                    GROUP BY "rideId") AS wp
-                         ON ride."rideId" = wp."rideId"
-                         LEFT JOIN (SELECT "rideId", ST_MakeLine(array_agg(coordinate::geometry ORDER BY "idx")) AS flow_line
-                                    FROM {2}
-                                    GROUP BY "rideId") AS flow_wp
-                         ON ride."rideId" = flow_wp."rideId"
-                         LEFT JOIN (SELECT "userId", "displayName" from {6}) AS users
+                         FROM (SELECT * FROM {0} AS ride
+                               WHERE {2}
+                               ORDER BY {5}
+                               LIMIT $8) AS ride
+                         LEFT JOIN {1} AS geometry
+                         ON ride."rideId" = geometry."rideId"
+                         LEFT JOIN (SELECT "userId", "displayName" from {3}) AS users
                          ON ride."userId" = users."userId"
-                         WHERE ride."startTime" BETWEEN '{3}' AND '{4}' {5}
-						             ORDER BY ride."startTime" DESC
+                         ORDER BY {5}
                        ) AS geo
                  ) AS feature_collection;
-          """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.WaypointsRaw, CibicResources.Postgres.RideFlowWaypoints,
-                    startTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"),
-                    endTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"), extraWhere, CibicResources.Postgres.UserEnrollments)
-    conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                            user=pgUsername, password=pgPassword)
-    cur = conn.cursor()
-    cur.execute(sql)
+          """
+for level, column in RideLineLevels:
+    declarePreparedStatement('query_rides_rich_' + column.lower(),
+                             queryRidesRichSql.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry,
+                                                      rideFilterSql, CibicResources.Postgres.UserEnrollments,
+                                                      column, rideOrderSql),
+                             rideFilterTypes, timeZonePreamble)
 
-    rides = []
-    for r in cur.fetchall():
-        rides.append(r[0])
+def queryRidesRich(startTime, endTime, region, organization, requireFlow, rideLineColumn,
+                   limit, cursor, paged):
+    """
+    Get the full GeoJSON for the rides where startTime is between startTime and endTime.
+    rideLineColumn is the RideGeometry column for the ride line (see getRideLineColumn).
+    If region is not None, restrict to the region.
+    If organization is not None, restrict to the organization.
+    if requireFlow is True, restrict to rides where the flow is not NULL.
+    limit and cursor are as from parsePageParameters.
+    Return (ridesJson, nextCursor) where ridesJson is the JSON text of the array
+    of ride FeatureCollections (latest first) and nextCursor is None if there
+    are no more rides. The rides are read from a server-side cursor and their
+    JSON text (built by Postgres) is written to the array as it arrives, without
+    decoding it. If the JSON would exceed maxReplyBytes, stop. If
+    paged, the client gets the remaining rides with nextCursor. Otherwise, end
+    the array with {"type": "Continuation", "cursor": <cursor after the last
+    ride>, "endTime": <startTime of the next ride>} so that the client can query
+    the remaining rides with that cursor (as a paged query). The endTime is for
+    older clients, which get the rides at exactly endTime again.
+    """
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+    cur = conn.cursor(name='query_rides_rich')
+    cur.itersize = richQueryFetchSize if limit == None else min(richQueryFetchSize, limit + 1)
+    executePreparedStatement(cur, 'query_rides_rich_' + rideLineColumn.lower(),
+                             getRideFilterParameters(startTime, endTime, region, organization, requireFlow,
+                                                     limit, cursor))
+
+    # Leave room for the continuation and the closing bracket.
+    continuationBytes = 200
+    buffer = tempfile.SpooledTemporaryFile(max_size=richQuerySpoolBytes, mode='w+')
+    buffer.write('[')
+    size = 1
+    count = 0
+    for rideJson, rideId, rideStartTime in cur:
+        # The text from Postgres is not ASCII-escaped, so count the UTF-8 bytes.
+        rideBytes = len(rideJson.encode('utf-8'))
+        if count > 0 and ((limit != None and count == limit) or
+                          size + 2 + rideBytes + continuationBytes > maxReplyBytes):
+            if paged:
+                print('stopped at {} bytes, next cursor {}'.format(size, nextCursor))
+            else:
+                continuation = {'type': 'Continuation', 'cursor': nextCursor,
+                                'endTime': rideStartTime.isoformat()}
+                nextCursor = None
+                buffer.write(', ' + json.dumps(continuation))
+                print('stopped at {} bytes, continuation {}'.format(size, continuation))
+            break
+        if count > 0:
+            buffer.write(', ')
+            size += 2
+        buffer.write(rideJson)
+        size += rideBytes
+        count += 1
+        # The cursor after this ride, for the next page if there are more rides.
+        nextCursor = makePageCursor(rideStartTime.isoformat(), rideId)
+    else:
+        nextCursor = None
+    buffer.write(']')
+    cur.close()
+    conn.commit()
+
+    print('fetched {} rides'.format(count))
+    buffer.seek(0)
+    ridesJson = buffer.read()
+    buffer.close()
+    return (ridesJson, nextCursor)
+
+# The tile query with the /ride/query filters (see rideFilterSql, without a
+# cursor or limit) and $9 z, $10 x, $11 y of the tile. Filter with the tile
+# bounds in 4326 so that the GIST index on "rideLine" is used, then clip and
+# quantize to the tile in web mercator.
+declarePreparedStatement('query_ride_tile', """
+            WITH bounds AS (
+              SELECT ST_TileEnvelope($9, $10, $11) AS geom,
+                     ST_Transform(ST_TileEnvelope($9, $10, $11), 4326) AS geom4326
+            ),
+            rides AS (
+              SELECT ride."rideId", ride.role, ride.flow, ride.region, ride.organization
+                FROM {0} AS ride
+                WHERE {2}
+            ),
+            ride_lines AS (
+              SELECT rides.*,
+                     ST_AsMVTGeom(ST_Transform(geometry."rideLine", 3857), bounds.geom) AS geom
+                FROM rides
+                JOIN {1} AS geometry ON rides."rideId" = geometry."rideId"
+                CROSS JOIN bounds
+                WHERE geometry."rideLine" && bounds.geom4326
+            ),
+            flow_lines AS (
+              SELECT rides.*,
+                     ST_AsMVTGeom(ST_Transform(geometry."flowLine", 3857), bounds.geom) AS geom
+                FROM rides
+                JOIN {1} AS geometry ON rides."rideId" = geometry."rideId"
+                CROSS JOIN bounds
+                WHERE geometry."flowLine" && bounds.geom4326
+            )
+            SELECT COALESCE((SELECT ST_AsMVT(ride_lines, 'rides', 4096, 'geom')
+                               FROM ride_lines WHERE geom IS NOT NULL), ''::bytea) ||
+                   COALESCE((SELECT ST_AsMVT(flow_lines, 'flows', 4096, 'geom')
+                               FROM flow_lines WHERE geom IS NOT NULL), ''::bytea)
+          """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry, rideFilterSql),
+                         rideFilterTypes + ['integer', 'integer', 'integer'])
+
+def queryRideTile(z, x, y, startTime, endTime, region, organization, requireFlow):
+    """
+    Get the Mapbox Vector Tile (bytes) for the web map tile z/x/y with the ride
+    lines and flow lines of the rides where startTime is between startTime and
+    endTime. The 'rides' layer is from RideGeometry "rideLine" and the 'flows'
+    layer is from RideGeometry "flowLine". Each feature has the ride properties
+    rideId, role, flow, region and organization.
+    If region is not None, restrict to the region.
+    If organization is not None, restrict to the organization.
+    if requireFlow is True, restrict to rides where the flow is not NULL.
+    """
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+    cur = conn.cursor()
+    executePreparedStatement(cur, 'query_ride_tile',
+                             getRideFilterParameters(startTime, endTime, region, organization, requireFlow,
+                                                     None, None) + [z, x, y])
+    tile = bytes(cur.fetchone()[0])
     conn.commit()
     cur.close()
 
-    return rides
+    return tile
@@ -0,0 +1,67 @@
+# This lambda fills RideGeometry for rides which were ingested before the ride
+# lines were precomputed, whose row is missing or whose row has no flow line,
+# point count and bounding box yet (rows written before those columns). It can run periodically or
+# be invoked by hand until it reports that no rides are left. Each run handles
+# at most ENV_VAR_BACKFILL_BATCH_SIZE rides.
+
+from common.cibic_common import *
+import os
+
+pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
+pgUsername = os.environ['ENV_VAR_POSTGRES_USER']
+pgPassword = os.environ['ENV_VAR_POSTGRES_PASSWORD']
+pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
+batchSize = int(os.environ['ENV_VAR_BACKFILL_BATCH_SIZE']) if 'ENV_VAR_BACKFILL_BATCH_SIZE' in os.environ else 200
+
+def lambda_handler(event, context):
+    try:
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+        cur = conn.cursor()
+
+        # Get the rides which don't have a (complete) ride geometry yet. "pointCount"
+        # is set for every row written by insertRideGeometry.
+        sql = """
+SELECT ride."rideId"
+  FROM {0} AS ride
+  LEFT JOIN {1} AS geometry ON ride."rideId" = geometry."rideId"
+  WHERE geometry."rideId" IS NULL OR geometry."pointCount" IS NULL
+  ORDER BY ride."startTime" DESC
+  LIMIT %s;
+        """.format(CibicResources.Postgres.Rides, CibicResources.Postgres.RideGeometry)
+        cur.execute(sql, (batchSize,))
+        rideIds = [row[0] for row in cur.fetchall()]
+        print('backfilling ride geometry for {} rides'.format(len(rideIds)))
+
+        for rideId in rideIds:
+            sql = """
+SELECT ST_Y(coordinate::geometry), ST_X(coordinate::geometry), "pointJson"::text
+  FROM {0}
+  WHERE "rideId" = %s AND zone = 'main'
+  ORDER BY "idx";
+            """.format(CibicResources.Postgres.WaypointsRaw)
+            cur.execute(sql, (rideId,))
+            waypoints = cur.fetchall()
+            sql = """
+SELECT ST_Y(coordinate::geometry), ST_X(coordinate::geometry)
+  FROM {0}
+  WHERE "rideId" = %s
+  ORDER BY "idx";
+            """.format(CibicResources.Postgres.RideFlowWaypoints)
+            cur.execute(sql, (rideId,))
+            flowWaypoints = cur.fetchall()
+            insertRideGeometry(cur, rideId,
+                               [waypoint[0] for waypoint in waypoints],
+                               [waypoint[1] for waypoint in waypoints],
+                               [waypoint[2] for waypoint in waypoints],
+                               [waypoint[0] for waypoint in flowWaypoints],
+                               [waypoint[1] for waypoint in flowWaypoints])
+            # Commit each ride so that a timeout keeps the finished rides.
+            conn.commit()
+
+        cur.close()
+    except:
+        err = reportError()
+        print('caught exception:', sys.exc_info()[0])
+        return lambdaReply(420, str(err))
+
+    return lambdaReply(200, {'backfilled': len(rideIds), 'done': len(rideIds) < batchSize})
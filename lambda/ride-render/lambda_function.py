@@ -0,0 +1,76 @@
+# This lambda renders the /ride/get GeoJSON of a ride into the RideGeoJson object
+# store (see renderRideGeoJson), so that ride-geo-data-api-access reads the
+# object instead of querying Postgres. It is triggered by the new ride ready SNS
+# (from wp-snap and fetch-ridewithgps). infer-pod renders the rides again when
+# it updates them.
+# To render the existing rides, invoke with { "action": "backfill" } and then
+# with { "action": "backfill", "cursor": <the "cursor" of the reply> } until the
+# reply has "done": true. Each run renders at most ENV_VAR_BACKFILL_BATCH_SIZE
+# rides, latest first.
+
+from common.cibic_common import *
+import os
+
+pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
+pgUsername = os.environ['ENV_VAR_POSTGRES_USER']
+pgPassword = os.environ['ENV_VAR_POSTGRES_PASSWORD']
+pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
+batchSize = int(os.environ['ENV_VAR_BACKFILL_BATCH_SIZE']) if 'ENV_VAR_BACKFILL_BATCH_SIZE' in os.environ else 200
+
+rideGeoJsonStore = makeObjectStore(CibicResources.S3Bucket.RideGeoJson)
+
+# SNS message expected payload:
+# { "id": "<ride-id>", "requestId": "<request-id>", "rideData": {} }
+def lambda_handler(event, context):
+    try:
+        conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
+        cur = conn.cursor()
+
+        if 'Records' in event:
+            for rec in event['Records']:
+                payload = json.loads(rec['Sns']['Message'])
+                if 'id' in payload:
+                    if not renderRideGeoJson(cur, rideGeoJsonStore, str(payload['id'])):
+                        print('no ride with id {} found'.format(payload['id']))
+                    conn.commit()
+            cur.close()
+            return processedReply()
+
+        if event.get('action') == 'backfill':
+            rideIds, cursor = selectRides(cur, event.get('cursor'))
+            print('rendering ride GeoJSON for {} rides'.format(len(rideIds)))
+            for rideId in rideIds:
+                renderRideGeoJson(cur, rideGeoJsonStore, rideId)
+                conn.commit()
+            cur.close()
+            return lambdaReply(200, {'rendered': len(rideIds), 'cursor': cursor,
+                                     'done': len(rideIds) < batchSize})
+
+        cur.close()
+        return malformedMessageReply()
+    except:
+        err = reportError()
+        print('caught exception:', sys.exc_info()[0])
+        return lambdaReply(420, str(err))
+    finally:
+        printPreparedStatementStats()
+
+def selectRides(cur, cursor):
+    """
+    Return (rideIds, cursor) of the next batch of rides, latest first, after the
+    cursor (None for the first batch). The cursor is [startTime, rideId] of the
+    last ride as JSON compatible values.
+    """
+    sql = """
+SELECT "rideId", "startTime"
+  FROM {0}
+  WHERE ("startTime", "rideId") < (COALESCE(%s::timestamptz, 'infinity'), COALESCE(%s, ''))
+  ORDER BY "startTime" DESC, "rideId" DESC
+  LIMIT %s;
+    """.format(CibicResources.Postgres.Rides)
+    cursorStartTime, cursorRideId = cursor if cursor != None else (None, None)
+    cur.execute(sql, (cursorStartTime, cursorRideId, batchSize))
+    rows = cur.fetchall()
+    if len(rows) == 0:
+        return ([], cursor)
+    return ([row[0] for row in rows], [rows[-1][1].isoformat(), rows[-1][0]])
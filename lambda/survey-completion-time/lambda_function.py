@@ -2,7 +2,8 @@
 # table for raw survey data, and gets the maximum timestamp for the userId/role
 # along with the associated surveyId. It also fetches the outstanding survey CSV
 # (or the initial survey CSV if the user has not completed a survey)
-# and finds the latest entry where the role matches or is "*".
+# and finds the latest entry where the role matches or is "*". The parsed CSVs
+# are cached in the container and revalidated after ENV_VAR_SURVEY_CATALOG_TTL.
 # Return a JSON dictionary with completionTime, surveyId, availableSurveyId and
 # availableSurveyUrl, where each of these is "" if not found.
 
@@ -17,6 +18,14 @@ import requests
 
 initialSurveysUrl = os.environ['ENV_VAR_INITIAL_SURVEYS_URL']
 outstandingSurveysUrl = os.environ['ENV_VAR_OUTSTANDING_SURVEYS_URL']
+# Seconds to use a cached survey catalog before revalidating it.
+surveyCatalogTtl = int(os.environ['ENV_VAR_SURVEY_CATALOG_TTL']) if 'ENV_VAR_SURVEY_CATALOG_TTL' in os.environ else 300
+# Seconds to wait for the survey CSV server before using the cached catalog.
+surveyFetchTimeout = 10
+
+# The parsed survey CSV of each URL in this lambda container: URL ->
+# {'latestByRole', 'etag', 'lastModified', 'checkedTime'} (see getSurveyCatalog).
+surveyCatalogs = {}
 
 dynamoDbResource = boto3.resource('dynamodb')
 
@@ -72,27 +81,82 @@ def lambda_handler(event, context):
 
 def getAvailableSurvey(surveysUrl, role):
     """
-    Fetch the survey CSV from surveysUrl and find the latest entry where the role
-    matches the given role or is "*".
+    Get the survey catalog from surveysUrl (see getSurveyCatalog) and find the
+    latest entry where the role matches the given role or is "*".
     Return a dictionary where availableSurveyId and availableSurveyUrl are the
     survey ID and URL for the role, or empty strings if not found.
     """
     availableSurveyId = ''
     availableSurveyUrl = ''
 
-    response = requests.get(surveysUrl, stream = True)
-    if response.status_code/100 == 2:
-        # Get the text and remove CR.
-        csv = response.raw.read().decode("utf-8").replace('\r', '')
-
-        for line in csv.split('\n'):
-            fields = line.split(',')
-            # The fields should be: order,survey id,role,url
-            if fields[2] == '*' or fields[2] == role:
-                availableSurveyId = fields[1]
-                availableSurveyUrl = fields[3]
+    catalog = getSurveyCatalog(surveysUrl)
+    if catalog != None:
+        latest = max([catalog['latestByRole'].get(role, (-1, '', '')),
+                      catalog['latestByRole'].get('*', (-1, '', ''))])
+        availableSurveyId = latest[1]
+        availableSurveyUrl = latest[2]
+
+    return { 'availableSurveyId': availableSurveyId,
+             'availableSurveyUrl': availableSurveyUrl }
+
+def getSurveyCatalog(surveysUrl):
+    """
+    Return the survey catalog for the survey CSV at surveysUrl from
+    surveyCatalogs. Fetch the CSV if it is not cached, and revalidate it with
+    If-None-Match/If-Modified-Since if it was fetched more than surveyCatalogTtl
+    seconds ago. If the fetch fails (including a timeout or connection error),
+    use the cached catalog if any (and revalidate it again after
+    surveyCatalogTtl), otherwise return None.
+    """
+    catalog = surveyCatalogs.get(surveysUrl)
+    now = time.monotonic()
+    if catalog != None and now - catalog['checkedTime'] < surveyCatalogTtl:
+        print('survey catalog {} is cached'.format(surveysUrl))
+        return catalog
+
+    headers = {}
+    if catalog != None:
+        if catalog['etag'] != None:
+            headers['If-None-Match'] = catalog['etag']
+        if catalog['lastModified'] != None:
+            headers['If-Modified-Since'] = catalog['lastModified']
+    try:
+        response = requests.get(surveysUrl, headers = headers, stream = True, timeout = surveyFetchTimeout)
+        if response.status_code/100 == 2:
+            # Get the text and remove CR.
+            csv = response.raw.read().decode("utf-8").replace('\r', '')
+    except Exception:
+        reportError()
+        print('Available surveys get failed, using the cached catalog: {}'.format(catalog != None))
+        if catalog != None:
+            catalog['checkedTime'] = now
+        return catalog
+
+    if response.status_code == 304 and catalog != None:
+        print('survey catalog {} is not modified'.format(surveysUrl))
+        catalog['checkedTime'] = now
+    elif response.status_code/100 == 2:
+        catalog = {
+          'latestByRole': parseSurveyCatalog(csv),
+          'etag': response.headers.get('ETag'),
+          'lastModified': response.headers.get('Last-Modified'),
+          'checkedTime': now
+        }
+        surveyCatalogs[surveysUrl] = catalog
+        print('fetched survey catalog {}'.format(surveysUrl))
     else:
         print('Available surveys get failed with code {}'.format(response.status_code))
+    return catalog
 
-    return { 'availableSurveyId': availableSurveyId,
-             'availableSurveyUrl': availableSurveyUrl }
\ No newline at end of file
+def parseSurveyCatalog(csv):
+    """
+    Return a dictionary where the key is a role (or "*") and the value is
+    (line number, survey id, url) of the last line of the survey CSV for it.
+    """
+    latestByRole = {}
+    for lineNumber, line in enumerate(csv.split('\n')):
+        fields = line.split(',')
+        # The fields should be: order,survey id,role,url
+        if len(fields) >= 4:
+            latestByRole[fields[2]] = (lineNumber, fields[1], fields[3])
+    return latestByRole
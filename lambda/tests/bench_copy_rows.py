@@ -0,0 +1,121 @@
+# Benchmark of loading the raw waypoints of a 20,000-point ride with copyRows
+# (COPY FROM STDIN) against psycopg2 execute_values (INSERT ... VALUES pages of
+# 100 rows), which wp-process used before. Without Postgres, it compares the
+# client side only: the bytes sent, the time to build them and the peak memory.
+# With the ENV_VAR_POSTGRES_* environment variables of a database which has the
+# WaypointsRaw table, it also times both into a temporary copy of the table.
+# Not a test, so unittest discover skips it. Run from the lambda folder with:
+# python tests/bench_copy_rows.py
+
+import os
+import sys
+import time
+import tracemalloc
+
+import psycopg2.extensions
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.cibic_common import (CibicResources, CopyRowStream, WaypointArray, copyBufferSize,
+                                 copyRows, getPostgresConnection, nanToNone)
+
+pointCount = 20000
+pageSize = 100
+columns = ['rideId', 'coordinate', 'timestamp', 'roadType', 'speed', 'distance', 'speedLimit',
+           'idx', 'zone', 'requestId', 'pointJson']
+
+def makeWaypoints():
+    """
+    Return a WaypointArray of pointCount waypoints with all the columns set.
+    """
+    waypoints = WaypointArray()
+    for i in range(pointCount):
+        waypoints.append(34.0 + i * 1e-5, -118.2 + i * 1e-5, 1637215841000 + i * 1000,
+                         5.0 + i % 7, float(i), 50.0, 'residential')
+        waypoints.idx[i] = i
+    return waypoints
+
+def makeRows(waypoints):
+    """
+    Yield the WaypointsRaw rows of the waypoints as insertRawWaypoints does.
+    """
+    for i in range(len(waypoints)):
+        timestamp = waypoints.isoTimestamp(i)
+        yield ('bench-ride', '{}, {}'.format(waypoints.longitude[i], waypoints.latitude[i]),
+               timestamp, waypoints.roadTypeName(i), nanToNone(waypoints.speed[i]),
+               nanToNone(waypoints.distance[i]), nanToNone(waypoints.speedLimit[i]),
+               waypoints.idx[i], waypoints.zoneName(i), 'bench-request', waypoints.pointJson(i, timestamp))
+
+def buildInsertPages(waypoints):
+    """
+    Return the bytes of the INSERT statements which execute_values sends: the
+    list of all rows, then one statement per page with the quoted values.
+    """
+    rows = list(makeRows(waypoints))
+    sent = 0
+    for start in range(0, len(rows), pageSize):
+        values = [b'(' + b','.join(psycopg2.extensions.adapt(value).getquoted() for value in row) + b')'
+                  for row in rows[start:start + pageSize]]
+        sent += len(b'INSERT INTO t VALUES ' + b','.join(values))
+    return sent
+
+def buildCopyData(waypoints):
+    """
+    Return the bytes of the COPY data which copyRows sends.
+    """
+    stream = CopyRowStream(makeRows(waypoints))
+    sent = 0
+    while True:
+        data = stream.read(copyBufferSize)
+        if not data:
+            return sent
+        sent += len(data.encode())
+
+def benchClient(waypoints):
+    """
+    Print the bytes, the best time of three runs and the peak memory of
+    building the INSERT statements and the COPY data.
+    """
+    for function in (buildInsertPages, buildCopyData):
+        tracemalloc.start()
+        function(waypoints)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        times = []
+        for i in range(3):
+            start = time.perf_counter()
+            sent = function(waypoints)
+            times.append(time.perf_counter() - start)
+        print('client {}: {} bytes, {:.1f} ms, peak memory {:.1f} MB'.format(
+                function.__name__, sent, min(times) * 1000, peak / 1e6))
+
+def benchServer(waypoints):
+    """
+    Print the best time of three loads of the waypoints with execute_values and
+    with copyRows into a temporary table like WaypointsRaw. Roll back at the end.
+    """
+    conn = getPostgresConnection(os.environ['ENV_VAR_POSTGRES_SERVER'], os.environ['ENV_VAR_POSTGRES_DB'],
+                                 os.environ['ENV_VAR_POSTGRES_USER'], os.environ['ENV_VAR_POSTGRES_PASSWORD'])
+    cur = conn.cursor()
+    cur.execute('CREATE TEMP TABLE bench_waypoints_raw (LIKE {})'.format(CibicResources.Postgres.WaypointsRaw))
+    sql = 'INSERT INTO bench_waypoints_raw ({}) VALUES %s'.format(', '.join('"{}"'.format(c) for c in columns))
+    for name, insert in [('execute_values', lambda: psycopg2.extras.execute_values(cur, sql, makeRows(waypoints),
+                                                                                  page_size=pageSize)),
+                         ('copyRows', lambda: copyRows(cur, 'bench_waypoints_raw', columns, makeRows(waypoints)))]:
+        times = []
+        for i in range(3):
+            cur.execute('TRUNCATE bench_waypoints_raw')
+            start = time.perf_counter()
+            insert()
+            times.append(time.perf_counter() - start)
+        print('server {}: {:.1f} ms'.format(name, min(times) * 1000))
+    conn.rollback()
+    cur.close()
+
+if __name__ == '__main__':
+    waypoints = makeWaypoints()
+    benchClient(waypoints)
+    if 'ENV_VAR_POSTGRES_SERVER' in os.environ:
+        benchServer(waypoints)
+    else:
+        print('ENV_VAR_POSTGRES_SERVER is not set, skipping the Postgres timing')
@@ -0,0 +1,50 @@
+# Benchmark of the /ride/query rich reply body: decoding the JSON of each ride
+# (as the psycopg2 json typecaster did) and encoding the list again, against
+# joining the JSON text which Postgres built (see queryRidesRich). The rides are
+# 300 synthetic rides of 1500 points. Not a test, so unittest discover skips it.
+# Run from the lambda folder with: python tests/bench_json_passthrough.py
+
+import json
+import random
+import time
+import tracemalloc
+
+rideCount = 300
+pointCount = 1500
+
+def makeRideJsons():
+    """
+    Return the list of the JSON texts of the rides, as Postgres returns them.
+    """
+    rand = random.Random(1)
+    rideJsons = []
+    for i in range(rideCount):
+        coordinates = [[round(-118.3 + rand.random() * 0.1, 5), round(34.0 + rand.random() * 0.1, 5), 0,
+                        '2021-11-18T07:10:41.{:03d}-08:00'.format(j % 1000)] for j in range(pointCount)]
+        rideJsons.append(json.dumps({
+            'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': coordinates}}],
+            'properties': {'rideId': 'ride{}'.format(i), 'startTime': '2021-11-18T07:10:41-08:00',
+                           'weather': {'temperature': 12.5}}}))
+    return rideJsons
+
+def decodeEncode(rideJsons):
+    return json.dumps([json.loads(rideJson) for rideJson in rideJsons])
+
+def passthrough(rideJsons):
+    return '[' + ', '.join(rideJsons) + ']'
+
+if __name__ == '__main__':
+    rideJsons = makeRideJsons()
+    for function in (decodeEncode, passthrough):
+        times = []
+        for i in range(3):
+            start = time.process_time()
+            body = function(rideJsons)
+            times.append(time.process_time() - start)
+        tracemalloc.start()
+        function(rideJsons)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{}: body {:.1f} MB, CPU {:.1f} ms, peak memory {:.1f} MB'.format(
+                function.__name__, len(body) / 1e6, min(times) * 1000, peak / 1e6))
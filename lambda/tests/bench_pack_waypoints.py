@@ -0,0 +1,61 @@
+# Benchmark of the waypoints payload from ride-data-ingest to wp-process: the
+# gzip JSON ('waypoints_gz_b64') against the packed binary waypoints
+# ('waypoints_bin_b64', see packWaypoints). The rides are sample.json and a
+# long ride made of 40 shifted copies of it. Not a test, so unittest discover
+# skips it. Run from the lambda folder with: python tests/bench_pack_waypoints.py
+
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.cibic_common import WaypointArray, makeIsoTimestamp, packWaypoints, unpackWaypoints
+
+def timeMs(function, runs=5):
+    """
+    Return (result, milliseconds) of the average of runs calls of function.
+    """
+    start = time.perf_counter()
+    for i in range(runs):
+        result = function()
+    return (result, (time.perf_counter() - start) / runs * 1000)
+
+def makeLongRide(waypoints, copies):
+    """
+    Return the list of waypoint dicts of copies of the ride waypoints (dicts),
+    each 15 minutes later and 0.001 degrees north of the previous one.
+    """
+    timestamps = WaypointArray.fromDicts(waypoints).timestamp
+    ride = []
+    for copy in range(copies):
+        for i, waypoint in enumerate(waypoints):
+            waypoint = dict(waypoint)
+            waypoint['timestamp'] = makeIsoTimestamp(timestamps[i] + copy * 900000, 60)
+            waypoint['latitude'] = round(waypoint['latitude'] + copy * 0.001, 5)
+            ride.append(waypoint)
+    return ride
+
+def benchRide(name, ride):
+    """
+    Print the payload size and the encode and decode times of the ride (list of
+    waypoint dicts) in both formats.
+    """
+    (gzipJson, encodeMs) = timeMs(lambda: base64.b64encode(gzip.compress(json.dumps(ride).encode())))
+    (waypoints, decodeMs) = timeMs(lambda: WaypointArray.fromDicts(json.loads(gzip.decompress(base64.b64decode(gzipJson)))))
+    print('{} ({} points) gzip JSON: {} bytes, encode {:.1f} ms, decode to WaypointArray {:.1f} ms'.format(
+            name, len(ride), len(gzipJson), encodeMs, decodeMs))
+
+    (packed, encodeMs) = timeMs(lambda: base64.b64encode(packWaypoints(WaypointArray.fromDicts(ride))))
+    (result, packMs) = timeMs(lambda: packWaypoints(waypoints))
+    (unpacked, decodeMs) = timeMs(lambda: unpackWaypoints(base64.b64decode(packed)))
+    print('{} ({} points) packed: {} bytes, encode {:.1f} ms (packing {:.1f} ms), decode {:.1f} ms'.format(
+            name, len(ride), len(packed), encodeMs, packMs, decodeMs))
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample.json')) as f:
+        sample = json.load(f)['trajectoryData']['waypoints']
+    benchRide('sample.json', sample)
+    benchRide('long ride', makeLongRide(sample, 40))
@@ -0,0 +1,37 @@
+# Load the lambda_function module of a lambda folder for the tests, with the
+# environment variables it reads and the local object store.
+
+import importlib.util
+import re
+import os
+import sys
+import tempfile
+import types
+from unittest import mock
+
+LambdaRoot = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, LambdaRoot)
+
+def loadLambda(folder, environ=None):
+    """
+    Return the lambda_function module of the lambda folder. The ENV_VAR_* and
+    ENV_SNS_* variables which are not in environ are set to '1', and the
+    object stores use a new local folder (see ENV_VAR_LOCAL_OBJECT_STORE_DIR).
+    The requests layer is replaced if it is not installed, since the tests do
+    not call the external APIs.
+    """
+    env = {'AWS_DEFAULT_REGION': 'us-west-1',
+           'ENV_VAR_LOCAL_OBJECT_STORE_DIR': tempfile.mkdtemp(prefix='cibic21-test-')}
+    env.update(environ or {})
+    source = os.path.join(LambdaRoot, folder, 'lambda_function.py')
+    with open(source) as f:
+        for name in set(re.findall(r"os\.environ\['((?:ENV_VAR|ENV_SNS|ENV_LAMBDA)_[A-Z0-9_]+)'\]", f.read())):
+            env.setdefault(name, '1')
+    modules = {}
+    if importlib.util.find_spec('requests') == None:
+        modules['requests'] = types.ModuleType('requests')
+    with mock.patch.dict(os.environ, env), mock.patch.dict(sys.modules, modules):
+        spec = importlib.util.spec_from_file_location(folder.replace('-', '_'), source)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,41 @@
+# Tests of the claim check of large rides: ride-data-ingest puts the waypoints
+# in the RideWaypoints object store and wp-process reads them by key. The
+# object store is LocalObjectStore (see ENV_VAR_LOCAL_OBJECT_STORE_DIR).
+
+import json
+import os
+import tempfile
+import unittest
+
+from lambda_loader import LambdaRoot, loadLambda
+from common.cibic_common import LocalObjectStore
+
+class ClaimCheckTests(unittest.TestCase):
+    def setUp(self):
+        environ = {'ENV_VAR_LOCAL_OBJECT_STORE_DIR': tempfile.mkdtemp(prefix='cibic21-test-')}
+        self.rideDataIngest = loadLambda('ride-data-ingest', environ)
+        self.wpProcess = loadLambda('wp-process', environ)
+        with open(os.path.join(LambdaRoot, 'sample.json')) as f:
+            self.trajectoryData = json.load(f)['trajectoryData']
+
+    def testRoundTrip(self):
+        self.assertIsInstance(self.rideDataIngest.waypointsStore, LocalObjectStore)
+        waypointsData = self.rideDataIngest.makeWaypointsData(self.trajectoryData)
+        key = self.rideDataIngest.putWaypointsData('test-request', waypointsData)
+        self.assertEqual(key, 'waypoints/test-request.json.gz')
+
+        waypoints = self.wpProcess.decodeWaypoints({'waypoints_s3_key': key})
+        expected = self.wpProcess.decodeWaypoints(waypointsData)
+        self.assertEqual(len(waypoints), len(self.trajectoryData['waypoints']))
+        for name in ('latitude', 'longitude', 'timestamp', 'roadType'):
+            self.assertEqual(list(getattr(waypoints, name)), list(getattr(expected, name)))
+        self.assertEqual(waypoints.latitude[0], self.trajectoryData['waypoints'][0]['latitude'])
+
+        # wp-process deletes the object after it commits the ride.
+        self.wpProcess.waypointsStore.delete(key)
+        self.assertEqual(self.wpProcess.waypointsStore.getWithMetadata(key), None)
+        # Deleting again (for example on a retry) is not an error.
+        self.wpProcess.waypointsStore.delete(key)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# Regression tests for the batch geo math helpers of common/cibic_common.py,
+# which must agree with the scalar getGreatCircleDistance with and without
+# NumPy. getWithinRadius and splitWaypoints must classify the points near the
+# radius exactly as the comparison getGreatCircleDistance(...) <= radius.
+# Run from the lambda folder with: python -m unittest discover tests
+
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cibic_common
+
+def makePoints(count, seed):
+    """
+    Return (lats, lons) of a random walk in Los Angeles with some repeated
+    points, plus a few far away points.
+    """
+    rand = random.Random(seed)
+    lats = [34.05]
+    lons = [-118.25]
+    for i in range(count - 1):
+        if rand.random() < 0.1:
+            lats.append(lats[-1])
+            lons.append(lons[-1])
+        else:
+            lats.append(lats[-1] + rand.uniform(-0.001, 0.001))
+            lons.append(lons[-1] + rand.uniform(-0.001, 0.001))
+    lats.extend([-34.6, 0.0, 89.9])
+    lons.extend([-58.4, 179.9, -179.9])
+    return (lats, lons)
+
+def makeRadiusPoints(lat, lon, radius, count, seed):
+    """
+    Return (lats, lons) of random points around lat, lon at distances close to
+    radius meters (some within a tiny fraction of it), plus a few points well
+    inside and outside.
+    """
+    rand = random.Random(seed)
+    R = 6378.137 * 1000.0
+    lats = []
+    lons = []
+    for i in range(count):
+        if i % 4 == 0:
+            distance = radius * (1.0 + rand.uniform(-1e-9, 1e-9))
+        else:
+            distance = radius * rand.uniform(0.0, 2.0)
+        # The destination point at the distance along a random bearing.
+        bearing = rand.uniform(0.0, 2.0 * math.pi)
+        angle = distance / R
+        rLat = math.radians(lat)
+        lat2 = math.asin(math.sin(rLat) * math.cos(angle) +
+                         math.cos(rLat) * math.sin(angle) * math.cos(bearing))
+        lon2 = math.radians(lon) + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(rLat),
+                                              math.cos(angle) - math.sin(rLat) * math.sin(lat2))
+        lats.append(math.degrees(lat2))
+        lons.append((math.degrees(lon2) + 540.0) % 360.0 - 180.0)
+    return (lats, lons)
+
+class BatchDistanceTests():
+    """
+    The tests of the batch helpers. Subclasses set useNumpy.
+    """
+    useNumpy = None
+
+    def setUp(self):
+        self.numpy = cibic_common.numpy
+        if self.useNumpy:
+            if self.numpy is None:
+                self.skipTest('NumPy is not installed')
+        else:
+            cibic_common.numpy = None
+        (self.lats, self.lons) = makePoints(500, 1)
+
+    def tearDown(self):
+        cibic_common.numpy = self.numpy
+
+    def assertDistancesEqual(self, distances, expected):
+        self.assertEqual(len(distances), len(expected))
+        for distance, expectedDistance in zip(distances, expected):
+            self.assertIsInstance(distance, float)
+            self.assertAlmostEqual(distance, expectedDistance, delta=1e-6 * max(1.0, expectedDistance))
+
+    def testGreatCircleDistances(self):
+        lat = self.lats[0]
+        lon = self.lons[0]
+        expected = [cibic_common.getGreatCircleDistance(lat, lon, lat2, lon2)
+                    for lat2, lon2 in zip(self.lats, self.lons)]
+        self.assertDistancesEqual(cibic_common.getGreatCircleDistances(lat, lon, self.lats, self.lons), expected)
+        self.assertEqual(cibic_common.getGreatCircleDistances(lat, lon, self.lats, self.lons)[0], 0.0)
+
+    def testConsecutiveDistances(self):
+        expected = [cibic_common.getGreatCircleDistance(self.lats[i - 1], self.lons[i - 1], self.lats[i], self.lons[i])
+                    for i in range(1, len(self.lats))]
+        self.assertDistancesEqual(cibic_common.getConsecutiveDistances(self.lats, self.lons), expected)
+
+    def testCumulativeDistances(self):
+        expected = [0.0]
+        for i in range(1, len(self.lats)):
+            expected.append(expected[-1] + cibic_common.getGreatCircleDistance(
+                              self.lats[i - 1], self.lons[i - 1], self.lats[i], self.lons[i]))
+        self.assertDistancesEqual(cibic_common.getCumulativeDistances(self.lats, self.lons), expected)
+
+    def testEmptyAndSinglePoint(self):
+        self.assertEqual(cibic_common.getGreatCircleDistances(34.0, -118.0, [], []), [])
+        self.assertEqual(cibic_common.getConsecutiveDistances([], []), [])
+        self.assertEqual(cibic_common.getConsecutiveDistances([34.0], [-118.0]), [])
+        self.assertEqual(cibic_common.getCumulativeDistances([], []), [])
+        self.assertEqual(cibic_common.getCumulativeDistances([34.0], [-118.0]), [0.0])
+
+    def assertWithinRadiusExact(self, lat, lon, radius, lats, lons):
+        expected = [cibic_common.getGreatCircleDistance(lat, lon, lat2, lon2) <= radius
+                    for lat2, lon2 in zip(lats, lons)]
+        self.assertEqual(cibic_common.getWithinRadius(lat, lon, radius, lats, lons), expected)
+
+    def testWithinRadius(self):
+        radius = 100.0
+        for seed, (lat, lon) in enumerate([(34.05, -118.25), (-34.6, -58.4), (0.0, 179.9995),
+                                           (51.5, -179.9999), (89.9995, 10.0)]):
+            (lats, lons) = makeRadiusPoints(lat, lon, radius, 400, seed)
+            self.assertWithinRadiusExact(lat, lon, radius, lats, lons)
+        self.assertWithinRadiusExact(self.lats[0], self.lons[0], radius, self.lats, self.lons)
+
+    def testWithinRadiusOnBoundary(self):
+        # The radius is exactly the distance of the point, which is within it.
+        for lat, lon, lat2, lon2 in [(34.05, -118.25, 34.0505, -118.2495),
+                                     (0.0, 179.9995, 0.0003, -179.9998)]:
+            radius = cibic_common.getGreatCircleDistance(lat, lon, lat2, lon2)
+            self.assertEqual(cibic_common.getWithinRadius(lat, lon, radius, [lat2], [lon2]), [True])
+            self.assertEqual(cibic_common.getWithinRadius(lat, lon, math.nextafter(radius, 0.0),
+                                                          [lat2], [lon2]), [False])
+
+    def testSplitWaypoints(self):
+        # A ride across the antimeridian which starts and ends near the radius.
+        radius = 100.0
+        (lats, lons) = makeRadiusPoints(0.0, 179.9995, radius, 200, 7)
+        lats = [0.0] + lats + [0.0005]
+        lons = [179.9995] + lons + [-179.9995]
+        waypoints = cibic_common.WaypointArray()
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            waypoints.append(lat, lon, 1600000000000 + i * 1000)
+        (startZone, endZone, mainZone) = cibic_common.splitWaypoints(radius, waypoints)
+
+        inStart = [cibic_common.getGreatCircleDistance(lats[0], lons[0], lat, lon) <= radius
+                   for lat, lon in zip(lats, lons)]
+        inEnd = [cibic_common.getGreatCircleDistance(lats[-1], lons[-1], lat, lon) <= radius
+                 for lat, lon in zip(lats, lons)]
+        self.assertEqual(list(startZone.idx), [0] + [i for i in range(len(lats)) if inStart[i]])
+        self.assertEqual(list(endZone.idx), [i for i in range(len(lats)) if inEnd[i]] + [len(lats) - 1])
+        self.assertEqual(list(mainZone.idx), [i for i in range(len(lats)) if not inStart[i] and not inEnd[i]])
+
+class NumpyBatchDistanceTests(BatchDistanceTests, unittest.TestCase):
+    useNumpy = True
+
+class PythonBatchDistanceTests(BatchDistanceTests, unittest.TestCase):
+    useNumpy = False
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Tests of the packed binary waypoints sent from ride-data-ingest to wp-process.
+
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.cibic_common import (WaypointArray, packWaypoints, unpackWaypoints,
+                                 writeVarint, zigzag)
+
+def makeWaypoints():
+    waypoints = WaypointArray(utcOffsetMinutes=-420)
+    waypoints.append(34.0512345, -118.2498765, 1650000000000, 4.123456, 0.0, 11.176, 'road')
+    waypoints.append(34.0513456, -118.2497654, 1650000001000, None, 5.4321987, None, None)
+    waypoints.append(34.0514567, -118.2496543, 1650000002000, 0.000123, 12.9876543, 11.176, 'path')
+    return waypoints
+
+class PackWaypointsTests(unittest.TestCase):
+    def assertValuesEqual(self, values, expected, places):
+        self.assertEqual(len(values), len(expected))
+        for value, expectedValue in zip(values, expected):
+            if expectedValue != expectedValue:
+                self.assertTrue(math.isnan(value))
+            else:
+                self.assertAlmostEqual(value, expectedValue, places=places)
+
+    def testRoundTrip(self):
+        waypoints = makeWaypoints()
+        unpacked = unpackWaypoints(packWaypoints(waypoints))
+        self.assertEqual(len(unpacked), 3)
+        self.assertEqual(unpacked.utcOffsetMinutes, -420)
+        self.assertEqual(list(unpacked.timestamp), list(waypoints.timestamp))
+        self.assertValuesEqual(unpacked.latitude, waypoints.latitude, 6)
+        self.assertValuesEqual(unpacked.longitude, waypoints.longitude, 6)
+        # The measures keep 6 decimal places, not just centimeters.
+        for name in ('speed', 'distance', 'speedLimit'):
+            self.assertValuesEqual(getattr(unpacked, name), getattr(waypoints, name), 6)
+        self.assertEqual([unpacked.roadTypeName(i) for i in range(3)], ['road', None, 'path'])
+
+    def testVersion1(self):
+        # A version 1 message from ride-data-ingest deployed before wp-process.
+        data = bytearray(b'CBW\x01')
+        for value in (1, zigzag(0), 0, zigzag(34000000), zigzag(-118000000), zigzag(1650000000000),
+                      zigzag(412) + 1, 0, 0, 0):
+            writeVarint(data, value)
+        unpacked = unpackWaypoints(bytes(data))
+        self.assertEqual(list(unpacked.latitude), [34.0])
+        self.assertEqual(list(unpacked.speed), [4.12])
+        self.assertTrue(math.isnan(unpacked.distance[0]))
+        self.assertEqual(unpacked.roadTypeName(0), None)
+
+    def testTimestampFormat(self):
+        # The ISO timestamps are written as the app sent them, after packing too.
+        for timestamps in (['2021-11-18T06:10:41.411Z', '2021-11-18T06:10:42.000Z'],
+                           ['2021-11-18T07:10:41+01:00', '2021-11-18T07:10:42+01:00'],
+                           ['2021-11-18T06:10:41.123456Z', '2021-11-18T06:10:41.123457Z']):
+            waypoints = WaypointArray.fromDicts([{'latitude': 34.05, 'longitude': -118.25, 'timestamp': timestamp}
+                                                 for timestamp in timestamps])
+            for unpacked in (waypoints, unpackWaypoints(packWaypoints(waypoints))):
+                self.assertEqual([unpacked.isoTimestamp(i) for i in range(2)], timestamps)
+                self.assertEqual(unpacked.pointJson(0), '[-118.25, 34.05, 0, "{}"]'.format(timestamps[0]))
+            self.assertEqual(waypoints.take([1]).isoTimestamp(0), timestamps[1])
+
+    def testBadVersion(self):
+        with self.assertRaises(ValueError):
+            unpackWaypoints(b'CBW\x09')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# Tests of the wp-process route statistics for the compact trajectory, which
+# may come without speeds or road types.
+
+import json
+import unittest
+
+from lambda_loader import loadLambda
+from common.cibic_common import encodePolyline
+
+wpProcess = loadLambda('wp-process')
+
+class RouteStatsTests(unittest.TestCase):
+    def makePayload(self, speedDeltas=None):
+        latitudes = [34.05, 34.0505, 34.051, 34.0515]
+        longitudes = [-118.25, -118.2505, -118.251, -118.2515]
+        trajectory = {'encoded': encodePolyline(latitudes, longitudes),
+                      'timestampDeltas': [1650000000000, 1000, 1000, 1000],
+                      'utcOffset': -420}
+        if speedDeltas != None:
+            trajectory['speedDeltas'] = speedDeltas
+        return {'trajectory': trajectory}
+
+    def testTrajectoryWithoutSpeeds(self):
+        waypoints = wpProcess.decodeWaypoints(self.makePayload())
+        stats = wpProcess.processWaypoints(waypoints)
+        # The derived data SNS message must be valid JSON.
+        json.dumps(stats, allow_nan=False)
+        self.assertEqual(stats[0]['total']['avgSpeed'], None)
+        self.assertGreater(stats[0]['total']['totalDist'], 0)
+        self.assertEqual(list(stats[1].keys()), ['unknown'])
+        self.assertEqual(stats[1]['unknown']['avgSpeed'], None)
+
+    def testTrajectoryWithSpeeds(self):
+        waypoints = wpProcess.decodeWaypoints(self.makePayload([40, 10, 10, -20]))
+        stats = wpProcess.processWaypoints(waypoints)
+        json.dumps(stats, allow_nan=False)
+        self.assertAlmostEqual(stats[0]['total']['avgSpeed'], (4.0 + 5.0 + 6.0 + 4.0) / 4)
+
+    def testSomeSpeedsMissing(self):
+        waypoints = wpProcess.decodeWaypoints(self.makePayload([40, 10, 10, -20]))
+        waypoints.speed[1] = float('nan')
+        stats = wpProcess.getRouteStats(waypoints)
+        self.assertAlmostEqual(stats['avgSpeed'], (4.0 + 6.0 + 4.0) / 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# Tests of the snapped segment cache of wp-snap: the snapped waypoints of a ride
+# made from the cached segments must match those from the Roads API.
+
+import json
+import types
+import unittest
+import urllib.parse
+
+from lambda_loader import loadLambda
+
+class FakeCursor:
+    """
+    Cursor for the cache table statements, which finds no rows.
+    """
+    description = None
+
+    def execute(self, sql, parameters=None):
+        pass
+
+class FakeRoadsApi:
+    """
+    The requests module for the Roads API. Each point is snapped 0.00001
+    degrees north, with one interpolated point after each but the last.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def request(self, method, url, headers=None, data=None):
+        self.calls += 1
+        path = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['path'][0]
+        points = [[float(value) for value in point.split(',')] for point in path.split('|')]
+        snappedPoints = []
+        for i, (latitude, longitude) in enumerate(points):
+            snappedPoints.append({'location': {'latitude': latitude + 0.00001, 'longitude': longitude},
+                                  'originalIndex': i, 'placeId': 'place {} {}'.format(latitude, longitude)})
+            if i + 1 < len(points):
+                snappedPoints.append({'location': {'latitude': latitude + 0.00001,
+                                                   'longitude': (longitude + points[i + 1][1]) / 2},
+                                      'placeId': 'interpolated {} {}'.format(latitude, longitude)})
+        return types.SimpleNamespace(status_code=200, text=json.dumps({'snappedPoints': snappedPoints}))
+
+def makeWaypoints():
+    """
+    Return the waypoints (as from selectWaypoints) of a ride east through a few
+    segments, two waypoints in each cell.
+    """
+    return [{'latitude': 34.0512, 'longitude': -118.25 + i * 0.0007, 'idx': i} for i in range(60)]
+
+class SnappedSegmentCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.wpSnap = loadLambda('wp-snap')
+        self.roadsApi = FakeRoadsApi()
+        self.wpSnap.requests = self.roadsApi
+
+    def testCachedSnapMatchesUncached(self):
+        waypoints = makeWaypoints()
+        segments = self.wpSnap.splitSnapSegments(waypoints)
+        self.assertGreater(len(segments), 2)
+
+        uncached = self.wpSnap.snapWaypoints(FakeCursor(), waypoints)
+        self.assertEqual(self.roadsApi.calls, 1)
+        cached = self.wpSnap.snapWaypoints(FakeCursor(), waypoints)
+        self.assertEqual(self.roadsApi.calls, 1)
+
+        # A cached point has the idx of the first waypoint of its cell.
+        firstIdx = {}
+        for segment in segments:
+            for wp, cellIndex in zip(segment['waypoints'], segment['cellIndexes']):
+                firstIdx[wp['idx']] = segment['cellWaypoints'][cellIndex]['idx']
+        for wp in uncached:
+            if not wp['isInterpolated']:
+                wp['rawIdx'] = firstIdx[wp['rawIdx']]
+        self.assertEqual(cached, uncached)
+        self.assertEqual(sum(1 for wp in cached if wp['isInterpolated']), len(waypoints) - 1)
+
+    def testPartlyCached(self):
+        # Snap the second half, then the whole ride: the cached segments are
+        # reused, and the others are snapped in one request.
+        waypoints = makeWaypoints()
+        segments = self.wpSnap.splitSnapSegments(waypoints)
+        laterWaypoints = [wp for segment in segments[2:] for wp in segment['waypoints']]
+        self.wpSnap.snapWaypoints(FakeCursor(), laterWaypoints)
+        snapped = self.wpSnap.snapWaypoints(FakeCursor(), waypoints)
+        self.assertEqual(self.roadsApi.calls, 2)
+        self.assertEqual(sorted(set(wp['rawIdx'] for wp in snapped if not wp['isInterpolated'])),
+                         sorted(set(wp['idx'] for segment in segments for wp in segment['cellWaypoints'])
+                                | set(wp['idx'] for segment in segments[:2] for wp in segment['waypoints'])))
+        # No points are interpolated between the uncached and the cached segment.
+        self.assertEqual(sum(1 for wp in snapped if wp['isInterpolated']), len(waypoints) - 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,8 +5,7 @@
 
 from common.cibic_common import *
 import os
-import psycopg2
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import urllib
 
 pgDbName = os.environ['ENV_VAR_POSTGRES_DB']
@@ -23,9 +22,10 @@ def lambda_handler(event, context):
             startTime = parseDatetime(event['queryStringParameters'].get('startTime'))
             endTime = parseDatetime(event['queryStringParameters'].get('endTime'))
 
-            userData = fetchUserRideStatistics(region, organization, startTime, endTime)
-            if userData:
-                return lambdaReply(200, userData)
+            userJsons = fetchUserRideStatistics(region, organization, startTime, endTime)
+            if userJsons:
+                # Splice the JSON text of the users into the array.
+                return lambdaReplyJson(200, '[' + ', '.join(userJsons) + ']', event)
             else:
                 print('no users matching query parameters found')
                 return lambdaReply(404, 'not found')
@@ -33,33 +33,20 @@ def lambda_handler(event, context):
         err = reportError()
         print('caught exception:', sys.exc_info()[0])
         return lambdaReply(420, str(err))
+    finally:
+        printPreparedStatementStats()
 
     return processedReply()
 
-def fetchUserRideStatistics(region, organization, startTime, endTime):
-    """
-    Get active, non-deleted user enrollments and add the count of matching rides
-    where the flow is not NULL and between startTime and endTime (if not None).
-    If region is not None, restrict to the region.
-    If organization is not None, restrict to the organization.
-    """
-    extraUsersWhere = ''
-    if region != None:
-        extraUsersWhere += " AND region = '{}'".format(region)
-    if organization != None:
-        extraUsersWhere += " AND organization = '{}'".format(organization)
-
-    extraRidesWhere = ''
-    if startTime != None:
-        extraRidesWhere += " AND rides.\"startTime\" >= '{}'".format(
-          startTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"))
-    if endTime != None:
-        extraRidesWhere += " AND rides.\"startTime\" < '{}'".format(
-          endTime.astimezone().strftime("%Y-%m-%d %H:%M:%S%z"))
-
-    sql = """
+# $1 region (or NULL), $2 organization (or NULL), $3 startTime (or NULL),
+# $4 endTime (or NULL), $5 the start of the first full UTC day (or NULL for no
+# startTime) and $6 the end of the last full UTC day (or NULL for no endTime).
+# The rides on the full days are counted from RideDailyRollup and the rides on
+# the partial days at either end from Rides. The last flow is from UserLastFlow
+# if that ride is between startTime and endTime, otherwise from Rides.
+fetchUserRideStatisticsSql = """
 SELECT json_build_object(
-         'userId', "userId",
+         'userId', users."userId",
          'role', role,
          'displayName', "displayName",
          'email', email,
@@ -67,36 +54,89 @@ SELECT json_build_object(
          'outwardFlowName', "outwardFlowName",
          'returnFlowId', "returnFlowId",
          'returnFlowName', "returnFlowName",
-         'totalRides', (SELECT COUNT(*) FROM {1} AS rides
-                        WHERE rides."userId" = users."userId" AND
-                        rides.flow IS NOT NULL {3}),
+         'totalRides', COALESCE(full_days.rides, 0) + COALESCE(partial_days.rides, 0),
          'lastFlowId', last_flow_info[1],
          'lastFlowName', last_flow_info[2]
-       )
-FROM (SELECT "userId", role, "displayName", email,
+       )::text
+FROM (SELECT u."userId", role, "displayName", email,
       "outwardFlowId", "outwardFlowName", "returnFlowId", "returnFlowName",
-      (SELECT array[flow, "flowName"]
-	     FROM {1} AS rides
-	     WHERE rides."userId" = u."userId" AND rides.flow IS NOT NULL {3}
-	     ORDER BY rides."startTime" DESC
-	     LIMIT 1) AS last_flow_info
+      CASE WHEN last_flow."startTime" >= COALESCE($3, '-infinity') AND
+                last_flow."startTime" < COALESCE($4, 'infinity')
+           THEN array[last_flow.flow, last_flow."flowName"]
+           ELSE (SELECT array[flow, "flowName"]
+                 FROM {1} AS rides
+                 WHERE rides."userId" = u."userId" AND rides.flow IS NOT NULL AND {4}
+                 ORDER BY rides."startTime" DESC
+                 LIMIT 1)
+      END AS last_flow_info
       FROM {0} AS u
-      WHERE active = True AND deleted = False {2}
-      ORDER BY "userId") AS users;
-          """.format(CibicResources.Postgres.UserEnrollments,
-                     CibicResources.Postgres.Rides, extraUsersWhere, extraRidesWhere)
-    conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                            user=pgUsername, password=pgPassword)
+      LEFT JOIN {3} AS last_flow ON u."userId" = last_flow."userId"
+      WHERE active = True AND deleted = False AND {5}) AS users
+LEFT JOIN (SELECT "userId", SUM(rides) AS rides
+           FROM {2}
+           WHERE ($5::timestamptz IS NULL OR day >= ($5 AT TIME ZONE 'UTC')::date) AND
+                 ($6::timestamptz IS NULL OR day < ($6 AT TIME ZONE 'UTC')::date)
+           GROUP BY "userId") AS full_days
+ON users."userId" = full_days."userId"
+LEFT JOIN (SELECT "userId", COUNT(*) AS rides
+           FROM {1} AS rides
+           WHERE rides.flow IS NOT NULL AND
+                 ((rides."startTime" >= $3 AND rides."startTime" < $5) OR
+                  (rides."startTime" >= $6 AND rides."startTime" < COALESCE($4, 'infinity')))
+           GROUP BY "userId") AS partial_days
+ON users."userId" = partial_days."userId"
+ORDER BY users."userId";
+          """.format(CibicResources.Postgres.UserEnrollments, CibicResources.Postgres.Rides,
+                     CibicResources.Postgres.RideDailyRollup, CibicResources.Postgres.UserLastFlow,
+                     '($3::timestamptz IS NULL OR rides."startTime" >= $3) AND ($4::timestamptz IS NULL OR rides."startTime" < $4)',
+                     '($1::text IS NULL OR region = $1) AND ($2::text IS NULL OR organization = $2)')
+declarePreparedStatement('fetch_user_ride_statistics', fetchUserRideStatisticsSql,
+                         ['text', 'text', 'timestamptz', 'timestamptz', 'timestamptz', 'timestamptz'])
+
+def fetchUserRideStatistics(region, organization, startTime, endTime):
+    """
+    Get active, non-deleted user enrollments and add the count of matching rides
+    where the flow is not NULL and between startTime and endTime (if not None).
+    If region is not None, restrict to the region.
+    If organization is not None, restrict to the organization.
+    Return the list of the JSON text (built by Postgres) of each user.
+    """
+    startTime = startTime.astimezone(timezone.utc) if startTime != None else None
+    endTime = endTime.astimezone(timezone.utc) if endTime != None else None
+    (fullDaysStart, fullDaysEnd) = getFullDays(startTime, endTime)
+
+    conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
     cur = conn.cursor()
-    cur.execute(sql)
+    executePreparedStatement(cur, 'fetch_user_ride_statistics',
+                             [region, organization, startTime, endTime, fullDaysStart, fullDaysEnd])
 
-    userData = []
+    userJsons = []
     for r in cur.fetchall():
-        userData.append(r[0])
+        userJsons.append(r[0])
     conn.commit()
     cur.close()
 
-    return userData
+    return userJsons
+
+def getFullDays(startTime, endTime):
+    """
+    Return (start, end) of the whole UTC days between startTime and endTime (UTC
+    datetimes or None), where start is None if startTime is None and end is None
+    if endTime is None. If there are no whole days, start and end are endTime so
+    that the partial days do not overlap.
+    """
+    start = None
+    if startTime != None:
+        start = startTime.replace(hour=0, minute=0, second=0, microsecond=0)
+        if start < startTime:
+            start += timedelta(days=1)
+    end = None
+    if endTime != None:
+        end = endTime.replace(hour=0, minute=0, second=0, microsecond=0)
+    if start != None and end != None and start > end:
+        start = endTime
+        end = endTime
+    return (start, end)
 
 def parseDatetime(ss):
     try:
@@ -8,14 +8,13 @@ from common.cibic_common import *
 import os
 import gzip
 import base64
-import psycopg2
-from psycopg2 import extras # for fast batch insert, see https://www.psycopg.org/docs/extras.html#fast-exec
 
 # Python 3.8 lambda environment does not have requests https://stackoverflow.com/questions/58952947/import-requests-on-aws-lambda-for-python-3-8
 # for a fix using Lambda Layers, see https://dev.to/razcodes/how-to-create-a-lambda-layer-in-aws-106m
 import requests
 
 snsClient = boto3.client('sns')
+waypointsStore = makeObjectStore(CibicResources.S3Bucket.RideWaypoints)
 
 obfuscateRadius = float(os.environ['ENV_VAR_OBFUSCATE_RADIUS']) if 'ENV_VAR_OBFUSCATE_RADIUS' in os.environ else 100
 obfuscateSalt = os.environ['ENV_VAR_OBFUSCATE_SALT']
@@ -35,17 +34,24 @@ accuweatherConditionsUrl = os.environ['ENV_VAR_ACCUWEATHER_CONDITIONS_URL']
 #   'rid': "API-endpoint-request-id",
 #   'data': { 'rideData' : {'id': "rideId"}, 'flowData' : <flow-waypoints>, 'waypoints_gz_b64' : <waypoints-data> }
 # }
+# Instead of 'waypoints_gz_b64', 'data' may have the packed waypoints (see
+# cibic_common packWaypoints) or the compact 'trajectory' (see ride-data-ingest
+# isCompactTrajectory):
+#   'waypoints_bin_b64' : <base64 of packed waypoints>
+#   'waypoints_s3_key' : <key in the RideWaypoints bucket of the gzipped JSON of one of the others>
+#   'trajectory' : { 'encoded': <polyline>, 'timestampDeltas': [...], 'speedDeltas': [...], 'utcOffset': <minutes> }
 def lambda_handler(event, context):
     try:
         if 'rid' in event and 'data' in event:
             requestId = event['rid']
             payload = event['data']
-            if 'rideData' in payload and 'id' in payload['rideData'] and 'waypoints_gz_b64' in payload:
+            if ('rideData' in payload and 'id' in payload['rideData'] and
+                ('waypoints_bin_b64' in payload or 'waypoints_gz_b64' in payload or
+                 'trajectory' in payload or 'waypoints_s3_key' in payload)):
                 rideData = payload['rideData']
                 flowData = payload['flowData']
                 rideId = rideData['id']
-                gunzipped_waypoints = json.loads(gzip.decompress(base64.b64decode(payload['waypoints_gz_b64'])))
-                waypoints = validateWaypoints(gunzipped_waypoints)
+                waypoints = validateWaypoints(decodeWaypoints(payload))
                 print ('API request {} process waypoints for ride {} ({} waypoints)'
                     .format(requestId, rideId, len(waypoints)))
 
@@ -62,8 +68,8 @@ def lambda_handler(event, context):
                 startZone, endZone, mainZone = splitWaypoints(obfuscateRadius, waypoints)
 
                 # Add the start and end time to rideData based on start/end zones.
-                rideData['startTime'] = startZone[0]['timestamp']
-                rideData['endTime'] = endZone[-1]['timestamp']
+                rideData['startTime'] = startZone.isoTimestamp(0)
+                rideData['endTime'] = endZone.isoTimestamp(-1)
                 # Change ISO time Z to make Python happy.
                 if rideData['startTime'].endswith('Z'):
                     rideData['startTime'] = rideData['startTime'][:-1] + '+00:00'
@@ -71,8 +77,7 @@ def lambda_handler(event, context):
                     rideData['endTime'] = rideData['endTime'][:-1] + '+00:00'
 
                 # insert data into postgres
-                conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                        user=pgUsername, password=pgPassword)
+                conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
                 cur = conn.cursor()
 
                 # insert new ride
@@ -109,16 +114,22 @@ def lambda_handler(event, context):
                 weatherJson = None
                 if role == 'steward':
                     # For a steward include the weather (at the start waypoint).
-                    weatherJson = fetchWeatherJson(startZone[0]['latitude'], startZone[0]['longitude'],
+                    weatherJson = fetchWeatherJson(startZone.latitude[0], startZone.longitude[0],
                       accuweatherLocationUrl, accuweatherConditionsUrl, accuweatherApiKey,
-                      requests)
+                      requests, cur)
 
                 # The pod is inferred later by Lambda infer-pod.
                 insertRide(cur, rideId, requestId, userId, role, flow, flowName, flowIsToWork, commute,
                            flowJoinPointsJson, flowLeavePointsJson, pod, podName, podMemberJson,
                            weatherJson, region, organization, startZone, endZone)
+                addRideToRollup(cur, rideId)
                 # insert raw waypoints
                 insertRawWaypoints(cur, rideId, requestId, waypoints)
+                flowRoute = flowData['route'] if flow != None and 'route' in flowData else []
+                # Insert the main zone ride line, also simplified for the map API, and the flow line.
+                insertRideGeometry(cur, rideId, mainZone.latitude, mainZone.longitude,
+                                   [mainZone.pointJson(i) for i in range(len(mainZone))],
+                                   [wp['lat'] for wp in flowRoute], [wp['long'] for wp in flowRoute])
                 # Insert the flow waypoints which may change over time for the same flow ID.
                 if flow != None and 'route' in flowData:
                     # Locally assign the waypoint indexes.
@@ -132,6 +143,10 @@ def lambda_handler(event, context):
                 conn.commit()
                 cur.close()
 
+                if 'waypoints_s3_key' in payload:
+                    # The waypoints are in WaypointsRaw now, so the claim check is done.
+                    waypointsStore.delete(payload['waypoints_s3_key'])
+
                 # notify waypoints added
                 response = snsClient.publish(TopicArn=waypointsReadyTopic,
                                             Message=json.dumps({'id':rideId, 'requestId':requestId, 'rideData':rideData}),
@@ -149,6 +164,31 @@ def lambda_handler(event, context):
 
     return processedReply()
 
+def decodeWaypoints(payload):
+    """
+    Return a WaypointArray from the payload 'waypoints_bin_b64', 'trajectory'
+    or 'waypoints_gz_b64'. If the payload has 'waypoints_s3_key' instead, first
+    read one of these from the object store.
+    """
+    if 'waypoints_s3_key' in payload:
+        # The waypoints were too big for the lambda payload (see ride-data-ingest).
+        print('reading waypoints from the object store: ' + payload['waypoints_s3_key'])
+        stream = waypointsStore.open(payload['waypoints_s3_key'])
+        try:
+            payload = json.load(gzip.GzipFile(fileobj=stream))
+        finally:
+            stream.close()
+
+    if 'waypoints_bin_b64' in payload:
+        return unpackWaypoints(base64.b64decode(payload['waypoints_bin_b64']))
+    if 'trajectory' in payload:
+        trajectory = payload['trajectory']
+        return WaypointArray.fromPolyline(trajectory['encoded'], trajectory['timestampDeltas'],
+                                          trajectory.get('speedDeltas'), trajectory.get('utcOffset', 0))
+
+    gunzipped_waypoints = json.loads(gzip.decompress(base64.b64decode(payload['waypoints_gz_b64'])))
+    return WaypointArray.fromDicts(gunzipped_waypoints)
+
 # NOTE: sample data  contains waypoints with identical timestamps
 # TODO: ask @Florian if that's possible for real data and cleanup if needed
 # this function leaves last (as encountered in waypoints array) waypoint out of
@@ -156,12 +196,12 @@ def lambda_handler(event, context):
 def validateWaypoints(waypoints):
     tsWaypointDict = {}
     nDuplicate = 0
-    for wp in waypoints:
-        if wp['timestamp'] in tsWaypointDict:
+    for i, timestamp in enumerate(waypoints.timestamp):
+        if timestamp in tsWaypointDict:
             nDuplicate += 1
-        tsWaypointDict[wp['timestamp']] = wp
+        tsWaypointDict[timestamp] = i
     if nDuplicate > 0:
-        validated = [tsWaypointDict[k] for k in sorted(tsWaypointDict.keys())]
+        validated = waypoints.take([tsWaypointDict[k] for k in sorted(tsWaypointDict.keys())])
         print('waypoints validation: found {} waypoints with same timestamp, {} valid waypoints'
                 .format(nDuplicate, len(validated)))
         return validated
@@ -173,32 +213,28 @@ def processWaypoints(waypoints):
 
     # calculate statistics per road type (for example)
     # stats['roadTypes'] = {}
-    roadTypes = set(map(lambda x: x['road_type'], waypoints))
-    routeSegments=[[wp for wp in waypoints if wp['road_type'] == rt] for rt in roadTypes]
-    for idx,rt in enumerate(roadTypes):
-        stats.append({ rt :  getRouteStats(routeSegments[idx]) })
-        # stats['roadTypes'][rt] = getRouteStats(routeSegments[idx])
+    roadTypes = set(waypoints.roadType)
+    for rt in roadTypes:
+        routeSegment = waypoints.take([i for i, wpRt in enumerate(waypoints.roadType) if wpRt == rt])
+        # The compact trajectory and some apps do not send the road type.
+        roadTypeName = routeSegment.roadTypeName(0)
+        stats.append({ roadTypeName if roadTypeName != None else 'unknown' :  getRouteStats(routeSegment) })
+        # stats['roadTypes'][rt] = getRouteStats(routeSegment)
 
     print('calculated route statistics {}'.format(stats))
     return stats
 
 # returns simple statistics:
 # - total distance travelled
-# - average speed
+# - average speed (None if no waypoint has a speed)
 def getRouteStats(waypoints):
-    totalDist = 0
-    avgSpeed = 0
-    prevWp = None
-    for wp in waypoints:
-        if prevWp:
-            # NOTE: can also use 'distance' from waypoint data, it is within ~1m accuracy
-            totalDist += getGreatCircleDistance(prevWp['latitude'], prevWp['longitude'],
-                                                wp['latitude'], wp['longitude'])
-        prevWp = wp
-        avgSpeed += wp['speed']
+    # NOTE: can also use 'distance' from waypoint data, it is within ~1m accuracy
+    totalDist = sum(getConsecutiveDistances(waypoints.latitude, waypoints.longitude))
     # calculate avg speed by finding average speed of all segments
     # one can also use total distance and start/end timestamp
-    avgSpeed /= len(waypoints)
+    # A missing speed is NaN, which is not valid JSON for the SNS message.
+    speeds = [speed for speed in waypoints.speed if speed == speed]
+    avgSpeed = sum(speeds) / len(speeds) if len(speeds) else None
     return { 'totalDist' : totalDist, 'avgSpeed' : avgSpeed }
 
 def insertRide(cur, rideId, requestId, userId, role, flow, flowName, flowIsToWork, commute,
@@ -220,35 +256,35 @@ def insertRide(cur, rideId, requestId, userId, role, flow, flowName, flowIsToWor
                     """.format(CibicResources.Postgres.Rides,
                                 wktPoint(cLat1, cLon1), rad1,
                                 wktPoint(cLat2, cLon2), rad2)
-    cur.execute(sqlInsertRide, (rideId, requestId, startZone[0]['timestamp'], endZone[-1]['timestamp'], userId, role, flow, flowName, flowIsToWork, commute,
+    cur.execute(sqlInsertRide, (rideId, requestId, startZone.isoTimestamp(0), endZone.isoTimestamp(-1), userId, role, flow, flowName, flowIsToWork, commute,
                                 flowJoinPointsJson, flowLeavePointsJson, pod, podName, podMemberJson, weatherJson, region, organization))
 
 def wktPoint(lat, lon):
     return 'POINT({} {})'.format(lon, lat)
 
 def insertRawWaypoints(cur, rideId, requestId, waypoints):
-    sql = """
-            INSERT INTO {} ("rideId", coordinate, timestamp, "roadType", speed, distance, "speedLimit", idx, zone, "requestId", "pointJson")
-            VALUES %s
-          """.format(CibicResources.Postgres.WaypointsRaw)
-    values = list((rideId, makeSqlPoint(wp['latitude'], wp['longitude']),
-                    wp['timestamp'], wp['road_type'], wp['speed'], wp['distance'],
-                    wp['speed_limit'], wp['originalIdx'], wp['zone'], requestId,
-                    # Cache the JSON of the point with the timestamp.
-                    '[' + str(wp['longitude']) + ', ' + str(wp['latitude']) + ', 0, "' + wp['timestamp'] + '"]')
-                  for wp in waypoints)
-    extras.execute_values(cur, sql, values)
+    def makeRows():
+        for i in range(len(waypoints)):
+            timestamp = waypoints.isoTimestamp(i)
+            yield (rideId, makeSqlPoint(waypoints.latitude[i], waypoints.longitude[i]),
+                   timestamp, waypoints.roadTypeName(i), nanToNone(waypoints.speed[i]),
+                   nanToNone(waypoints.distance[i]), nanToNone(waypoints.speedLimit[i]),
+                   waypoints.idx[i], waypoints.zoneName(i), requestId,
+                   # Cache the JSON of the point with the timestamp.
+                   waypoints.pointJson(i, timestamp))
+
+    copyRows(cur, CibicResources.Postgres.WaypointsRaw,
+             ['rideId', 'coordinate', 'timestamp', 'roadType', 'speed', 'distance', 'speedLimit',
+              'idx', 'zone', 'requestId', 'pointJson'],
+             makeRows())
     print('sql insert raw waypoints execute result: ' + str(cur.statusmessage))
 
 def insertFlowWaypoints(cur, rideId, requestId, flow, waypoints):
     try:
-        sql = """
-                INSERT INTO {} ("rideId", flow, coordinate, idx, "requestId")
-                VALUES %s
-              """.format(CibicResources.Postgres.RideFlowWaypoints)
-        values = list((rideId, flow, makeSqlPoint(wp['lat'], wp['long']),
-                       wp['idx'], requestId) for wp in waypoints)
-        extras.execute_values(cur, sql, values)
+        copyRows(cur, CibicResources.Postgres.RideFlowWaypoints,
+                 ['rideId', 'flow', 'coordinate', 'idx', 'requestId'],
+                 ((rideId, flow, makeSqlPoint(wp['lat'], wp['long']), wp['idx'], requestId)
+                  for wp in waypoints))
         print('sql insert flow waypoints execute result: ' + str(cur.statusmessage))
     except:
         print('caught exception in insertFlowWaypoints:', sys.exc_info()[0])
@@ -1,7 +1,6 @@
 from common.cibic_common import *
 import os
 import psycopg2
-from psycopg2 import extras # for fast batch insert, see https://www.psycopg.org/docs/extras.html#fast-exec
 import urllib.parse
 
 # Python 3.8 lambda environment does not have requests https://stackoverflow.com/questions/58952947/import-requests-on-aws-lambda-for-python-3-8
@@ -15,6 +14,20 @@ pgServer = os.environ['ENV_VAR_POSTGRES_SERVER']
 roadsApiKey = os.environ['ENV_VAR_GOOGLE_API_KEY']
 rideReadyTopic = os.environ['ENV_SNS_RIDE_READY']
 roadsApiUrl = 'https://roads.googleapis.com/v1/snapToRoads?key={}&interpolate={}&path={}'
+# roads API limits requests to up to 100 points
+roadsApiMaxPoints = 100
+# The waypoints are snapped in segments: runs of consecutive waypoints in the
+# same geohash cell of snapSegmentPrecision characters (about 1.2 by 0.6 km).
+# A segment is keyed by its sequence of the geohash cells of snapCellPrecision
+# characters (about 150 by 150 meters) of the waypoints, so that the rides of
+# the same route share the snapped points of the segment. These are cached in
+# the container and for snapCacheDays in the SnappedSegments table. The points
+# which the Roads API interpolates between two segments are cached with the
+# first segment, and are missing where a cached segment meets an uncached one.
+snapSegmentPrecision = 6
+snapCellPrecision = 7
+snapCacheDays = int(os.environ['ENV_VAR_SNAP_CACHE_DAYS']) if 'ENV_VAR_SNAP_CACHE_DAYS' in os.environ else 90
+snappedSegmentCache = LruCache('snapped segment', 4 * 1024 * 1024)
 
 snsClient = boto3.client('sns')
 
@@ -31,27 +44,12 @@ def lambda_handler(event, context):
                 requestId = payload['requestId']
                 print ('route snapping for ride id {}, requestId {}'.format(rideId, requestId))
 
-                conn = psycopg2.connect(host=pgServer, database=pgDbName,
-                                        user=pgUsername, password=pgPassword)
+                conn = getPostgresConnection(pgServer, pgDbName, pgUsername, pgPassword)
                 cur = conn.cursor()
 
                 # retrieve waypoints
                 waypoints = selectWaypoints(cur, rideId)
-                snappedWpts = []
-
-                # roads API limits requests to up to 100 points
-                batches = [waypoints[i:i+100] for i in range(0, len(waypoints), 100)]
-                for b in batches:
-                    print('snapping batch of {}'.format(len(b)))
-                    url = makeSnappingRequest(b)
-                    response = requests.request("GET", url, headers={}, data={})
-                    if response.status_code/100 == 2:
-                        processedWpts = processSnappingResponse(b, json.loads(response.text))
-                        print('received {} processed snapped waypoints'.format(len(processedWpts)))
-                        # print(processedWpts)
-                        snappedWpts.extend(processedWpts)
-                    else:
-                        print('Roads API request failed with code {}'.format(response.status_code))
+                snappedWpts = snapWaypoints(cur, waypoints)
 
                 # store snapped waypoints in DB
                 insertSnappedWaypoints(cur, rideId, requestId, snappedWpts)
@@ -79,6 +77,7 @@ def selectWaypoints(cur, rideId):
                  timestamp, "roadType", speed, distance, "speedLimit", idx
           FROM {}
           WHERE "rideId"=%s AND zone=%s
+          ORDER BY idx
           """.format(CibicResources.Postgres.WaypointsRaw)
     try:
         cur.execute(sql, (rideId, "main"))
@@ -108,33 +107,190 @@ def makeSnappingRequest(waypoints):
       pathParam += '{},{}'.format(wp['latitude'], wp['longitude'])
     return roadsApiUrl.format(roadsApiKey, 'true', urllib.parse.quote(pathParam))
 
-def processSnappingResponse(waypoints, response):
+def snapWaypoints(cur, waypoints):
+    """
+    Return the snapped waypoints of waypoints (from selectWaypoints). The
+    snapped points of the cached segments (see snapSegmentPrecision) are reused,
+    and only the waypoints of the other segments are sent to the Roads API. If a
+    request fails, print the error and skip its snapped waypoints.
+    """
+    segments = splitSnapSegments(waypoints)
+    snappedJsons = getSnappedSegments(cur, [segment['key'] for segment in segments])
+    for segment in segments:
+        if segment['key'] in snappedJsons:
+            segment['snapped'] = makeCachedSnappedWaypoints(segment, json.loads(snappedJsons[segment['key']]))
+
+    # Each batch is the waypoints of consecutive uncached segments, so that the
+    # Roads API does not interpolate across a cached segment.
+    batches = []
+    lastSegment = None
+    for segment in segments:
+        if 'snapped' in segment:
+            continue
+        if lastSegment == None or lastSegment['next'] is not segment:
+            batches.append([])
+        for wp, cellIndex in zip(segment['waypoints'], segment['cellIndexes']):
+            if len(batches[-1]) == roadsApiMaxPoints:
+                batches.append([])
+            batches[-1].append((wp, cellIndex, segment))
+        segment['snapped'] = []
+        segment['isSnapped'] = True
+        lastSegment = segment
+
+    for b in batches:
+        print('snapping batch of {}'.format(len(b)))
+        url = makeSnappingRequest([wp for wp, cellIndex, segment in b])
+        response = requests.request("GET", url, headers={}, data={})
+        if response.status_code/100 == 2:
+            processSnappingResponse(b, json.loads(response.text))
+        else:
+            print('Roads API request failed with code {}'.format(response.status_code))
+            for wp, cellIndex, segment in b:
+                segment['isSnapped'] = False
+
     snappedWpts = []
+    cachedSegments = 0
+    cachedWaypoints = 0
+    for segment in segments:
+        if not 'isSnapped' in segment:
+            cachedSegments += 1
+            cachedWaypoints += len(segment['waypoints'])
+        snappedWpts.extend(segment['snapped'])
+    putSnappedSegments(cur, [segment for segment in segments if segment.get('isSnapped')])
+
+    uncachedCalls = (len(waypoints) + roadsApiMaxPoints - 1) // roadsApiMaxPoints
+    print('snapped segments: {} of {} cached ({:.0%} hit rate), {} of {} waypoints cached'
+            .format(cachedSegments, len(segments), cachedSegments / max(len(segments), 1),
+                    cachedWaypoints, len(waypoints)))
+    print('Roads API calls: {}, saved {} of {}'
+            .format(len(batches), uncachedCalls - len(batches), uncachedCalls))
+    print(snappedSegmentCache.getStats())
+    return snappedWpts
+
+def splitSnapSegments(waypoints):
+    """
+    Split waypoints into segments (see snapSegmentPrecision). Return the list of
+    segment dicts with the 'key', the 'waypoints', the 'cellIndexes' (the index
+    of the cell of each waypoint in the sequence of cells), the 'cellWaypoints'
+    (the first waypoint in each cell) and the 'next' segment.
+    """
+    segments = []
+    segment = None
+    for wp in waypoints:
+        cell = encodeGeohash(wp['latitude'], wp['longitude'], snapCellPrecision)
+        if segment == None or not cell.startswith(segment['prefix']):
+            nextSegment = {'prefix': cell[:snapSegmentPrecision], 'cells': [],
+                           'waypoints': [], 'cellIndexes': [], 'cellWaypoints': [], 'next': None}
+            if segment != None:
+                segment['next'] = nextSegment
+            segment = nextSegment
+            segments.append(segment)
+        if len(segment['cells']) == 0 or segment['cells'][-1] != cell:
+            segment['cells'].append(cell)
+            segment['cellWaypoints'].append(wp)
+        segment['waypoints'].append(wp)
+        segment['cellIndexes'].append(len(segment['cells']) - 1)
+    for segment in segments:
+        segment['key'] = hashlib.sha1('|'.join(segment['cells']).encode()).hexdigest()
+    return segments
+
+def getSnappedSegments(cur, keys):
+    """
+    Return the dict of segment key -> JSON of the snapped points for the keys
+    which are cached. The keys missing from the container cache are read from
+    the SnappedSegments table in one query.
+    """
+    snappedJsons = {}
+    missingKeys = []
+    for key in keys:
+        snappedJson = snappedSegmentCache.get(key)
+        if snappedJson != None:
+            snappedJsons[key] = snappedJson
+        elif not key in missingKeys:
+            missingKeys.append(key)
+    if len(missingKeys) > 0:
+        rows = executeCacheSql(cur, """
+               SELECT "segmentKey", "snappedJson" FROM {}
+               WHERE "segmentKey" = ANY(%s) AND "createdTime" > now() - %s * interval '1 day'
+               """.format(CibicResources.Postgres.SnappedSegments), (missingKeys, snapCacheDays), fetchAll=True)
+        for key, snappedJson in rows:
+            snappedJsons[key] = snappedJson
+            snappedSegmentCache.put(key, snappedJson)
+    return snappedJsons
+
+def putSnappedSegments(cur, segments):
+    """
+    Cache the snapped points of the segments, each as a JSON array of
+    [latitude, longitude, googlePlaceId, cellIndex] where cellIndex is None for
+    an interpolated point. Also delete the rows older than snapCacheDays, which
+    are not read again.
+    """
+    if len(segments) == 0:
+        return
+    snappedJsons = {}
+    for segment in segments:
+        snappedJsons[segment['key']] = json.dumps([[wp['latitude'], wp['longitude'], wp['googlePlaceId'], wp['cellIndex']]
+                                                   for wp in segment['snapped']])
+        snappedSegmentCache.put(segment['key'], snappedJsons[segment['key']])
+    executeCacheSql(cur, """
+      INSERT INTO {} ("segmentKey", "snappedJson")
+      SELECT * FROM unnest(%s::text[], %s::text[])
+      ON CONFLICT ("segmentKey") DO UPDATE SET "snappedJson" = EXCLUDED."snappedJson", "createdTime" = now()
+      """.format(CibicResources.Postgres.SnappedSegments), (list(snappedJsons.keys()), list(snappedJsons.values())))
+    executeCacheSql(cur, """
+      DELETE FROM {} WHERE "createdTime" < now() - %s * interval '1 day'
+      """.format(CibicResources.Postgres.SnappedSegments), (snapCacheDays,))
+
+def processSnappingResponse(batch, response):
+    """
+    Append the snapped waypoints of the Roads API response to the 'snapped' of
+    their segments. batch is the list of (waypoint, cellIndex, segment) of the
+    request. An interpolated point belongs to the segment of the preceding
+    snapped waypoint, so the points interpolated between two segments are
+    cached with the first one only. A request starts and ends at a cached
+    segment (see snapWaypoints), so between a cached and an uncached segment
+    the snapped waypoints have no interpolated points.
+    """
+    segment = batch[0][2]
     for snappedWp in response.get('snappedPoints', []):
         rawIdx = -1
-        isInterpolated = not 'originalIndex' in snappedWp
-        if not isInterpolated:
-            origIdx = snappedWp['originalIndex']
-            rawIdx = origIdx + waypoints[origIdx]['idx']
-        snappedWpts.append({
-            'latitude': snappedWp['location']['latitude'],
-            'longitude': snappedWp['location']['longitude'],
-            'googlePlaceId': snappedWp['placeId'],
-            'isInterpolated': isInterpolated,
-            'rawIdx': rawIdx
-        })
+        cellIndex = None
+        if 'originalIndex' in snappedWp:
+            (wp, cellIndex, segment) = batch[snappedWp['originalIndex']]
+            rawIdx = wp['idx']
+        segment['snapped'].append(makeSnappedWaypoint(
+            snappedWp['location']['latitude'], snappedWp['location']['longitude'],
+            snappedWp['placeId'], rawIdx, cellIndex))
+
+def makeCachedSnappedWaypoints(segment, snappedPoints):
+    """
+    Return the snapped waypoints of the segment from its cached snapped points
+    (see putSnappedSegments). The rawIdx of a snapped point is the idx of the
+    first waypoint of the segment in the same cell.
+    """
+    snappedWpts = []
+    for (latitude, longitude, googlePlaceId, cellIndex) in snappedPoints:
+        rawIdx = segment['cellWaypoints'][cellIndex]['idx'] if cellIndex != None else -1
+        snappedWpts.append(makeSnappedWaypoint(latitude, longitude, googlePlaceId, rawIdx, cellIndex))
     return snappedWpts
 
+def makeSnappedWaypoint(latitude, longitude, googlePlaceId, rawIdx, cellIndex):
+    return {
+        'latitude': latitude,
+        'longitude': longitude,
+        'googlePlaceId': googlePlaceId,
+        'isInterpolated': cellIndex == None,
+        'rawIdx': rawIdx,
+        'cellIndex': cellIndex
+    }
+
 def makeSqlPoint(lat, lon):
     return str(lon) + ', ' + str(lat)
 
 def insertSnappedWaypoints(cur, rideId, requestId, waypoints):
-    sql = """
-            INSERT INTO {}
-            VALUES %s
-          """.format(CibicResources.Postgres.WaypointsSnapped)
-    values = list((rideId, makeSqlPoint(wp['latitude'], wp['longitude']),
-                    wp['rawIdx'], wp['isInterpolated'],
-                    wp['googlePlaceId'], idx, requestId) for idx, wp in enumerate(waypoints))
-    extras.execute_values(cur, sql, values)
+    # The values are in the order of the table columns.
+    copyRows(cur, CibicResources.Postgres.WaypointsSnapped, None,
+             ((rideId, makeSqlPoint(wp['latitude'], wp['longitude']),
+               wp['rawIdx'], wp['isInterpolated'],
+               wp['googlePlaceId'], idx, requestId) for idx, wp in enumerate(waypoints)))
     print('sql query execute result: ' + str(cur.statusmessage))